@@ -0,0 +1,392 @@
+#! /usr/bin/env python3
+
+# Micro benchmarks for the hot paths in hwilib
+#
+# Run from the repository root, e.g.:
+#   python contrib/benchmark.py psbt_parse
+#
+# --baseline takes a git revision whose hwilib/serializations.py is timed
+# alongside the current one where that makes sense, e.g.:
+#   python contrib/benchmark.py psbt_parse --baseline master
+
+import argparse
+import base64
+import binascii
+import importlib.util
+import os
+import struct
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import hwilib.serializations as serializations  # noqa: E402
+from hwilib.base58 import b58_digits, decode_many, encode_many  # noqa: E402
+from hwilib.batch import finish_psbt, prepare_psbt, signtx_batch  # noqa: E402
+from hwilib.descriptor import INPUT_CHARSET, descriptor_checksums  # noqa: E402
+from hwilib.serializations import (  # noqa: E402
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    PSBT,
+    PartiallySignedInput,
+    PartiallySignedOutput,
+    PrecomputedTransactionData,
+    hash256,
+    p2wpkh_script_code,
+)
+
+def measure(func, *args):
+    """Run func and return (best seconds of a few runs, peak traced bytes, result)"""
+    elapsed = min(timeit.repeat(lambda: func(*args), number=1, repeat=3))
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def report(name, elapsed, peak):
+    print('{:<40} {:>10.3f} ms {:>12.1f} KiB'.format(name, elapsed * 1000, peak / 1024))
+
+def make_psbt(num_inputs, num_prev_outputs=8, segwit=False):
+    """Build a PSBT spending num_inputs outputs of distinct previous transactions"""
+    psbt = PSBT()
+    psbt.tx.nVersion = 2
+    for i in range(num_inputs):
+        prev = CTransaction()
+        prev.nVersion = 2
+        prev.vin.append(CTxIn(COutPoint(i + 1, 0), b'\x00' * 107, 0xffffffff))
+        for j in range(num_prev_outputs):
+            prev.vout.append(CTxOut(100000 + j, b'\x76\xa9\x14' + struct.pack('<I', i) * 5 + b'\x88\xac'))
+        prev.rehash()
+
+        psbt.tx.vin.append(CTxIn(COutPoint(prev.sha256, i % num_prev_outputs), b'', 0xffffffff))
+
+        psbt_in = PartiallySignedInput()
+        if segwit:
+            psbt_in.witness_utxo = CTxOut(100000, b'\x00\x14' + struct.pack('<I', i) * 5)
+        else:
+            psbt_in.non_witness_utxo = prev
+        pubkey = b'\x02' + struct.pack('<I', i) * 8
+        psbt_in.hd_keypaths[pubkey] = (0x12345678 if i % 4 == 0 else 0x9abcdef0, 0x80000054, 0x80000001, 0x80000000, 0, i)
+        psbt.inputs.append(psbt_in)
+
+    psbt.tx.vout.append(CTxOut(num_inputs * 90000, b'\x00\x14' + b'\x11' * 20))
+    psbt.outputs.append(PartiallySignedOutput())
+    return psbt.serialize()
+
+def load_baseline(rev):
+    """hwilib.serializations as it was at the git revision rev"""
+    source = subprocess.check_output(['git', 'show', rev + ':hwilib/serializations.py'], cwd=ROOT)
+    spec = importlib.util.spec_from_loader('hwilib.baseline_serializations', loader=None)
+    module = importlib.util.module_from_spec(spec)
+    module.__package__ = 'hwilib'
+    exec(compile(source, '{}:hwilib/serializations.py'.format(rev), 'exec'), module.__dict__)
+    return module
+
+def baseline_parser(rev):
+    module = load_baseline(rev)
+
+    def parse(b64):
+        psbt = module.PSBT()
+        psbt.deserialize(b64)
+        return psbt
+    return parse
+
+def buffer_parse(b64):
+    psbt = PSBT()
+    psbt.deserialize(b64)
+    return psbt
+
+def lazy_parse(b64):
+    psbt = PSBT()
+    psbt.deserialize(b64, lazy=True)
+    return psbt
+
+def bench_psbt_parse(args):
+    b64 = make_psbt(args.inputs)
+    print('PSBT with {} inputs, {} bytes base64'.format(args.inputs, len(b64)))
+    parsers = [('parse', buffer_parse), ('lazy parse', lazy_parse)]
+    if args.baseline:
+        parsers.insert(0, ('parse at ' + args.baseline, baseline_parser(args.baseline)))
+    for name, func in parsers:
+        elapsed, peak, psbt = measure(func, b64)
+        assert psbt.serialize() == b64
+        report(name, elapsed, peak)
+
+def bench_psbt_serialize(args):
+    b64 = make_psbt(args.inputs)
+    psbt = buffer_parse(b64)
+    print('PSBT with {} inputs, {} bytes base64'.format(args.inputs, len(b64)))
+    elapsed, peak, serd = measure(psbt.serialize)
+    assert serd == b64
+    report('serialize to base64', elapsed, peak)
+    elapsed, peak, _ = measure(psbt.serialize_bytes)
+    report('serialize to bytes', elapsed, peak)
+
+# The classes that use __slots__
+SLOTTED_CLASSES = ['COutPoint', 'CTxIn', 'CTxOut', 'CScriptWitness', 'CTxInWitness', 'CTxWitness', 'PartiallySignedInput', 'PartiallySignedOutput']
+
+def without_slots(cls):
+    """The same class with a __dict__ per instance instead of __slots__"""
+    namespace = {k: v for k, v in cls.__dict__.items() if k not in cls.__slots__ and k != '__slots__'}
+    return type(cls.__name__, cls.__bases__, namespace)
+
+def retained_by_parse(raw):
+    tracemalloc.start()
+    psbt = PSBT()
+    psbt.deserialize_bytes(raw)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+def bench_psbt_memory(args):
+    inputs = max(args.inputs, 10000)
+    raw = base64.b64decode(make_psbt(inputs, segwit=True))
+    print('Segwit PSBT with {} inputs, {} bytes'.format(inputs, len(raw)))
+    originals = {name: getattr(serializations, name) for name in SLOTTED_CLASSES}
+    try:
+        for name, cls in originals.items():
+            setattr(serializations, name, without_slots(cls))
+        unslotted = retained_by_parse(raw)
+    finally:
+        for name, cls in originals.items():
+            setattr(serializations, name, cls)
+    for name, current in [('retained without __slots__', unslotted), ('retained with __slots__', retained_by_parse(raw))]:
+        print('{:<40} {:>12.1f} KiB {:>8.1f} bytes/input'.format(name, current / 1024, current / inputs))
+
+def legacy_segwit_sighashes(tx, amounts):
+    # The per-input loop the Digital Bitbox client used to run
+    sighashes = []
+    for txin, amount in zip(tx.vin, amounts):
+        prevouts_preimage = b""
+        sequence_preimage = b""
+        for inputs in tx.vin:
+            prevouts_preimage += inputs.prevout.serialize()
+            sequence_preimage += struct.pack("<I", inputs.nSequence)
+        hashPrevouts = hash256(prevouts_preimage)
+        hashSequence = hash256(sequence_preimage)
+        outputs_preimage = b""
+        for output in tx.vout:
+            outputs_preimage += output.serialize()
+        hashOutputs = hash256(outputs_preimage)
+
+        preimage = b""
+        preimage += struct.pack("<i", tx.nVersion)
+        preimage += hashPrevouts
+        preimage += hashSequence
+        preimage += txin.prevout.serialize()
+        preimage += b"\x19\x76\xa9\x14" + b"\x11" * 20 + b"\x88\xac"
+        preimage += struct.pack("<q", amount)
+        preimage += struct.pack("<I", txin.nSequence)
+        preimage += hashOutputs
+        preimage += struct.pack("<I", tx.nLockTime)
+        preimage += b"\x01\x00\x00\x00"
+        sighashes.append(hash256(preimage))
+    return sighashes
+
+def precomputed_segwit_sighashes(tx, amounts):
+    txdata = PrecomputedTransactionData(tx)
+    script_code = p2wpkh_script_code(b"\x00\x14" + b"\x11" * 20)
+    return [txdata.segwit_v0_sighash(i, script_code, amount) for i, amount in enumerate(amounts)]
+
+def bench_segwit_sighash(args):
+    inputs = min(args.inputs, 1000)
+    psbt = buffer_parse(make_psbt(inputs, segwit=True))
+    amounts = [psbt_in.witness_utxo.nValue for psbt_in in psbt.inputs]
+    print('Segwit transaction with {} inputs'.format(inputs))
+    results = []
+    for name, func in [('per-input BIP 143 preimage', legacy_segwit_sighashes), ('precomputed BIP 143 midstates', precomputed_segwit_sighashes)]:
+        elapsed, peak, sighashes = measure(func, psbt.tx, amounts)
+        results.append(sighashes)
+        report(name, elapsed, peak)
+    assert results[0] == results[1]
+
+def legacy_reserialize_sighashes(tx, script_codes):
+    # The per-input loop the Digital Bitbox client used to run
+    blank_tx = CTransaction(tx)
+    sighashes = []
+    for txin, script_code in zip(blank_tx.vin, script_codes):
+        txin.scriptSig = script_code
+        sighashes.append(hash256(blank_tx.serialize_without_witness() + b"\x01\x00\x00\x00"))
+        txin.scriptSig = b""
+    return sighashes
+
+def precomputed_legacy_sighashes(tx, script_codes):
+    txdata = PrecomputedTransactionData(tx)
+    return [txdata.legacy_sighash(i, script_code) for i, script_code in enumerate(script_codes)]
+
+def bench_legacy_sighash(args):
+    inputs = min(args.inputs, 1000)
+    psbt = buffer_parse(make_psbt(inputs))
+    script_codes = [psbt_in.non_witness_utxo.vout[txin.prevout.n].scriptPubKey for psbt_in, txin in zip(psbt.inputs, psbt.tx.vin)]
+    print('Legacy transaction with {} inputs'.format(inputs))
+    results = []
+    for name, func in [('reserialize per input', legacy_reserialize_sighashes), ('spliced precomputed layout', precomputed_legacy_sighashes)]:
+        elapsed, peak, sighashes = measure(func, psbt.tx, script_codes)
+        results.append(sighashes)
+        report(name, elapsed, peak)
+    assert results[0] == results[1]
+
+def legacy_descriptor_checksum(desc):
+    # DescriptorChecksum as it was, with a charset scan and the branchy PolyMod
+    def polymod(c, val):
+        c0 = c >> 35
+        c = ((c & 0x7ffffffff) << 5) ^ val
+        if (c0 & 1):
+            c ^= 0xf5dee51989
+        if (c0 & 2):
+            c ^= 0xa9fdca3312
+        if (c0 & 4):
+            c ^= 0x1bab10e32d
+        if (c0 & 8):
+            c ^= 0x3706b1677a
+        if (c0 & 16):
+            c ^= 0x644d626ffd
+        return c
+
+    c = 1
+    cls = 0
+    clscount = 0
+    for ch in desc:
+        pos = INPUT_CHARSET.find(ch)
+        if pos == -1:
+            return ""
+        c = polymod(c, pos & 31)
+        cls = cls * 3 + (pos >> 5)
+        clscount += 1
+        if clscount == 3:
+            c = polymod(c, cls)
+            cls = 0
+            clscount = 0
+    if clscount > 0:
+        c = polymod(c, cls)
+    for j in range(0, 8):
+        c = polymod(c, 0)
+    c ^= 1
+    return ''.join(["qpzry9x8gf2tvdw0s3jn54khce6mua7l"[(c >> (5 * (7 - j))) & 31] for j in range(0, 8)])
+
+def bench_descriptor_checksum(args):
+    xpub = 'tpubD6NzVbkrYhZ4XgiXtGrdW5XDAPFCL9h7we1vwNCpn8tGbBcgfVYjXyhWo4E1xkh56hjod1RhGjxbaTLV3X4FyWuejifB9jusQ46QzG87VKp'
+    descs = ['wpkh([00000001/84h/1h/{}h]{}/0/*)'.format(i, xpub) for i in range(100000)]
+    print('{} descriptors'.format(len(descs)))
+    results = []
+    for name, func in [('charset scan and branchy PolyMod', lambda descs: [legacy_descriptor_checksum(d) for d in descs]), ('table driven descriptor_checksums', descriptor_checksums)]:
+        elapsed, peak, checksums = measure(func, descs)
+        results.append(checksums)
+        report(name, elapsed, peak)
+    assert results[0] == results[1]
+
+def legacy_base58_encode(b):
+    # base58.encode as it was, going through hex and one digit at a time
+    n = int('0x0' + binascii.hexlify(b).decode('utf8'), 16)
+    temp = []
+    while n > 0:
+        n, r = divmod(n, 58)
+        temp.append(b58_digits[r])
+    res = ''.join(temp[::-1])
+    pad = 0
+    for c in b:
+        if c == 0:
+            pad += 1
+        else:
+            break
+    return b58_digits[0] * pad + res
+
+def legacy_base58_decode(s):
+    # base58.decode as it was, with two scans of the digits per character
+    n = 0
+    for c in s:
+        n *= 58
+        if c not in b58_digits:
+            raise ValueError('Character %r is not a valid base58 character' % c)
+        n += b58_digits.index(c)
+    h = '%x' % n
+    if len(h) % 2:
+        h = '0' + h
+    res = binascii.unhexlify(h.encode('utf8'))
+    pad = 0
+    for c in s[:-1]:
+        if c == b58_digits[0]:
+            pad += 1
+        else:
+            break
+    return b'\x00' * pad + res
+
+def bench_base58(args):
+    # Serialized extended keys with their checksums, as decoded for every xpub
+    data = [b'\x04\x88\xb2\x1e' + hash256(struct.pack('<I', i)) * 2 + hash256(struct.pack('<I', i))[:14] for i in range(100000)]
+    strings = encode_many(data)
+    print('{} extended keys'.format(len(data)))
+    results = []
+    for name, func in [('legacy encode', lambda data: [legacy_base58_encode(b) for b in data]), ('table driven encode_many', encode_many)]:
+        elapsed, peak, encoded = measure(func, data)
+        results.append(encoded)
+        report(name, elapsed, peak)
+    for name, func in [('legacy decode', lambda strings: [legacy_base58_decode(s) for s in strings]), ('table driven decode_many', decode_many)]:
+        elapsed, peak, decoded = measure(func, strings)
+        results.append(decoded)
+        report(name, elapsed, peak)
+    assert results[0] == results[1] == strings
+    assert results[2] == results[3] == data
+
+class NullSigningClient(object):
+    """Stands in for a device that signs instantly, so only the host side work is measured"""
+
+    def sign_tx(self, tx):
+        return {'psbt': tx.serialize()}
+
+def serial_signtx(psbts, fingerprint):
+    # The same work as signtx_batch(), one PSBT after another in this process
+    client = NullSigningClient()
+    results = []
+    for psbt in psbts:
+        tx = PSBT()
+        tx.deserialize_bytes(prepare_psbt(psbt, fingerprint))
+        results.append(finish_psbt(psbt, client.sign_tx(tx)['psbt'], True))
+    return results
+
+def bench_signtx_batch(args):
+    psbts = [make_psbt(args.inputs // 10) for _ in range(20)]
+    fingerprint = 0x12345678
+    print('{} PSBTs with {} inputs each, on {} processors'.format(len(psbts), args.inputs // 10, os.cpu_count()))
+    elapsed, _, expected = measure(serial_signtx, psbts, fingerprint)
+    report('in process', elapsed, 0)
+    jobs = 1
+    while jobs <= max(os.cpu_count() or 1, 2):
+        run = lambda: [result for _, result in sorted(signtx_batch(NullSigningClient(), psbts, fingerprint=fingerprint, finalize=True, max_workers=jobs), key=lambda item: item[0])]  # noqa: E731
+        elapsed = min(timeit.repeat(run, number=1, repeat=3))
+        assert run() == expected
+        report('signtx_batch, {} workers'.format(jobs), elapsed, 0)
+        jobs *= 2
+
+BENCHMARKS = {
+    'base58': bench_base58,
+    'descriptor_checksum': bench_descriptor_checksum,
+    'legacy_sighash': bench_legacy_sighash,
+    'psbt_memory': bench_psbt_memory,
+    'psbt_parse': bench_psbt_parse,
+    'psbt_serialize': bench_psbt_serialize,
+    'segwit_sighash': bench_segwit_sighash,
+    'signtx_batch': bench_signtx_batch,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Run hwilib micro benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()) + ['all'])
+    parser.add_argument('--inputs', type=int, default=2000, help='Number of inputs for PSBT benchmarks')
+    parser.add_argument('--baseline', help='Git revision to compare the PSBT parser against')
+    args = parser.parse_args()
+
+    if args.benchmark == 'all':
+        for name in sorted(BENCHMARKS.keys()):
+            BENCHMARKS[name](args)
+    else:
+        BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
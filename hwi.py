@@ -3,7 +3,10 @@
 # Hardware wallet interaction script
 
 if __name__ == '__main__':
+    from multiprocessing import freeze_support
     from hwilib.cli import main
+    freeze_support()
     main()
-else:
+elif __name__ != '__mp_main__':
+    # Worker processes started with spawn import this script as __mp_main__
     raise ImportError('hwi is not importable. Import hwilib instead')
@@ -8,33 +8,50 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 #
 
+from . import bip32
 from .serializations import hash256
 import struct
-from binascii import hexlify, unhexlify
-from typing import List
+from binascii import hexlify
+from typing import Iterable, List
 b58_digits: str = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+def _decode_table() -> bytes:
+    table = bytearray([255]) * 256
+    for i, c in enumerate(b58_digits):
+        table[ord(c)] = i
+    return bytes(table)
+
+# The value of each byte as a base58 digit, 255 for bytes that are not one,
+# for bytes.translate()
+B58_DECODE_TABLE: bytes = _decode_table()
+
+# Every pair of digits, for encoding two at a time
+B58_PAIRS: List[str] = [a + b for a in b58_digits for b in b58_digits]
+
+# Numbers are converted GROUP digits at a time, so the big integer is only
+# multiplied or divided once per group and the rest is done with small ones
+GROUP: int = 20
+GROUP_POWERS: List[int] = [58 ** i for i in range(GROUP + 1)]
+
 def encode(b: bytes) -> str:
     """Encode bytes to a base58-encoded string"""
 
     # Convert big-endian bytes to integer
-    n: int = int('0x0' + hexlify(b).decode('utf8'), 16)
+    n: int = int.from_bytes(b, 'big')
 
-    # Divide that integer into base58
+    # Divide that integer into base58, a group at a time and two digits at
+    # a time within it. The last group gets padded with zeros, which are
+    # stripped below.
     temp: List[str] = []
     while n > 0:
-        n, r = divmod(n, 58)
-        temp.append(b58_digits[r])
-    res: str = ''.join(temp[::-1])
+        n, group = divmod(n, GROUP_POWERS[GROUP])
+        for _ in range(GROUP // 2):
+            group, r = divmod(group, 58 * 58)
+            temp.append(B58_PAIRS[r])
+    res: str = ''.join(temp[::-1]).lstrip(b58_digits[0])
 
     # Encode leading zeros as base58 zeros
-    czero: int = 0
-    pad: int = 0
-    for c in b:
-        if c == czero:
-            pad += 1
-        else:
-            break
+    pad: int = len(b) - len(b.lstrip(b'\x00'))
     return b58_digits[0] * pad + res
 
 def decode(s: str) -> bytes:
@@ -42,58 +59,68 @@ def decode(s: str) -> bytes:
     if not s:
         return b''
 
-    # Convert the string to an integer
+    # Look up the value of every digit at once
+    try:
+        data: bytes = s.encode('ascii')
+    except UnicodeEncodeError as e:
+        raise ValueError('Character %r is not a valid base58 character' % s[e.start])
+    digits: bytes = data.translate(B58_DECODE_TABLE)
+    if 255 in digits:
+        raise ValueError('Character %r is not a valid base58 character' % chr(data[digits.index(255)]))
+
+    # Convert the digits to an integer, a group at a time
     n: int = 0
-    for c in s:
-        n *= 58
-        if c not in b58_digits:
-            raise ValueError('Character %r is not a valid base58 character' % c)
-        digit = b58_digits.index(c)
-        n += digit
+    for i in range(0, len(digits), GROUP):
+        chunk = digits[i:i + GROUP]
+        group: int = 0
+        for digit in chunk:
+            group = group * 58 + digit
+        n = n * GROUP_POWERS[len(chunk)] + group
 
     # Convert the integer to bytes
-    h: str = '%x' % n
-    if len(h) % 2:
-        h = '0' + h
-    res = unhexlify(h.encode('utf8'))
+    res: bytes = n.to_bytes((n.bit_length() + 7) // 8, 'big')
 
     # Add padding back.
-    pad = 0
-    for c in s[:-1]:
-        if c == b58_digits[0]:
-            pad += 1
-        else:
-            break
+    pad: int = len(data) - len(data.lstrip(b58_digits[0].encode()))
     return b'\x00' * pad + res
 
-def get_xpub_fingerprint(s: str) -> str:
-    data = decode(s)
-    fingerprint = data[5:9]
-    return struct.unpack("<I", fingerprint)[0]
+def encode_check(b: bytes) -> str:
+    """Encode bytes to a Base58Check string, with a 4 byte checksum"""
+    return encode(b + hash256(b)[0:4])
+
+def decode_check(s: str) -> bytes:
+    """Decode a Base58Check string, returning the bytes without the checksum.
+    Raises ValueError if the checksum does not match."""
+    data: bytes = decode(s)
+    if len(data) < 4 or hash256(data[:-4])[0:4] != data[-4:]:
+        raise ValueError('Invalid base58 checksum')
+    return data[:-4]
+
+def encode_many(items: Iterable[bytes]) -> List[str]:
+    """Encode many byte strings to base58"""
+    return [encode(b) for b in items]
+
+def decode_many(items: Iterable[str]) -> List[bytes]:
+    """Decode many base58 strings"""
+    return [decode(s) for s in items]
+
+# The xpub helpers below work on the interned keys of bip32.parse_xpub(), so
+# an xpub string is only decoded once
+
+def get_xpub_fingerprint(s: str) -> int:
+    return struct.unpack("<I", bip32.parse_xpub(s).parent_fingerprint)[0]
 
 def get_xpub_fingerprint_hex(xpub: str) -> str:
-    data = decode(xpub)
-    fingerprint = data[5:9]
-    return hexlify(fingerprint).decode()
+    return hexlify(bip32.parse_xpub(xpub).parent_fingerprint).decode()
 
 def get_xpub_fingerprint_as_id(xpub: str) -> str:
-    data = decode(xpub)
-    fingerprint = data[5:9]
-    return hexlify(fingerprint).decode()
+    return hexlify(bip32.parse_xpub(xpub).parent_fingerprint).decode()
 
 def to_address(b: bytes, version: bytes) -> str:
-    data = version + b
-    checksum = hash256(data)[0:4]
-    data += checksum
-    return encode(data)
+    return encode_check(version + b)
 
 def xpub_to_pub_hex(xpub: str) -> str:
-    data = decode(xpub)
-    pubkey = data[-37:-4]
-    return hexlify(pubkey).decode()
+    return hexlify(bip32.parse_xpub(xpub).pubkey).decode()
 
 def xpub_main_2_test(xpub: str) -> str:
-    data = decode(xpub)
-    test_data = b'\x04\x35\x87\xCF' + data[4:-4]
-    checksum = hash256(test_data)[0:4]
-    return encode(test_data + checksum)
+    return bip32.parse_xpub(xpub).with_version(bip32.TESTNET_XPUB_VERSION).serialize()
@@ -0,0 +1,213 @@
+# Batch processing of many PSBTs
+#
+# The CPU heavy work around signing (parsing, sanity checks, pruning,
+# merging and finalizing) is spread over a pool of worker processes. Device I/O always happens in the calling process, one
+# PSBT at a time, since a device can only handle one request at once.
+# Pools work with any multiprocessing start method, so with spawn, the
+# default on Windows and macOS, the main script must guard its entry point.
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from itertools import islice
+import os
+
+from .bip32 import HARDENED_FLAG
+from .descriptor import Descriptor
+from .errors import BadArgumentError, HWWError, UNKNOWN_ERROR
+from .serializations import PSBT
+
+def _error_result(e):
+    if isinstance(e, HWWError):
+        return {'error': e.get_msg(), 'code': e.get_code()}
+    return {'error': str(e), 'code': UNKNOWN_ERROR}
+
+# The result of a finished future, or an error result if it raised
+def _result(future):
+    try:
+        return future.result()
+    except Exception as e:
+        return _error_result(e)
+
+# Run in a worker process. Errors are turned into results there, since not
+# every exception can be pickled back to the calling process.
+def _call(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return _error_result(e)
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+# Yield (index, result) for futures, a dict of future to index in index
+# order, either in that order or as each one completes
+def _collect(futures, ordered):
+    for future in (futures if ordered else as_completed(futures)):
+        yield futures[future], _result(future)
+
+# Pop and yield (index, result) for the futures that are already done,
+# stopping at the first one that is not with ordered set
+def _pop_done(futures, ordered):
+    for future in list(futures):
+        if future.done():
+            yield futures.pop(future), _result(future)
+        elif ordered:
+            return
+
+# A process pool started with mp_context, e.g.
+# multiprocessing.get_context('spawn'), or the platform's default method.
+# Work is submitted in windows of a few items per worker, so a large batch
+# is never queued up front.
+def _executor(max_workers, mp_context):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if mp_context is None:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+    return executor, 2 * max_workers
+
+# Shut down a pool. If the batch was abandoned, e.g. by closing its
+# generator, the futures still queued are cancelled and the running ones
+# are not waited for.
+def _shutdown(executor, futures, finished):
+    if not finished:
+        for future in futures:
+            future.cancel()
+    executor.shutdown(wait=finished)
+
+# Run func(item, *args) for every item in a pool of worker processes and
+# yield (index, result) pairs. With ordered set they come in the order of
+# items, otherwise as soon as each one is done. An exception raised for an
+# item is yielded as an error result instead of stopping the batch.
+def process_batch(func, items, args=(), max_workers=None, ordered=True, mp_context=None):
+    executor, window = _executor(max_workers, mp_context)
+    items = enumerate(items)
+    pending = {}
+    finished = False
+    try:
+        while True:
+            for i, item in islice(items, window - len(pending)):
+                pending[executor.submit(_call, func, item, *args)] = i
+            if not pending:
+                break
+            if ordered:
+                future = next(iter(pending))
+                yield pending.pop(future), _result(future)
+            else:
+                wait(pending, return_when=FIRST_COMPLETED)
+                yield from _pop_done(pending, False)
+        finished = True
+    finally:
+        _shutdown(executor, pending, finished)
+
+# Parse and check a base64 PSBT and prune it for the signer with this
+# fingerprint. Returns the pruned PSBT in binary, which is much cheaper to
+# send back from a worker process than the parsed PSBT.
+def prepare_psbt(psbt, fingerprint, limits=None):
+    tx = PSBT()
+    tx.deserialize(psbt, limits=limits)
+    return tx.prune(fingerprint).serialize_bytes()
+
+# Finish a PSBT signed by a client's sign_tx(). With psbt, the full
+# original of a pruned PSBT, the signatures are merged into it first; it
+# is parsed lazily, so only the inputs that were signed are decoded.
+# Optionally finalize.
+def finish_psbt(psbt, signed, finalize=False):
+    signed_tx = PSBT()
+    signed_tx.deserialize(signed)
+    if psbt is None:
+        tx = signed_tx
+    else:
+        tx = PSBT()
+        tx.deserialize(psbt, lazy=True)
+        tx.merge_signatures(signed_tx)
+    if finalize:
+        complete = tx.finalize()
+        if complete:
+            return {'hex': tx.extract().serialize_with_witness().hex(), 'complete': True}
+        return {'psbt': tx.serialize(), 'complete': complete}
+    return {'psbt': tx.serialize()}
+
+# Sign many base64 PSBTs with one client and yield (index, result) pairs,
+# ordered or as completed like process_batch(). The device signs one PSBT
+# after another, in the order they were given. With fingerprint, the PSBTs
+# are parsed and pruned for that signer in worker processes ahead of the
+# device, and its signatures are merged back into the originals there
+# too. Without it there is nothing to prune or merge, so PSBTs are parsed
+# in the calling process and workers only finalize.
+def signtx_batch(client, psbts, fingerprint=None, finalize=False, limits=None, max_workers=None, ordered=True, mp_context=None):
+    executor, window = _executor(max_workers, mp_context)
+    psbts = iter(psbts)
+    prepared = deque()
+    finishing = {}
+    finished = False
+    try:
+        i = 0
+        while True:
+            for psbt in islice(psbts, window - len(prepared)):
+                if fingerprint is None:
+                    prepared.append((psbt, _resolved(None)))
+                else:
+                    prepared.append((psbt, executor.submit(_call, prepare_psbt, psbt, fingerprint, limits)))
+            if not prepared:
+                break
+            psbt, future = prepared.popleft()
+            result = _result(future)
+            if not isinstance(result, dict):
+                try:
+                    tx = PSBT()
+                    if result is None:
+                        tx.deserialize(psbt, limits=limits)
+                    else:
+                        tx.deserialize_bytes(result)
+                    result = client.sign_tx(tx)
+                except Exception as e:
+                    result = _error_result(e)
+            if 'psbt' in result and (fingerprint is not None or finalize):
+                original = None if fingerprint is None else psbt
+                finishing[executor.submit(_call, finish_psbt, original, result['psbt'], finalize)] = i
+            else:
+                finishing[_resolved(result)] = i
+            i += 1
+
+            # Hand out whatever is finished while the device is busy
+            yield from _pop_done(finishing, ordered)
+
+        yield from _collect(finishing, ordered)
+        finished = True
+    finally:
+        _shutdown(executor, list(finishing) + [future for _, future in prepared], finished)
+
+# Run in a worker process: the addresses of a valid pkh, wpkh or sh(wpkh)
+# descriptor for a chunk (start, end) of indexes, inclusive
+def derive_address_range(chunk, desc, testnet=False):
+    start, end = chunk
+    return Descriptor.parse(desc, testnet).get_addresses(start, end)
+
+# Derive the addresses of a ranged pkh, wpkh or sh(wpkh) descriptor from
+# index start to end, inclusive. The descriptor and range are checked, and
+# the first address derived, before anything is yielded. The range is then
+# split into chunks of chunk_size indexes that are derived in a pool of
+# worker processes, and the addresses are yielded in order as each chunk is
+# done. Should a later chunk still fail, the addresses of the chunks before
+# it have already been yielded when the error is raised.
+def derive_addresses(desc, start, end, testnet=False, max_workers=None, chunk_size=1000, mp_context=None):
+    descriptor = Descriptor.parse(desc, testnet)
+    if descriptor is None:
+        raise BadArgumentError('Unable to parse descriptor: ' + desc)
+    if not 0 <= start <= end < HARDENED_FLAG:
+        raise BadArgumentError('Invalid range {} to {}'.format(start, end))
+    descriptor.get_address(start)
+
+    chunks = [(i, min(i + chunk_size - 1, end)) for i in range(start, end + 1, chunk_size)]
+    if len(chunks) == 1:
+        # Not worth starting the workers
+        yield from descriptor.get_addresses(start, end)
+        return
+    for _, result in process_batch(derive_address_range, chunks, args=(desc, testnet), max_workers=max_workers, mp_context=mp_context):
+        if isinstance(result, dict):
+            raise HWWError(result['error'], result['code'])
+        yield from result
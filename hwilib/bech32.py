@@ -21,18 +21,36 @@
 """Reference implementation for Bech32 and segwit addresses."""
 
 
+from functools import lru_cache
+
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
 
+# Value of each character of CHARSET
+CHARSET_POS = {c: i for i, c in enumerate(CHARSET)}
+
 
-def bech32_polymod(values):
-    """Internal function that computes the Bech32 checksum."""
+def _polymod_table():
+    """The generator terms to xor in for each value of the top 5 bits."""
     generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
-    chk = 1
-    for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1ffffff) << 5 ^ value
+    table = []
+    for top in range(32):
+        term = 0
         for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+            if (top >> i) & 1:
+                term ^= generator[i]
+        table.append(term)
+    return table
+
+
+POLYMOD_TABLE = _polymod_table()
+
+
+def bech32_polymod(values, chk=1):
+    """Internal function that computes the Bech32 checksum, continuing from
+    chk if given."""
+    table = POLYMOD_TABLE
+    for value in values:
+        chk = ((chk & 0x1ffffff) << 5) ^ value ^ table[chk >> 25]
     return chk
 
 
@@ -41,15 +59,20 @@ def bech32_hrp_expand(hrp):
     return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
 
 
+@lru_cache(maxsize=16)
+def bech32_hrp_polymod(hrp):
+    """The checksum state after the expanded HRP, computed once per HRP."""
+    return bech32_polymod(bech32_hrp_expand(hrp))
+
+
 def bech32_verify_checksum(hrp, data):
     """Verify a checksum given HRP and converted data characters."""
-    return bech32_polymod(bech32_hrp_expand(hrp) + data) == 1
+    return bech32_polymod(data, bech32_hrp_polymod(hrp)) == 1
 
 
 def bech32_create_checksum(hrp, data):
     """Compute the checksum values given HRP and data."""
-    values = bech32_hrp_expand(hrp) + data
-    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    polymod = bech32_polymod(data + [0, 0, 0, 0, 0, 0], bech32_hrp_polymod(hrp)) ^ 1
     return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
 
 
@@ -68,17 +91,47 @@ def bech32_decode(bech):
     pos = bech.rfind('1')
     if pos < 1 or pos + 7 > len(bech) or len(bech) > 90:
         return (None, None)
-    if not all(x in CHARSET for x in bech[pos + 1:]):
+    try:
+        data = [CHARSET_POS[x] for x in bech[pos + 1:]]
+    except KeyError:
         return (None, None)
     hrp = bech[:pos]
-    data = [CHARSET.find(x) for x in bech[pos + 1:]]
     if not bech32_verify_checksum(hrp, data):
         return (None, None)
     return (hrp, data[:-6])
 
 
 def convertbits(data, frombits, tobits, pad=True):
-    """General power-of-2 base conversion."""
+    """General power-of-2 base conversion. Bytes to 5 bit values and 5 bit
+    values to bytes are converted through one big integer."""
+    if frombits == 8 and tobits == 5:
+        try:
+            data = bytes(data)
+        except ValueError:
+            return None
+        nbits = len(data) * 8
+        acc = int.from_bytes(data, 'big')
+        extra = nbits % 5
+        if not pad:
+            if acc & ((1 << extra) - 1):
+                return None
+            acc >>= extra
+            nbits -= extra
+        elif extra:
+            acc <<= 5 - extra
+            nbits += 5 - extra
+        return [(acc >> shift) & 31 for shift in range(nbits - 5, -1, -5)]
+    if frombits == 5 and tobits == 8 and not pad:
+        acc = 0
+        for value in data:
+            if value < 0 or (value >> 5):
+                return None
+            acc = (acc << 5) | value
+        extra = len(data) * 5 % 8
+        if extra >= 5 or acc & ((1 << extra) - 1):
+            return None
+        return list((acc >> extra).to_bytes(len(data) * 5 // 8, 'big'))
+
     acc = 0
     bits = 0
     ret = []
@@ -116,8 +169,28 @@ def decode(hrp, addr):
 
 
 def encode(hrp, witver, witprog):
-    """Encode a segwit address."""
-    ret = bech32_encode(hrp, [witver] + convertbits(witprog, 8, 5))
-    if decode(hrp, ret) == (None, None):
+    """Encode a segwit address. Returns None for anything decode() would
+    not accept back."""
+    if not hrp or hrp.lower() != hrp or any(ord(x) < 33 or ord(x) > 126 for x in hrp):
+        return None
+    if not 0 <= witver <= 16 or len(witprog) < 2 or len(witprog) > 40:
+        return None
+    if witver == 0 and len(witprog) != 20 and len(witprog) != 32:
+        return None
+    data = convertbits(witprog, 8, 5)
+    if data is None:
+        return None
+    ret = bech32_encode(hrp, [witver] + data)
+    if len(ret) > 90:
         return None
     return ret
+
+
+def encode_many(hrp, programs):
+    """Encode segwit addresses for many (witver, witprog) pairs."""
+    return [encode(hrp, witver, witprog) for witver, witprog in programs]
+
+
+def decode_many(hrp, addrs):
+    """Decode many segwit addresses to (witver, witprog) pairs."""
+    return [decode(hrp, addr) for addr in addrs]
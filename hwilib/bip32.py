@@ -0,0 +1,251 @@
+# BIP 32 public key derivation
+#
+# Non-hardened children of an extended public key can be derived from the
+# public key alone, so once the xpub of a path's last hardened step is known
+# the rest of the path does not need the device. The curve arithmetic is
+# done here rather than with ecdsa's points, which are too slow for deriving
+# many addresses.
+
+from functools import lru_cache
+import hashlib
+import hmac
+import struct
+from typing import List, Tuple
+
+from ecdsa.curves import SECP256k1  # type: ignore
+
+from . import base58
+from .errors import BadArgumentError
+from .serializations import hash160
+
+HARDENED_FLAG = 0x80000000
+
+CURVE_P = SECP256k1.curve.p()
+CURVE_N = SECP256k1.order
+CURVE_G = (SECP256k1.generator.x(), SECP256k1.generator.y())
+
+# Points are affine (x, y) tuples, or None for the point at infinity, and
+# sums are worked out in Jacobian coordinates (X, Y, Z) to save inversions
+
+def _to_affine(point):
+    x, y, z = point
+    if z == 0:
+        return None
+    zinv = pow(z, CURVE_P - 2, CURVE_P)
+    zinv2 = zinv * zinv % CURVE_P
+    return (x * zinv2 % CURVE_P, y * zinv2 * zinv % CURVE_P)
+
+def _double(point):
+    x, y, z = point
+    if y == 0 or z == 0:
+        return (1, 1, 0)
+    ysq = y * y % CURVE_P
+    s = 4 * x * ysq % CURVE_P
+    m = 3 * x * x % CURVE_P
+    nx = (m * m - 2 * s) % CURVE_P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % CURVE_P
+    return (nx, ny, 2 * y * z % CURVE_P)
+
+# Add an affine point to a Jacobian one
+def _add_affine(point, affine):
+    if affine is None:
+        return point
+    x1, y1, z1 = point
+    x2, y2 = affine
+    if z1 == 0:
+        return (x2, y2, 1)
+    z1sq = z1 * z1 % CURVE_P
+    u2 = x2 * z1sq % CURVE_P
+    s2 = y2 * z1sq * z1 % CURVE_P
+    if u2 == x1:
+        if s2 == y1:
+            return _double(point)
+        return (1, 1, 0)
+    h = (u2 - x1) % CURVE_P
+    r = (s2 - y1) % CURVE_P
+    hsq = h * h % CURVE_P
+    hcu = hsq * h % CURVE_P
+    v = x1 * hsq % CURVE_P
+    nx = (r * r - hcu - 2 * v) % CURVE_P
+    ny = (r * (v - nx) - y1 * hcu) % CURVE_P
+    return (nx, ny, z1 * h % CURVE_P)
+
+_G_TABLE: List[List[Tuple[int, int]]] = []
+
+# The multiples d * 16^w * G for d in 1 to 15 of each 4 bit window w of a
+# scalar, so multiplying G is one addition per nonzero window
+def _g_table():
+    if not _G_TABLE:
+        base = (CURVE_G[0], CURVE_G[1], 1)
+        for _ in range(64):
+            row = [base]
+            affine = _to_affine(base)
+            for _ in range(14):
+                row.append(_add_affine(row[-1], affine))
+            _G_TABLE.append([_to_affine(point) for point in row])
+            for _ in range(4):
+                base = _double(base)
+    return _G_TABLE
+
+def _mul_g(k):
+    table = _g_table()
+    point = (1, 1, 0)
+    w = 0
+    while k:
+        d = k & 15
+        if d:
+            point = _add_affine(point, table[w][d - 1])
+        k >>= 4
+        w += 1
+    return point
+
+def _decompress(pubkey):
+    if len(pubkey) != 33 or pubkey[0] not in (2, 3):
+        raise BadArgumentError('Invalid compressed public key')
+    x = int.from_bytes(pubkey[1:], 'big')
+    y = pow((x * x * x + 7) % CURVE_P, (CURVE_P + 1) // 4, CURVE_P)
+    if x >= CURVE_P or (y * y - x * x * x - 7) % CURVE_P != 0:
+        raise BadArgumentError('Public key is not on the curve')
+    if (y & 1) != (pubkey[0] & 1):
+        y = CURVE_P - y
+    return (x, y)
+
+def _compress(point):
+    return bytes([2 + (point[1] & 1)]) + point[0].to_bytes(32, 'big')
+
+# Parse a path like m/84h/1'/0/5 into a list of child numbers
+def parse_path(path):
+    steps = path.split('/')
+    if steps[0] != 'm':
+        raise BadArgumentError('Path must start with m: ' + path)
+    indexes = []
+    for step in steps[1:]:
+        hardened = step[-1:] in ("'", 'h', 'H')
+        index = step[:-1] if hardened else step
+        if not index or not all(c in '0123456789' for c in index) or int(index) >= HARDENED_FLAG:
+            raise BadArgumentError('Invalid step {} in path: {}'.format(step, path))
+        indexes.append(int(index) + (HARDENED_FLAG if hardened else 0))
+    return indexes
+
+def path_to_str(indexes):
+    return '/'.join(['m'] + [str(i & ~HARDENED_FLAG) + ('h' if i & HARDENED_FLAG else '') for i in indexes])
+
+# Split a path at its last hardened step. Returns the path up to and
+# including that step, written with h for hardened steps, and the child
+# numbers of the non-hardened steps after it.
+def split_hardened_path(path):
+    indexes = parse_path(path)
+    split = len(indexes)
+    while split > 0 and not indexes[split - 1] & HARDENED_FLAG:
+        split -= 1
+    return path_to_str(indexes[:split]), indexes[split:]
+
+MAINNET_XPUB_VERSION = b'\x04\x88\xB2\x1E'
+TESTNET_XPUB_VERSION = b'\x04\x35\x87\xCF'
+
+# A BIP 32 extended public key. Keys are immutable, so the ones from
+# parse_xpub() and the derivation cache can be shared. fingerprint is the
+# key's own fingerprint, the first 4 bytes of the hash160 of pubkey.
+class ExtendedPubKey(object):
+    __slots__ = ("version", "depth", "parent_fingerprint", "child_num", "chaincode", "pubkey", "fingerprint", "_point", "_xpub")
+
+    def __init__(self, version, depth, parent_fingerprint, child_num, chaincode, pubkey, point=None):
+        set_attr = super(ExtendedPubKey, self).__setattr__
+        set_attr('version', version)
+        set_attr('depth', depth)
+        set_attr('parent_fingerprint', parent_fingerprint)
+        set_attr('child_num', child_num)
+        set_attr('chaincode', chaincode)
+        set_attr('pubkey', pubkey)
+        set_attr('fingerprint', hash160(pubkey)[:4])
+        set_attr('_point', point)
+        set_attr('_xpub', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ExtendedPubKey is immutable')
+
+    @classmethod
+    def deserialize(cls, xpub):
+        try:
+            data = base58.decode_check(xpub)
+        except ValueError as e:
+            raise BadArgumentError('Invalid extended public key {}: {}'.format(xpub, e))
+        if len(data) != 78:
+            raise BadArgumentError('Invalid extended public key: ' + xpub)
+        version, depth, parent_fingerprint, child_num, chaincode, pubkey = struct.unpack('>4sB4sI32s33s', data)
+        if pubkey[0] not in (2, 3):
+            raise BadArgumentError('Invalid compressed public key in ' + xpub)
+        # The point is only decompressed, and checked to be on the curve,
+        # when a child is derived
+        key = cls(version, depth, parent_fingerprint, child_num, chaincode, pubkey)
+        super(ExtendedPubKey, key).__setattr__('_xpub', xpub)
+        return key
+
+    def serialize_bytes(self):
+        return struct.pack('>4sB4sI32s33s', self.version, self.depth, self.parent_fingerprint, self.child_num, self.chaincode, self.pubkey)
+
+    # The base58 xpub string, encoded once
+    def serialize(self):
+        if self._xpub is None:
+            super(ExtendedPubKey, self).__setattr__('_xpub', base58.encode_check(self.serialize_bytes()))
+        return self._xpub
+
+    # The same key with other version bytes, e.g. TESTNET_XPUB_VERSION
+    def with_version(self, version):
+        return ExtendedPubKey(version, self.depth, self.parent_fingerprint, self.child_num, self.chaincode, self.pubkey, self._point)
+
+    # The public key as an affine point, decompressed once
+    def point(self):
+        if self._point is None:
+            super(ExtendedPubKey, self).__setattr__('_point', _decompress(self.pubkey))
+        return self._point
+
+    def derive_child(self, index):
+        return _derive_child(self, index)
+
+    # Derive the key at the given non-hardened child numbers below this one
+    def derive_path(self, indexes):
+        key = self
+        for index in indexes:
+            key = _derive_child(key, index)
+        return key
+
+    def __eq__(self, other):
+        return isinstance(other, ExtendedPubKey) and self.serialize_bytes() == other.serialize_bytes()
+
+    def __hash__(self):
+        return hash(self.serialize_bytes())
+
+    def __repr__(self):
+        return "ExtendedPubKey(%s)" % self.serialize()
+
+    def __reduce__(self):
+        return (ExtendedPubKey, (self.version, self.depth, self.parent_fingerprint, self.child_num, self.chaincode, self.pubkey))
+
+# The ExtendedPubKey of an xpub string. Keys are interned: parsing the same
+# string again gives the same key without decoding it again, for the most
+# recently used strings.
+@lru_cache(maxsize=1024)
+def parse_xpub(xpub):
+    return ExtendedPubKey.deserialize(xpub)
+
+# CKDpub. Derived keys are cached, so keys sharing a parent, like the
+# addresses of one chain, only derive that parent once.
+@lru_cache(maxsize=4096)
+def _derive_child(parent, index):
+    if index & HARDENED_FLAG:
+        raise BadArgumentError('Hardened children can not be derived from an extended public key')
+    if parent.depth == 255:
+        raise BadArgumentError('Extended public key is at the maximum depth')
+    i = hmac.new(parent.chaincode, parent.pubkey + struct.pack('>I', index), hashlib.sha512).digest()
+    il = int.from_bytes(i[:32], 'big')
+    if il >= CURVE_N:
+        raise BadArgumentError('Child {} is not a valid key'.format(index))
+    point = _to_affine(_add_affine(_mul_g(il), parent.point()))
+    if point is None:
+        raise BadArgumentError('Child {} is not a valid key'.format(index))
+    return ExtendedPubKey(parent.version, parent.depth + 1, parent.fingerprint, index, i[32:], _compress(point), point)
+
+# Derive the xpub at the given non-hardened child numbers below xpub
+def derive_xpub(xpub, indexes):
+    return parse_xpub(xpub).derive_path(indexes).serialize()
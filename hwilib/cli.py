@@ -1,9 +1,10 @@
 #! /usr/bin/env python3
 
-from .commands import backup_device, displayaddress, enumerate, find_device, \
+from .commands import backup_device, combinepsbt, decodepsbt, deriveaddresses, displayaddress, enumerate, finalizepsbts, find_device, \
     get_client, getmasterxpub, getxpub, getkeypool, getdescriptors, prompt_pin, restore_device, send_pin, setup_device, \
     signmessage, signtx, wipe_device, install_udev_rules
 from .errors import (
+    BadArgumentError,
     handle_errors,
     DEVICE_CONN_ERROR,
     HELP_TEXT,
@@ -11,17 +12,45 @@ from .errors import (
     NO_DEVICE_TYPE,
     UNAVAILABLE_ACTION
 )
+from .batch import signtx_batch
 from . import __version__
 
 import argparse
 import getpass
+import inspect
 import logging
 import json
+import struct
 import sys
 
 def backup_device_handler(args, client):
     return backup_device(client, label=args.label, backup_passphrase=args.backup_passphrase)
 
+def combinepsbt_handler(args):
+    return combinepsbt(psbts=args.psbts, psbt_files=args.psbt_file, out_file=args.out_file)
+
+def finalizepsbt_handler(args):
+    results = finalizepsbts(args.psbts, extract=args.extract, psbt_files=args.psbt_file)
+    if len(results) == 1:
+        return results[0]
+    return {'results': results}
+
+# Returns a generator of JSON objects, printed by main() as they are made
+def decodepsbt_handler(args):
+    return decodepsbt(psbt=args.psbt, psbt_file=args.psbt_file, fingerprint=args.fingerprint)
+
+# Returns a generator of an object for each address as soon as it is
+# derived, then of how many there were
+def deriveaddresses_handler(args):
+    count = 0
+    for address in deriveaddresses(args.desc, start=args.start, end=args.end, testnet=args.testnet, max_workers=args.jobs):
+        line = {'address': address}
+        if args.start is not None:
+            line['index'] = args.start + count
+        yield line
+        count += 1
+    yield {'addresses': count}
+
 def displayaddress_handler(args, client):
     return displayaddress(client, desc=args.desc, path=args.path, sh_wpkh=args.sh_wpkh, wpkh=args.wpkh)
 
@@ -54,7 +83,32 @@ def signmessage_handler(args, client):
     return signmessage(client, message=args.message, path=args.path)
 
 def signtx_handler(args, client):
-    return signtx(client, psbt=args.psbt)
+    if args.batch_file:
+        return signtx_batch_handler(args, client)
+    return signtx(client, psbt=args.psbt, psbt_file=args.psbt_file, out_file=args.out_file)
+
+# Sign every base64 PSBT in the batch file, printing a JSON line for each
+# as it is done and returning a summary
+def signtx_batch_handler(args, client):
+    fingerprint = None
+    if args.fingerprint:
+        try:
+            fp_bytes = bytes.fromhex(args.fingerprint)
+        except ValueError:
+            fp_bytes = b''
+        if len(fp_bytes) != 4:
+            raise BadArgumentError('Fingerprint must be 8 hex characters: ' + args.fingerprint)
+        fingerprint = struct.unpack('<I', fp_bytes)[0]
+    with open(args.batch_file) as f:
+        psbts = [line.strip() for line in f if line.strip()]
+
+    errors = 0
+    for i, result in signtx_batch(client, psbts, fingerprint=fingerprint, finalize=args.finalize, max_workers=args.jobs, ordered=not args.unordered):
+        if 'error' in result:
+            errors += 1
+        result['index'] = i
+        print(json.dumps(result), flush=True)
+    return {'signed': len(psbts) - errors, 'errors': errors}
 
 def wipe_device_handler(args, client):
     return wipe_device(client)
@@ -95,6 +149,16 @@ class HWIArgumentParser(argparse.ArgumentParser):
         print(json.dumps(error))
         self.exit(2)
 
+# Yield the objects of a streaming command, ending with an error object
+# if making one of them fails
+def stream_results(results, debug=False):
+    error = {}
+    with handle_errors(result=error, debug=debug):
+        for result in results:
+            yield result
+    if error:
+        yield error
+
 def process_commands(cli_args):
     parser = HWIArgumentParser(description='Hardware Wallet Interface, version {}.\nAccess and send commands to a hardware wallet device. Responses are in JSON format.'.format(__version__))
     parser.add_argument('--device-path', '-d', help='Specify the device path of the device to connect to')
@@ -119,9 +183,39 @@ def process_commands(cli_args):
     getmasterxpub_parser.set_defaults(func=getmasterxpub_handler)
 
     signtx_parser = subparsers.add_parser('signtx', help='Sign a PSBT')
-    signtx_parser.add_argument('psbt', help='The Partially Signed Syscoin Transaction to sign')
+    signtx_parser.add_argument('psbt', nargs='?', help='The Partially Signed Syscoin Transaction to sign, base64 encoded')
+    signtx_parser.add_argument('--psbt-file', help='Read the PSBT to sign from this binary PSBT file instead')
+    signtx_parser.add_argument('--out-file', help='Write the signed PSBT to this file in binary and only return its path and SHA256')
+    signtx_parser.add_argument('--batch-file', help='Sign every base64 PSBT in this file, one per line, printing a JSON line with the index and result of each. Parsing, pruning and finalizing run in parallel worker processes')
+    signtx_parser.add_argument('--jobs', '-j', type=int, help='Number of worker processes for --batch-file, defaults to the number of processors')
+    signtx_parser.add_argument('--unordered', action='store_true', help='With --batch-file, print results as they are done instead of in file order')
+    signtx_parser.add_argument('--finalize', action='store_true', help='With --batch-file, finalize each signed PSBT and return the network serialized transaction if complete')
     signtx_parser.set_defaults(func=signtx_handler)
 
+    combinepsbt_parser = subparsers.add_parser('combinepsbt', help='Combine PSBTs for the same transaction, e.g. signed by different devices, into one. Does not need a device')
+    combinepsbt_parser.add_argument('psbts', nargs='*', help='The base64 encoded PSBTs to combine')
+    combinepsbt_parser.add_argument('--psbt-file', action='append', default=[], help='A binary PSBT file to combine. Can be given multiple times')
+    combinepsbt_parser.add_argument('--out-file', help='Write the combined PSBT to this file in binary and only return its path and SHA256')
+    combinepsbt_parser.set_defaults(func=combinepsbt_handler)
+
+    finalizepsbt_parser = subparsers.add_parser('finalizepsbt', help='Finalize PSBTs and extract the signed transactions if complete. Does not need a device')
+    finalizepsbt_parser.add_argument('psbts', nargs='*', help='The base64 encoded PSBTs to finalize')
+    finalizepsbt_parser.add_argument('--psbt-file', action='append', default=[], help='A binary PSBT file to finalize. Can be given multiple times')
+    finalizepsbt_parser.add_argument('--no-extract', action='store_false', dest='extract', help='Return the finalized PSBT even if it is complete, instead of the network serialized transaction')
+    finalizepsbt_parser.set_defaults(func=finalizepsbt_handler)
+
+    decodepsbt_parser = subparsers.add_parser('decodepsbt', help='Describe a PSBT in JSON lines: the transaction, each input and output as it is decoded, then the fee and whether it is complete. With --fingerprint, also show the keypaths of that signer and whether it has signed. Does not need a device')
+    decodepsbt_parser.add_argument('psbt', nargs='?', help='The base64 encoded PSBT to describe')
+    decodepsbt_parser.add_argument('--psbt-file', help='Read the PSBT from this binary PSBT file instead')
+    decodepsbt_parser.set_defaults(func=decodepsbt_handler)
+
+    deriveaddresses_parser = subparsers.add_parser('deriveaddresses', help='Derive the addresses of a pkh, wpkh or sh(wpkh) descriptor, printing a JSON line for each. Ranges are split over parallel worker processes. Does not need a device')
+    deriveaddresses_parser.add_argument('desc', help='The descriptor. Keys must be public and the steps after them not hardened')
+    deriveaddresses_parser.add_argument('start', nargs='?', type=int, help='The first index to derive, for a ranged descriptor')
+    deriveaddresses_parser.add_argument('end', nargs='?', type=int, help='The last index to derive, for a ranged descriptor')
+    deriveaddresses_parser.add_argument('--jobs', '-j', type=int, help='Number of worker processes, defaults to the number of processors')
+    deriveaddresses_parser.set_defaults(func=deriveaddresses_handler)
+
     getxpub_parser = subparsers.add_parser('getxpub', help='Get an extended public key')
     getxpub_parser.add_argument('path', help='The BIP 32 derivation path to derive the key at')
     getxpub_parser.set_defaults(func=getxpub_handler)
@@ -220,6 +314,14 @@ def process_commands(cli_args):
     if command == 'enumerate':
         return args.func(args)
 
+    # Decode, combine or finalize PSBTs, or derive addresses, locally
+    if command in ['decodepsbt', 'combinepsbt', 'finalizepsbt', 'deriveaddresses']:
+        with handle_errors(result=result, debug=args.debug):
+            result = args.func(args)
+        if inspect.isgenerator(result):
+            return stream_results(result, args.debug)
+        return result
+
     # Install the devices udev rules for Linux
     if command == 'installudevrules':
         with handle_errors(msg="installudevrules failed:", result=result):
@@ -252,4 +354,8 @@ def process_commands(cli_args):
 
 def main():
     result = process_commands(sys.argv[1:])
-    print(json.dumps(result))
+    if inspect.isgenerator(result):
+        for line in result:
+            print(json.dumps(line), flush=True)
+    else:
+        print(json.dumps(result))
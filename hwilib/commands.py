@@ -2,13 +2,16 @@
 
 # Hardware wallet interaction script
 
+import hashlib
 import importlib
 import platform
+import struct
 
-from .serializations import PSBT
+from .serializations import CTxOut, PSBT
+from .batch import derive_addresses
 from .base58 import get_xpub_fingerprint_as_id, get_xpub_fingerprint_hex, xpub_to_pub_hex
-from .errors import UnknownDeviceError, BAD_ARGUMENT, NOT_IMPLEMENTED
-from .descriptor import Descriptor
+from .errors import BadArgumentError, UnknownDeviceError, BAD_ARGUMENT, NOT_IMPLEMENTED
+from .descriptor import ADDRESS_DESCRIPTORS, Descriptor
 from .devices import __all__ as all_devs
 
 # Get the client for the device
@@ -71,12 +74,176 @@ def find_device(device_path, password='', device_type=None, fingerprint=None):
 def getmasterxpub(client):
     return client.get_master_xpub()
 
-def signtx(client, psbt):
+def signtx(client, psbt=None, psbt_file=None, out_file=None):
     # Deserialize the transaction
     tx = PSBT()
-    tx.deserialize(psbt)
+    if psbt_file:
+        tx.deserialize_file(psbt_file)
+    elif psbt:
+        tx.deserialize(psbt)
+    else:
+        raise BadArgumentError('Either a PSBT or a PSBT file must be given')
+
+    # Write the signed PSBT to out_file and only return where it went. The
+    # PSBT is signed in place, so it is serialized straight to binary.
+    if out_file:
+        client.sign_psbt(tx)
+        return write_psbt_file(out_file, tx.serialize_bytes())
     return client.sign_tx(tx)
 
+# Combine PSBTs given as base64 strings or binary PSBT files into one
+def combinepsbt(psbts=(), psbt_files=(), out_file=None):
+    txs = []
+    for psbt in psbts:
+        tx = PSBT()
+        tx.deserialize(psbt)
+        txs.append(tx)
+    for psbt_file in psbt_files:
+        tx = PSBT()
+        tx.deserialize_file(psbt_file)
+        txs.append(tx)
+    if len(txs) == 0:
+        raise BadArgumentError('No PSBTs to combine were given')
+
+    combined = txs[0]
+    combined.combine(*txs[1:])
+    if out_file:
+        return write_psbt_file(out_file, combined.serialize_bytes())
+    return {'psbt': combined.serialize()}
+
+# Finalize a PSBT, given as base64 or a PSBT object, like Syscoin Core's
+# finalizepsbt. If it is complete and extract is set, the network
+# serialized transaction is returned instead of the PSBT.
+def finalizepsbt(psbt, extract=True):
+    if isinstance(psbt, PSBT):
+        tx = psbt
+    else:
+        tx = PSBT()
+        tx.deserialize(psbt)
+    complete = tx.finalize()
+    if complete and extract:
+        return {'hex': tx.extract().serialize_with_witness().hex(), 'complete': True}
+    return {'psbt': tx.serialize(), 'complete': complete}
+
+# Finalize many PSBTs, given as base64 strings, PSBT objects or binary
+# PSBT files, returning a result for each in the same order
+def finalizepsbts(psbts=(), extract=True, psbt_files=()):
+    psbts = list(psbts)
+    for psbt_file in psbt_files:
+        tx = PSBT()
+        tx.deserialize_file(psbt_file)
+        psbts.append(tx)
+    if len(psbts) == 0:
+        raise BadArgumentError('No PSBTs to finalize were given')
+    return [finalizepsbt(psbt, extract) for psbt in psbts]
+
+# Format a keypath as a BIP 32 derivation path string
+def keypath_to_str(keypath):
+    path = 'm'
+    for index in keypath:
+        if index >= 0x80000000:
+            path += '/{}h'.format(index - 0x80000000)
+        else:
+            path += '/{}'.format(index)
+    return path
+
+def _describe_utxo(utxo, redeem_script):
+    result = {'amount': utxo.nValue, 'script_type': utxo.script_type.name.lower()}
+    if utxo.is_p2sh() and len(redeem_script) != 0:
+        result['redeem_script_type'] = CTxOut(0, redeem_script).script_type.name.lower()
+    return result
+
+# Describe a PSBT, given as base64 or a binary PSBT file, as a sequence of
+# JSON objects: the transaction, each input and each output, then a
+# summary. Maps are decoded one at a time and dropped again, so memory use
+# does not grow with the input and output data. With fingerprint, the hex
+# master key fingerprint of a signer, our_keypaths lists its keys.
+def decodepsbt(psbt=None, psbt_file=None, fingerprint=None):
+    tx = PSBT()
+    # Do not keep the parsed non_witness_utxos around
+    tx.utxo_cache = None
+    if psbt_file:
+        tx.deserialize_file(psbt_file, lazy=True)
+    elif psbt:
+        tx.deserialize(psbt, lazy=True)
+    else:
+        raise BadArgumentError('Either a PSBT or a PSBT file must be given')
+    if fingerprint:
+        try:
+            fingerprint = struct.unpack('<I', bytes.fromhex(fingerprint))[0]
+        except (ValueError, struct.error):
+            raise BadArgumentError('Fingerprint must be 4 bytes of hex')
+
+    yield {'txid': tx.tx.txid[::-1].hex(), 'version': tx.tx.nVersion, 'locktime': tx.tx.nLockTime, 'inputs': len(tx.tx.vin), 'outputs': len(tx.tx.vout)}
+
+    amount_in = 0
+    complete = True
+    for i in range(len(tx.tx.vin)):
+        txin = tx.tx.vin[i]
+        psbt_in = tx.inputs.peek(i)
+        result = {'input': i, 'prevout': '{}:{}'.format(txin.prevout.hash_bytes[::-1].hex(), txin.prevout.n)}
+        if psbt_in.witness_utxo:
+            utxo = psbt_in.witness_utxo
+        elif psbt_in.non_witness_utxo:
+            utxo = psbt_in.non_witness_utxo.vout[txin.prevout.n]
+        else:
+            utxo = None
+        if utxo is None:
+            amount_in = None
+        else:
+            result.update(_describe_utxo(utxo, psbt_in.redeem_script))
+            if amount_in is not None:
+                amount_in += utxo.nValue
+        final = len(psbt_in.final_script_sig) != 0 or not psbt_in.final_script_witness.is_null()
+        result['signatures'] = len(psbt_in.partial_sigs)
+        result['final'] = final
+        complete = complete and final
+        if fingerprint is not None:
+            our_keys = [pubkey for pubkey, keypath in psbt_in.hd_keypaths.items() if keypath[0] == fingerprint]
+            result['our_keypaths'] = [keypath_to_str(psbt_in.hd_keypaths[pubkey][1:]) for pubkey in our_keys]
+            result['signed'] = final or (len(our_keys) > 0 and all(pubkey in psbt_in.partial_sigs for pubkey in our_keys))
+        yield result
+
+    amount_out = 0
+    for i in range(len(tx.tx.vout)):
+        txout = tx.tx.vout[i]
+        psbt_out = tx.outputs.peek(i)
+        result = {'output': i}
+        result.update(_describe_utxo(txout, psbt_out.redeem_script))
+        amount_out += txout.nValue
+        if fingerprint is not None:
+            result['our_keypaths'] = [keypath_to_str(keypath[1:]) for keypath in psbt_out.hd_keypaths.values() if keypath[0] == fingerprint]
+        yield result
+
+    yield {'fee': None if amount_in is None else amount_in - amount_out, 'complete': complete}
+
+# Derive the addresses of a pkh, wpkh or sh(wpkh) descriptor locally, from
+# index start to end, inclusive, for a ranged one. A generator: ranges are
+# derived by a pool of worker processes and the addresses yielded in order.
+# Bad arguments raise before the first address, see derive_addresses().
+def deriveaddresses(desc, start=None, end=None, testnet=False, max_workers=None):
+    descriptor = Descriptor.parse(desc, testnet)
+    if descriptor is None:
+        raise BadArgumentError('Unable to parse descriptor: ' + desc)
+    if descriptor.node.nesting() not in ADDRESS_DESCRIPTORS:
+        raise BadArgumentError('Only pkh, wpkh and sh(wpkh) descriptors can be derived: ' + desc)
+
+    if not descriptor.node.is_range():
+        if start is not None or end is not None:
+            raise BadArgumentError('A range can only be given for a ranged descriptor')
+        yield descriptor.get_address()
+        return
+
+    if start is None or end is None:
+        raise BadArgumentError('A ranged descriptor needs a start and end index')
+    yield from derive_addresses(desc, start, end, testnet=testnet, max_workers=max_workers)
+
+# Write a binary PSBT to path and return the path with the SHA256 of the file
+def write_psbt_file(path, psbt_bytes):
+    with open(path, 'wb') as f:
+        f.write(psbt_bytes)
+    return {'psbt_file': path, 'sha256': hashlib.sha256(psbt_bytes).hexdigest()}
+
 def getxpub(client, path):
     return client.get_pubkey_at_path(path)
 
@@ -153,10 +320,9 @@ def getdescriptor(client, master_xpub, testnet=False, path=None, internal=False,
     path_base = path.rsplit(path_suffix)[0]
 
     # Get the key at the base
-    if client.xpub_cache.get(path_base) is None:
-        client.xpub_cache[path_base] = client.get_pubkey_at_path(path_base)['xpub']
+    base_xpub = client.get_pubkey_at_path(path_base)['xpub']
 
-    return Descriptor(master_fpr, path_base.replace('m', ''), client.xpub_cache.get(path_base), path_suffix, client.is_testnet, sh_wpkh, wpkh)
+    return Descriptor(master_fpr, path_base.replace('m', ''), base_xpub, path_suffix, client.is_testnet, sh_wpkh, wpkh)
 
 # wrapper to allow both internal and external entries when path not given
 def getkeypool(client, path, start, end, internal=False, keypool=True, account=0, sh_wpkh=False, wpkh=True):
@@ -212,6 +378,8 @@ def displayaddress(client, path=None, desc=None, sh_wpkh=False, wpkh=False):
         descriptor = Descriptor.parse(desc, client.is_testnet)
         if descriptor is None:
             return {'error': 'Unable to parse descriptor: ' + desc, 'code': BAD_ARGUMENT}
+        if descriptor.node.nesting() not in ADDRESS_DESCRIPTORS:
+            return {'error': 'Only pkh, wpkh and sh(wpkh) descriptors can be displayed: ' + desc, 'code': BAD_ARGUMENT}
         if descriptor.m_path is None:
             return {'error': 'Descriptor missing origin info: ' + desc, 'code': BAD_ARGUMENT}
         if descriptor.origin_fingerprint != client.fingerprint:
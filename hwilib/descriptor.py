@@ -1,54 +1,327 @@
-import re
+from functools import lru_cache
+
+from . import bech32
+from .base58 import to_address
+from .bip32 import HARDENED_FLAG, parse_path, parse_xpub
+from .errors import BadArgumentError
+from .serializations import hash160
 
 # From: https://github.com/syscoin/syscoin/blob/master/src/script/descriptor.cpp
 
+INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
+CHECKSUM_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+# Position of each character in INPUT_CHARSET
+INPUT_CHARSET_POS = {ch: pos for pos, ch in enumerate(INPUT_CHARSET)}
+
+def _polymod_tables():
+    generator = [0xf5dee51989, 0xa9fdca3312, 0x1bab10e32d, 0x3706b1677a, 0x644d626ffd]
+    table = []
+    for c0 in range(32):
+        x = 0
+        for i in range(5):
+            if c0 & (1 << i):
+                x ^= generator[i]
+        table.append(x)
+
+    # PolyMod is linear, so two steps at once only need the terms for the
+    # top 10 bits, worked out by stepping them through twice
+    table2 = []
+    for c0 in range(1024):
+        c = c0 << 30
+        for _ in range(2):
+            c = ((c & 0x7ffffffff) << 5) ^ table[c >> 35]
+        table2.append(c)
+    return table, table2
+
+# The generator terms to xor in for each value of the top 5 bits, and for
+# two steps at once for each value of the top 10 bits
+POLYMOD_TABLE, POLYMOD_TABLE2 = _polymod_tables()
+
 def PolyMod(c, val):
-    c0 = c >> 35
-    c = ((c & 0x7ffffffff) << 5) ^ val
-    if (c0 & 1):
-        c ^= 0xf5dee51989
-    if (c0 & 2):
-        c ^= 0xa9fdca3312
-    if (c0 & 4):
-        c ^= 0x1bab10e32d
-    if (c0 & 8):
-        c ^= 0x3706b1677a
-    if (c0 & 16):
-        c ^= 0x644d626ffd
-    return c
+    return ((c & 0x7ffffffff) << 5) ^ val ^ POLYMOD_TABLE[c >> 35]
 
 def DescriptorChecksum(desc):
-    INPUT_CHARSET = "0123456789()[],'/*abcdefgh@:$%{}IJKLMNOPQRSTUVWXYZ&+-.;<=>?!^_|~ijklmnopqrstuvwxyzABCDEFGH`#\"\\ "
-    CHECKSUM_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+    table = POLYMOD_TABLE
+    table2 = POLYMOD_TABLE2
+    try:
+        positions = [INPUT_CHARSET_POS[ch] for ch in desc]
+    except KeyError:
+        return ""
 
     c = 1
-    cls = 0
-    clscount = 0
-    for ch in desc:
-        pos = INPUT_CHARSET.find(ch)
-        if pos == -1:
-            return ""
-        c = PolyMod(c, pos & 31)
-        cls = cls * 3 + (pos >> 5)
-        clscount += 1
-        if clscount == 3:
-            c = PolyMod(c, cls)
-            cls = 0
-            clscount = 0
-    if clscount > 0:
-        c = PolyMod(c, cls)
-    for j in range(0, 8):
-        c = PolyMod(c, 0)
+    # Each group of 3 characters adds their low 5 bits one at a time, then
+    # their high bits together: 4 symbols, fed in two at a time
+    full = len(positions) - len(positions) % 3
+    for i in range(0, full, 3):
+        p0 = positions[i]
+        p1 = positions[i + 1]
+        p2 = positions[i + 2]
+        c = ((c & 0x3fffffff) << 10) ^ ((p0 & 31) << 5) ^ (p1 & 31) ^ table2[c >> 30]
+        c = ((c & 0x3fffffff) << 10) ^ ((p2 & 31) << 5) ^ ((p0 >> 5) * 9 + (p1 >> 5) * 3 + (p2 >> 5)) ^ table2[c >> 30]
+    if full < len(positions):
+        cls = 0
+        for pos in positions[full:]:
+            c = ((c & 0x7ffffffff) << 5) ^ (pos & 31) ^ table[c >> 35]
+            cls = cls * 3 + (pos >> 5)
+        c = ((c & 0x7ffffffff) << 5) ^ cls ^ table[c >> 35]
+    for j in range(0, 4):
+        c = ((c & 0x3fffffff) << 10) ^ table2[c >> 30]
     c ^= 1
 
-    ret = [None] * 8
-    for j in range(0, 8):
-        ret[j] = CHECKSUM_CHARSET[(c >> (5 * (7 - j))) & 31]
-    return ''.join(ret)
+    return ''.join([CHECKSUM_CHARSET[(c >> (5 * (7 - j))) & 31] for j in range(0, 8)])
+
+# Checksums of many descriptors, in order
+def descriptor_checksums(descs):
+    return [DescriptorChecksum(desc) for desc in descs]
 
 def AddChecksum(desc):
     return desc + "#" + DescriptorChecksum(desc)
 
+HEX_CHARS = set("0123456789abcdefABCDEF")
+KEY_CHARS = set("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+# A key in a descriptor with its origin info and the derivation after it.
+# origin_path and path_suffix are strings like "/84'/1'/0'" with hardened
+# steps marked by ' and are None when absent. Parsed keys are shared by
+# the parse cache and must not be modified.
+class KeyExpression(object):
+    __slots__ = ("origin_fingerprint", "origin_path", "key", "path_suffix")
+
+    def __init__(self, origin_fingerprint, origin_path, key, path_suffix):
+        self.origin_fingerprint = origin_fingerprint
+        self.origin_path = origin_path
+        self.key = key
+        self.path_suffix = path_suffix
+
+    def is_range(self):
+        return self.path_suffix is not None and self.path_suffix.rstrip("'").endswith("*")
+
+    def is_hex(self):
+        return all(c in HEX_CHARS for c in self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, KeyExpression) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return "KeyExpression(%s)" % str(self)
+
+    def __str__(self):
+        origin = ''
+        if self.origin_fingerprint is not None:
+            origin = '[' + self.origin_fingerprint + (self.origin_path or '') + ']'
+        return origin + self.key + (self.path_suffix or '')
+
+# A node of a parsed descriptor: a script function with its arguments.
+#  - pk, pkh, wpkh and combo have a single key in keys
+#  - multi and sortedmulti have a threshold and their keys
+#  - sh and wsh have the descriptor they wrap in subdescriptor
+#  - addr and raw have their argument as a string in arg
+# Parsed nodes are shared by the parse cache and must not be modified.
+class DescriptorNode(object):
+    __slots__ = ("func", "keys", "threshold", "subdescriptor", "arg")
+
+    def __init__(self, func, keys=(), threshold=None, subdescriptor=None, arg=None):
+        self.func = func
+        self.keys = tuple(keys)
+        self.threshold = threshold
+        self.subdescriptor = subdescriptor
+        self.arg = arg
+
+    # The script functions from the outside in, e.g. ['sh', 'wsh', 'multi']
+    def nesting(self):
+        funcs = []
+        node = self
+        while node is not None:
+            funcs.append(node.func)
+            node = node.subdescriptor
+        return funcs
+
+    # The innermost node, the one that has the keys
+    def inner(self):
+        node = self
+        while node.subdescriptor is not None:
+            node = node.subdescriptor
+        return node
+
+    def all_keys(self):
+        return self.inner().keys
+
+    def is_range(self):
+        return any(key.is_range() for key in self.all_keys())
+
+    def __eq__(self, other):
+        return isinstance(other, DescriptorNode) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return "DescriptorNode(%s)" % str(self)
+
+    def __str__(self):
+        if self.subdescriptor is not None:
+            args = str(self.subdescriptor)
+        elif self.arg is not None:
+            args = self.arg
+        else:
+            args = ','.join(([str(self.threshold)] if self.threshold is not None else []) + [str(key) for key in self.keys])
+        return self.func + '(' + args + ')'
+
+    def serialize(self):
+        return AddChecksum(str(self))
+
+# Where each script function may appear: at the top level, inside sh() or
+# inside wsh()
+SCRIPT_CONTEXTS = {
+    'pk': ('top', 'sh', 'wsh'),
+    'pkh': ('top', 'sh', 'wsh'),
+    'wpkh': ('top', 'sh'),
+    'combo': ('top',),
+    'multi': ('top', 'sh', 'wsh'),
+    'sortedmulti': ('top', 'sh', 'wsh'),
+    'sh': ('top',),
+    'wsh': ('top', 'sh'),
+    'addr': ('top',),
+    'raw': ('top',),
+}
+
+MAX_MULTISIG_KEYS = 20
+
+# The descriptors Descriptor can make addresses for
+ADDRESS_DESCRIPTORS = (['pkh'], ['wpkh'], ['sh', 'wpkh'])
+
+# P2PKH version, P2SH version and bech32 HRP of mainnet and testnet
+ADDRESS_PARAMS = {
+    False: (b'\x3F', b'\x05', 'sys'),
+    True: (b'\x41', b'\xc4', 'tsys'),
+}
+
+# Recursive descent parser for a descriptor without its checksum
+class DescriptorParser(object):
+    def __init__(self, desc):
+        self.desc = desc
+        self.pos = 0
+
+    def error(self, msg):
+        return BadArgumentError('{} at position {} in descriptor: {}'.format(msg, self.pos, self.desc))
+
+    def peek(self):
+        return self.desc[self.pos] if self.pos < len(self.desc) else None
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise self.error("Expected '{}'".format(ch))
+        self.pos += 1
+
+    # Read up to, not including, the first of the given characters
+    def read_until(self, stops):
+        start = self.pos
+        while self.pos < len(self.desc) and self.desc[self.pos] not in stops:
+            self.pos += 1
+        return self.desc[start:self.pos]
+
+    def parse(self):
+        node = self.parse_script('top')
+        if self.pos != len(self.desc):
+            raise self.error('Unexpected characters')
+        return node
+
+    def parse_script(self, context):
+        func = self.read_until('(')
+        if func not in SCRIPT_CONTEXTS:
+            raise self.error("Unknown script function '{}'".format(func))
+        if context not in SCRIPT_CONTEXTS[func]:
+            raise self.error("{}() is not allowed {}".format(func, 'at the top level' if context == 'top' else 'inside ' + context + '()'))
+        self.expect('(')
+
+        if func in ('sh', 'wsh'):
+            node = DescriptorNode(func, subdescriptor=self.parse_script(func))
+        elif func in ('addr', 'raw'):
+            arg = self.read_until(')')
+            if func == 'raw' and (len(arg) % 2 != 0 or not all(c in HEX_CHARS for c in arg)):
+                raise self.error('raw() needs a hex script')
+            node = DescriptorNode(func, arg=arg)
+        elif func in ('multi', 'sortedmulti'):
+            threshold = self.read_until(',)')
+            if not threshold or not all(c in '0123456789' for c in threshold):
+                raise self.error('Multisig threshold must be a number')
+            keys = []
+            while self.peek() == ',':
+                self.pos += 1
+                keys.append(self.parse_key())
+            threshold = int(threshold)
+            if not 1 <= threshold <= len(keys):
+                raise self.error('Multisig threshold must be between 1 and the number of keys')
+            if len(keys) > MAX_MULTISIG_KEYS:
+                raise self.error('Multisig can have at most {} keys'.format(MAX_MULTISIG_KEYS))
+            node = DescriptorNode(func, keys=keys, threshold=threshold)
+        else:
+            node = DescriptorNode(func, keys=[self.parse_key()])
+
+        self.expect(')')
+        return node
+
+    # Check a derivation path like "/84h/1'/0" and return it with hardened
+    # steps marked by '. With allow_range the last step may be * or *'.
+    def parse_path(self, path, allow_range):
+        steps = path.split('/')[1:]
+        for i, step in enumerate(steps):
+            index = step[:-1] if step[-1:] in ("'", 'h') else step
+            if allow_range and index == '*' and i == len(steps) - 1:
+                continue
+            if not index or not all(c in '0123456789' for c in index) or int(index) >= 0x80000000:
+                raise self.error("Invalid derivation step '{}'".format(step))
+        return path.replace('h', '\'')
+
+    def parse_key(self):
+        origin_fingerprint = None
+        origin_path = None
+        if self.peek() == '[':
+            self.pos += 1
+            origin = self.read_until(']')
+            self.expect(']')
+            origin_fingerprint, _, origin_path = origin.partition('/')
+            if len(origin_fingerprint) != 8 or not all(c in HEX_CHARS for c in origin_fingerprint):
+                raise self.error('Key origin fingerprint must be 8 hex characters')
+            origin_path = self.parse_path('/' + origin_path, False) if origin_path else None
+
+        key = self.read_until('/,)')
+        if not key or not all(c in KEY_CHARS for c in key):
+            raise self.error('Invalid key')
+        path_suffix = None
+        if self.peek() == '/':
+            path_suffix = self.parse_path(self.read_until(',)'), True)
+
+        key = KeyExpression(origin_fingerprint, origin_path, key, path_suffix)
+        if key.is_hex() and path_suffix is not None:
+            raise self.error('Public keys can not have a derivation path')
+        return key
+
+@lru_cache(maxsize=1024)
+def _parse_descriptor_body(desc):
+    return DescriptorParser(desc).parse()
+
+@lru_cache(maxsize=1024)
+def _parse_descriptor(desc):
+    desc, sep, checksum = desc.partition('#')
+    if sep:
+        if '#' in checksum:
+            raise BadArgumentError('Multiple checksums in descriptor: ' + desc)
+        if len(checksum) != 8 or DescriptorChecksum(desc) != checksum:
+            raise BadArgumentError('Invalid descriptor checksum: ' + desc)
+    return _parse_descriptor_body(desc)
+
+# Parse a descriptor, with or without its checksum, to a DescriptorNode.
+# Raises BadArgumentError when the descriptor is invalid. Parsed
+# descriptors are cached, so parsing the same one again is cheap and gives
+# back the same shared, read only, node.
+def parse_descriptor(desc):
+    return _parse_descriptor(desc.strip())
+
 class Descriptor:
     def __init__(self, origin_fingerprint, origin_path, base_key, path_suffix, testnet, sh_wpkh, wpkh):
         self.origin_fingerprint = origin_fingerprint
@@ -59,66 +332,73 @@ class Descriptor:
         self.sh_wpkh = sh_wpkh
         self.wpkh = wpkh
         self.m_path = None
+        self.node = None
 
         if origin_path:
             self.m_path_base = "m" + origin_path
             self.m_path = "m" + origin_path + (path_suffix or "")
 
+    # Parse a single key descriptor. Descriptors with several keys give the
+    # first one; the full parse is kept in node, and serialize() uses it for
+    # anything other than pkh, wpkh and sh(wpkh).
     @classmethod
     def parse(cls, desc, testnet=False):
-        sh_wpkh = None
-        wpkh = None
-        origin_fingerprint = None
-        origin_path = None
-        base_key_and_path_match = None
-        base_key = None
-        path_suffix = None
+        try:
+            node = parse_descriptor(desc)
+        except BadArgumentError:
+            return None
 
-        # Check the checksum
-        check_split = desc.split('#')
-        if len(check_split) > 2:
+        keys = node.all_keys()
+        if not keys:
             return None
-        if len(check_split) == 2:
-            if len(check_split[1]) != 8:
-                return None
-            checksum = DescriptorChecksum(check_split[0])
-            if not checksum.strip():
-                return None
-            if checksum != check_split[1]:
-                return None
-        desc = check_split[0]
-
-        if desc.startswith("sh(wpkh("):
-            sh_wpkh = True
-        elif desc.startswith("wpkh("):
-            wpkh = True
-
-        origin_match = re.search(r"\[(.*)\]", desc)
-        if origin_match:
-            origin = origin_match.group(1)
-            match = re.search(r"^([0-9a-fA-F]{8})(\/.*)", origin)
-            if match:
-                origin_fingerprint = match.group(1)
-                origin_path = match.group(2)
-                # Replace h with '
-                origin_path = origin_path.replace('h', '\'')
-
-            base_key_and_path_match = re.search(r"\[.*\](\w+)([\/\)][\d'\/\*]*)", desc)
-        else:
-            base_key_and_path_match = re.search(r"\((\w+)([\/\)][\d'\/\*]*)", desc)
+        key = keys[0]
+        nesting = node.nesting()
+        sh_wpkh = True if nesting == ['sh', 'wpkh'] else None
+        wpkh = True if nesting == ['wpkh'] else None
 
-        if base_key_and_path_match:
-            base_key = base_key_and_path_match.group(1)
-            path_suffix = base_key_and_path_match.group(2)
-            if path_suffix == ")":
-                path_suffix = None
-        else:
-            if origin_match is None:
-                return None
+        descriptor = cls(key.origin_fingerprint, key.origin_path, key.key, key.path_suffix, testnet, sh_wpkh, wpkh)
+        descriptor.node = node
+        return descriptor
+
+    # The public key of the descriptor, at index for a ranged one. Keys are
+    # derived locally, so the key must be public and the steps after it
+    # not hardened.
+    def get_pubkey(self, index=None):
+        path_suffix = self.path_suffix or ''
+        if ('*' in path_suffix) != (index is not None):
+            raise BadArgumentError('An index must be given for ranged descriptors only')
+        if index is not None:
+            path_suffix = path_suffix.replace('*', str(index))
 
-        return cls(origin_fingerprint, origin_path, base_key, path_suffix, testnet, sh_wpkh, wpkh)
+        if all(c in HEX_CHARS for c in self.base_key):
+            if path_suffix:
+                raise BadArgumentError('Public keys can not have a derivation path')
+            return bytes.fromhex(self.base_key)
+        steps = parse_path('m' + path_suffix)
+        if any(step & HARDENED_FLAG for step in steps):
+            raise BadArgumentError('Hardened steps can not be derived from an extended public key')
+        return parse_xpub(self.base_key).derive_path(steps).pubkey
+
+    # The address of the descriptor, at index for a ranged one
+    def get_address(self, index=None):
+        if self.node is not None and self.node.nesting() not in ADDRESS_DESCRIPTORS:
+            raise BadArgumentError('Only pkh, wpkh and sh(wpkh) descriptors have addresses')
+        p2pkh_version, p2sh_version, hrp = ADDRESS_PARAMS[bool(self.testnet)]
+        keyhash = hash160(self.get_pubkey(index))
+        if self.wpkh:
+            return bech32.encode(hrp, 0, keyhash)
+        if self.sh_wpkh:
+            return to_address(hash160(b'\x00\x14' + keyhash), p2sh_version)
+        return to_address(keyhash, p2pkh_version)
+
+    # The addresses of a ranged descriptor from index start to end, inclusive
+    def get_addresses(self, start, end):
+        return [self.get_address(i) for i in range(start, end + 1)]
 
     def serialize(self):
+        if self.node is not None and self.node.nesting() not in ADDRESS_DESCRIPTORS:
+            return self.node.serialize()
+
         descriptor_open = 'pkh('
         descriptor_close = ')'
         origin = ''
@@ -7,6 +7,7 @@ from .ckcc.client import ColdcardDevice, COINKITE_VID, CKCC_PID
 from .ckcc.protocol import CCProtocolPacker, CCBusyError, CCProtoError, CCUserRefused
 from .ckcc.constants import MAX_BLK_LEN, AF_P2WPKH, AF_CLASSIC, AF_P2WPKH_P2SH
 from ..base58 import xpub_main_2_test
+from ..serializations import PSBT
 from hashlib import sha256
 
 import base64
@@ -46,9 +47,9 @@ class ColdcardClient(HardwareWalletClient):
             self.device = ColdcardDevice(dev=device)
 
     # Must return a dict with the xpub
-    # Retrieves the public key at the specified BIP 32 derivation path
+    # Retrieves the public key at the specified BIP 32 derivation path from the device
     @coldcard_exception
-    def get_pubkey_at_path(self, path):
+    def get_device_pubkey_at_path(self, path):
         self.device.check_mitm()
         path = path.replace('h', '\'')
         path = path.replace('H', '\'')
@@ -62,14 +63,15 @@ class ColdcardClient(HardwareWalletClient):
         # quick method to get fingerprint of wallet
         return hexlify(struct.pack('<I', self.device.master_fingerprint)).decode()
 
-    # Must return a hex string with the signed transaction
+    # Sign the PSBT tx in place
     # The tx must be in the combined unsigned transaction format
     @coldcard_exception
-    def sign_tx(self, tx):
+    def sign_psbt(self, tx):
         self.device.check_mitm()
 
-        # Get psbt in hex and then make binary
-        fd = io.BytesIO(base64.b64decode(tx.serialize()))
+        # Only upload what the Coldcard needs to sign
+        _, pruned_bytes = self.prune_psbt(tx, self.device.master_fingerprint)
+        fd = io.BytesIO(pruned_bytes)
 
         # learn size (portable way)
         sz = fd.seek(0, 2)
@@ -114,7 +116,11 @@ class ColdcardClient(HardwareWalletClient):
         result_len, result_sha = done
 
         result = self.device.download_file(result_len, result_sha, file_number=1)
-        return {'psbt': base64.b64encode(result).decode()}
+
+        # Put the signatures back into the full PSBT
+        signed = PSBT()
+        signed.deserialize_bytes(result)
+        tx.merge_signatures(signed)
 
     # Must return a base64 encoded string with the signed message
     # The message can be any string. keypath is the bip 32 derivation path for the key to sign with
@@ -16,7 +16,7 @@ import time
 
 from ..hwwclient import HardwareWalletClient
 from ..errors import ActionCanceledError, BadArgumentError, DeviceFailureError, DeviceAlreadyInitError, DEVICE_NOT_INITIALIZED, DeviceNotReadyError, NoPasswordError, UnavailableActionError, common_err_msgs, handle_errors
-from ..serializations import CTransaction, hash256, ser_sig_der, ser_sig_compact, ser_compact_size
+from ..serializations import PrecomputedTransactionData, hash256, p2wpkh_script_code, ser_compact_size, ser_sig_der, ser_sig_compact
 from ..base58 import get_xpub_fingerprint, xpub_main_2_test, get_xpub_fingerprint_hex
 
 applen = 225280 # flash size minus bootloader length
@@ -305,9 +305,9 @@ class DigitalbitboxClient(HardwareWalletClient):
         self.password = password
 
     # Must return a dict with the xpub
-    # Retrieves the public key at the specified BIP 32 derivation path
+    # Retrieves the public key at the specified BIP 32 derivation path from the device
     @digitalbitbox_exception
-    def get_pubkey_at_path(self, path):
+    def get_device_pubkey_at_path(self, path):
         if '\'' not in path and 'h' not in path and 'H' not in path:
             raise BadArgumentError('The digital bitbox requires one part of the derivation path to be derived using hardened keys')
         reply = send_encrypt('{"xpub":"' + path + '"}', self.password, self.device)
@@ -319,19 +319,25 @@ class DigitalbitboxClient(HardwareWalletClient):
         else:
             return {'xpub': reply['xpub']}
 
-    # Must return a hex string with the signed transaction
+    # Sign the PSBT tx in place
     # The tx must be in the PSBT format
     @digitalbitbox_exception
-    def sign_tx(self, tx):
+    def sign_psbt(self, tx):
 
-        # Create a transaction with all scriptsigs blanekd out
-        blank_tx = CTransaction(tx.tx)
+        # Create a transaction with all scriptsigs blanked out. The unsigned
+        # transaction in a PSBT already has them empty and it is not modified
+        # here, so share its inputs and outputs instead of deep copying them.
+        blank_tx = tx.tx.copy_on_write()
 
         # Get the master key fingerprint
         master_fp = get_xpub_fingerprint(self.get_pubkey_at_path('m/0h')['xpub'])
 
+        # Serializations and midstates shared by the sighashes of all inputs
+        txdata = PrecomputedTransactionData(blank_tx)
+
         # create sighashes
         sighash_tuples = []
+        our_inputs = tx.get_input_keypaths(master_fp)
         for txin, psbt_in, i_num in zip(blank_tx.vin, tx.inputs, range(len(blank_tx.vin))):
             sighash = b""
             if psbt_in.non_witness_utxo:
@@ -340,41 +346,18 @@ class DigitalbitboxClient(HardwareWalletClient):
                 # Check if P2SH
                 if utxo.is_p2sh():
                     # Look up redeemscript
-                    redeemscript = psbt_in.redeem_script
-                    # Add to blank_tx
-                    txin.scriptSig = redeemscript
+                    scriptCode = psbt_in.redeem_script
                 # Check if P2PKH
                 elif utxo.is_p2pkh() or utxo.is_p2pk():
-                    txin.scriptSig = psbt_in.non_witness_utxo.vout[txin.prevout.n].scriptPubKey
+                    scriptCode = utxo.scriptPubKey
                 # We don't know what this is, skip it
                 else:
                     continue
 
-                # Serialize and add sighash ALL
-                ser_tx = blank_tx.serialize_without_witness()
-                ser_tx += b"\x01\x00\x00\x00"
-
-                # Hash it
-                sighash += hash256(ser_tx)
-                txin.scriptSig = b""
+                # Hash it with sighash ALL
+                sighash = txdata.legacy_sighash(i_num, scriptCode)
             elif psbt_in.witness_utxo:
-                # Calculate hashPrevouts and hashSequence
-                prevouts_preimage = b""
-                sequence_preimage = b""
-                for inputs in blank_tx.vin:
-                    prevouts_preimage += inputs.prevout.serialize()
-                    sequence_preimage += struct.pack("<I", inputs.nSequence)
-                hashPrevouts = hash256(prevouts_preimage)
-                hashSequence = hash256(sequence_preimage)
-
-                # Calculate hashOutputs
-                outputs_preimage = b""
-                for output in blank_tx.vout:
-                    outputs_preimage += output.serialize()
-                hashOutputs = hash256(outputs_preimage)
-
                 # Get the scriptCode
-                scriptCode = b""
                 witness_program = b""
                 if psbt_in.witness_utxo.is_p2sh():
                     # Look up redeemscript
@@ -386,48 +369,31 @@ class DigitalbitboxClient(HardwareWalletClient):
                 # Check if witness_program is script hash
                 if len(witness_program) == 34 and witness_program[0] == 0x00 and witness_program[1] == 0x20:
                     # look up witnessscript and set as scriptCode
-                    witnessscript = psbt_in.witness_script
-                    scriptCode += ser_compact_size(len(witnessscript)) + witnessscript
+                    scriptCode = psbt_in.witness_script
                 else:
-                    scriptCode += b"\x19\x76\xa9\x14"
-                    scriptCode += witness_program[2:]
-                    scriptCode += b"\x88\xac"
-
-                # Make sighash preimage
-                preimage = b""
-                preimage += struct.pack("<i", blank_tx.nVersion)
-                preimage += hashPrevouts
-                preimage += hashSequence
-                preimage += txin.prevout.serialize()
-                preimage += scriptCode
-                preimage += struct.pack("<q", psbt_in.witness_utxo.nValue)
-                preimage += struct.pack("<I", txin.nSequence)
-                preimage += hashOutputs
-                preimage += struct.pack("<I", tx.tx.nLockTime)
-                preimage += b"\x01\x00\x00\x00"
+                    scriptCode = p2wpkh_script_code(witness_program)
 
                 # hash it
-                sighash = hash256(preimage)
+                sighash = txdata.segwit_v0_sighash(i_num, scriptCode, psbt_in.witness_utxo.nValue)
 
             # Figure out which keypath thing is for this input
-            for pubkey, keypath in psbt_in.hd_keypaths.items():
-                if master_fp == keypath[0]:
-                    # Add the keypath strings
-                    keypath_str = 'm'
-                    for index in keypath[1:]:
-                        keypath_str += '/'
-                        if index >= 0x80000000:
-                            keypath_str += str(index - 0x80000000) + 'h'
-                        else:
-                            keypath_str += str(index)
-
-                    # Create tuples and add to List
-                    tup = (binascii.hexlify(sighash).decode(), keypath_str, i_num, pubkey)
-                    sighash_tuples.append(tup)
+            for pubkey, keypath in our_inputs.get(i_num, []):
+                # Add the keypath strings
+                keypath_str = 'm'
+                for index in keypath[1:]:
+                    keypath_str += '/'
+                    if index >= 0x80000000:
+                        keypath_str += str(index - 0x80000000) + 'h'
+                    else:
+                        keypath_str += str(index)
+
+                # Create tuples and add to List
+                tup = (binascii.hexlify(sighash).decode(), keypath_str, i_num, pubkey)
+                sighash_tuples.append(tup)
 
         # Return early if nothing to do
         if len(sighash_tuples) == 0:
-            return {'psbt': tx.serialize()}
+            return
 
         # Sign the sighashes
         to_send = '{"sign":{"data":['
@@ -466,8 +432,6 @@ class DigitalbitboxClient(HardwareWalletClient):
         for tup, sig in zip(sighash_tuples, der_sigs):
             tx.inputs[tup[2]].partial_sigs[tup[3]] = sig
 
-        return {'psbt': tx.serialize()}
-
     # Must return a base64 encoded string with the signed message
     # The message can be any string
     @digitalbitbox_exception
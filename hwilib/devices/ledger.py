@@ -10,9 +10,9 @@ from .btchip.btchipUtils import compress_public_key
 import base64
 import hid
 import struct
-from .. import base58
 from ..base58 import get_xpub_fingerprint_hex
-from ..serializations import hash256, hash160, CTransaction
+from ..bip32 import ExtendedPubKey, MAINNET_XPUB_VERSION, TESTNET_XPUB_VERSION
+from ..serializations import hash160
 import logging
 import re
 
@@ -80,9 +80,9 @@ class LedgerClient(HardwareWalletClient):
         self.app = btchip(self.dongle)
 
     # Must return a dict with the xpub
-    # Retrieves the public key at the specified BIP 32 derivation path
+    # Retrieves the public key at the specified BIP 32 derivation path from the device
     @ledger_exception
-    def get_pubkey_at_path(self, path):
+    def get_device_pubkey_at_path(self, path):
         if not check_keypath(path):
             raise BadArgumentError("Invalid keypath")
         path = path[2:]
@@ -106,37 +106,36 @@ class LedgerClient(HardwareWalletClient):
             if childstr[-1] == "'" or childstr[-1] == "h" or childstr[-1] == "H":
                 childstr = childstr[:-1]
                 hard = 0x80000000
-            child = struct.pack(">I", int(childstr) + hard)
+            child = int(childstr) + hard
         # Special case for m
         else:
-            child = bytearray.fromhex("00000000")
-            fpr = child
+            child = 0
+            fpr = b'\x00\x00\x00\x00'
 
         chainCode = pubkey["chainCode"]
         publicKey = compress_public_key(pubkey["publicKey"])
 
         depth = len(path.split("/")) if len(path) > 0 else 0
-        depth = struct.pack("B", depth)
 
         if self.is_testnet:
-            version = bytearray.fromhex("043587CF")
+            version = TESTNET_XPUB_VERSION
         else:
-            version = bytearray.fromhex("0488B21E")
-        extkey = version + depth + fpr + child + chainCode + publicKey
-        checksum = hash256(extkey)[:4]
+            version = MAINNET_XPUB_VERSION
+        extkey = ExtendedPubKey(version, depth, bytes(fpr), child, bytes(chainCode), bytes(publicKey))
 
-        return {"xpub": base58.encode(extkey + checksum)}
+        return {"xpub": extkey.serialize()}
 
-    # Must return a hex string with the signed transaction
+    # Sign the PSBT tx in place
     # The tx must be in the combined unsigned transaction format
     # Current only supports segwit signing
     @ledger_exception
-    def sign_tx(self, tx):
-        c_tx = CTransaction(tx.tx)
+    def sign_psbt(self, tx):
+        c_tx = tx.tx.copy_on_write()
         tx_bytes = c_tx.serialize_with_witness()
 
         # Master key fingerprint
         master_fpr = hash160(compress_public_key(self.app.getWalletPublicKey('')["publicKey"]))[:4]
+        master_fp = struct.unpack("<I", master_fpr)[0]
         # An entry per input, each with 0 to many keys to sign with
         all_signature_attempts = [[]] * len(c_tx.vin)
 
@@ -152,14 +151,18 @@ class LedgerClient(HardwareWalletClient):
 
         script_codes = [[]] * len(c_tx.vin)
 
+        # Previous transactions converted for the device, by txid
+        ledger_prevtxs = {}
+
         # Detect changepath, (p2sh-)p2(w)pkh only
         change_path = ''
-        for txout, i_num in zip(c_tx.vout, range(len(c_tx.vout))):
+        for i_num, keypaths in tx.get_output_keypaths(master_fp).items():
+            txout = c_tx.vout[i_num]
             # Find which wallet key could be change based on hdsplit: m/.../1/k
             # Wallets shouldn't be sending to change address as user action
             # otherwise this will get confused
-            for pubkey, path in tx.outputs[i_num].hd_keypaths.items():
-                if struct.pack("<I", path[0]) == master_fpr and len(path) > 2 and path[-2] == 1:
+            for pubkey, path in keypaths:
+                if len(path) > 2 and path[-2] == 1:
                     # For possible matches, check if pubkey matches possible template
                     if hash160(pubkey) in txout.scriptPubKey or hash160(bytearray.fromhex("0014") + hash160(pubkey)) in txout.scriptPubKey:
                         change_path = ''
@@ -167,6 +170,7 @@ class LedgerClient(HardwareWalletClient):
                             change_path += str(index) + "/"
                         change_path = change_path[:-1]
 
+        our_inputs = tx.get_input_keypaths(master_fp)
         for txin, psbt_in, i_num in zip(c_tx.vin, tx.inputs, range(len(c_tx.vin))):
 
             seq = format(txin.nSequence, 'x')
@@ -179,15 +183,16 @@ class LedgerClient(HardwareWalletClient):
                 segwit_inputs.append({"value": txin.prevout.serialize() + struct.pack("<Q", psbt_in.non_witness_utxo.vout[txin.prevout.n].nValue), "witness": True, "sequence": seq_hex})
                 # We only need legacy inputs in the case where all inputs are legacy, we check
                 # later
-                ledger_prevtx = syscoinTransaction(psbt_in.non_witness_utxo.serialize())
-                legacy_inputs.append(self.app.getTrustedInput(ledger_prevtx, txin.prevout.n))
+                prev_txid = psbt_in.non_witness_utxo.txid
+                if prev_txid not in ledger_prevtxs:
+                    ledger_prevtxs[prev_txid] = syscoinTransaction(psbt_in.non_witness_utxo.serialize())
+                legacy_inputs.append(self.app.getTrustedInput(ledger_prevtxs[prev_txid], txin.prevout.n))
                 legacy_inputs[-1]["sequence"] = seq_hex
                 has_legacy = True
             else:
                 segwit_inputs.append({"value": txin.prevout.serialize() + struct.pack("<Q", psbt_in.witness_utxo.nValue), "witness": True, "sequence": seq_hex})
                 has_segwit = True
 
-            pubkeys = []
             signature_attempts = []
 
             scriptCode = b""
@@ -225,15 +230,9 @@ class LedgerClient(HardwareWalletClient):
             # Save scriptcode for later signing
             script_codes[i_num] = scriptCode
 
-            # Find which pubkeys could sign this input (should be all?)
-            for pubkey in psbt_in.hd_keypaths.keys():
+            # Find which of our wallet's keys could sign this input
+            for pubkey, keypath in our_inputs.get(i_num, []):
                 if hash160(pubkey) in scriptCode or pubkey in scriptCode:
-                    pubkeys.append(pubkey)
-
-            # Figure out which keys in inputs are from our wallet
-            for pubkey in pubkeys:
-                keypath = psbt_in.hd_keypaths[pubkey]
-                if master_fpr == struct.pack("<I", keypath[0]):
                     # Add the keypath strings
                     keypath_str = ''
                     for index in keypath[1:]:
@@ -272,9 +271,6 @@ class LedgerClient(HardwareWalletClient):
                     tx.inputs[i].partial_sigs[signature_attempt[1]] = self.app.untrustedHashSign(signature_attempt[0], "", c_tx.nLockTime, 0x01)
                     first_input = False
 
-        # Send PSBT back
-        return {'psbt': tx.serialize()}
-
     # Must return a base64 encoded string with the signed message
     # The message can be any string
     @ledger_exception
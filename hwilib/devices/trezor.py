@@ -10,7 +10,7 @@ from .trezorlib.ui import echo, PassphraseUI, mnemonic_words, PIN_CURRENT, PIN_N
 from .trezorlib import tools, syscoin, device
 from .trezorlib import messages as proto
 from ..base58 import get_xpub_fingerprint, to_address, xpub_main_2_test, get_xpub_fingerprint_hex
-from ..serializations import CTxOut, ser_uint256
+from ..serializations import CTxOut
 from .. import bech32
 from usb1 import USBErrorNoDevice
 from types import MethodType
@@ -114,9 +114,9 @@ class TrezorClient(HardwareWalletClient):
             raise DeviceNotReadyError('{} is locked. Unlock by using \'promptpin\' and then \'sendpin\'.'.format(self.type))
 
     # Must return a dict with the xpub
-    # Retrieves the public key at the specified BIP 32 derivation path
+    # Retrieves the public key at the specified BIP 32 derivation path from the device
     @trezor_exception
-    def get_pubkey_at_path(self, path):
+    def get_device_pubkey_at_path(self, path):
         self._check_unlocked()
         try:
             expanded_path = tools.parse_path(path)
@@ -128,16 +128,50 @@ class TrezorClient(HardwareWalletClient):
         else:
             return {'xpub': output.xpub}
 
-    # Must return a hex string with the signed transaction
+    # Sign the PSBT tx in place
     # The tx must be in the psbt format
     @trezor_exception
-    def sign_tx(self, tx):
+    def sign_psbt(self, tx):
         self._check_unlocked()
 
         # Get this devices master key fingerprint
         master_key = syscoin.get_public_node(self.client, [0])
         master_fp = get_xpub_fingerprint(master_key.xpub)
 
+        # Prepare prev txs. Inputs spending outputs of the same previous
+        # transaction share it, so each one only needs converting once.
+        prevtxs = {}
+        for psbt_in in tx.inputs:
+            if psbt_in.non_witness_utxo:
+                prev = psbt_in.non_witness_utxo
+                prev_hash = prev.txid[::-1]
+                if prev_hash in prevtxs:
+                    continue
+
+                t = proto.TransactionType()
+                t.version = prev.nVersion
+                t.lock_time = prev.nLockTime
+
+                for vin in prev.vin:
+                    i = proto.TxInputType()
+                    i.prev_hash = vin.prevout.hash_bytes[::-1]
+                    i.prev_index = vin.prevout.n
+                    i.script_sig = vin.scriptSig
+                    i.sequence = vin.nSequence
+                    t.inputs.append(i)
+
+                for vout in prev.vout:
+                    o = proto.TxOutputBinType()
+                    o.amount = vout.nValue
+                    o.script_pubkey = vout.scriptPubKey
+                    t.bin_outputs.append(o)
+                logging.debug(prev.hash)
+                prevtxs[prev_hash] = t
+
+        # Our keys in each input and output
+        our_inputs = tx.get_input_keypaths(master_fp)
+        our_outputs = tx.get_output_keypaths(master_fp)
+
         # Do multiple passes for multisig
         passes = 1
         p = 0
@@ -150,7 +184,7 @@ class TrezorClient(HardwareWalletClient):
                 txinputtype = proto.TxInputType()
 
                 # Set the input stuff
-                txinputtype.prev_hash = ser_uint256(txin.prevout.hash)[::-1]
+                txinputtype.prev_hash = txin.prevout.hash_bytes[::-1]
                 txinputtype.prev_index = txin.prevout.n
                 txinputtype.sequence = txin.nSequence
 
@@ -190,13 +224,13 @@ class TrezorClient(HardwareWalletClient):
                     # Add to txinputtype
                     txinputtype.multisig = multisig
                     if psbt_in.non_witness_utxo:
-                        if utxo.is_p2sh:
+                        if utxo.is_p2sh():
                             txinputtype.script_type = proto.InputScriptType.SPENDMULTISIG
                         else:
                             # Cannot sign bare multisig, ignore it
                             ignore_input()
                             continue
-                elif not is_ms and psbt_in.non_witness_utxo and not utxo.is_p2pkh:
+                elif not is_ms and psbt_in.non_witness_utxo and not utxo.is_p2pkh():
                     # Cannot sign unknown spk, ignore it
                     ignore_input()
                     continue
@@ -208,9 +242,8 @@ class TrezorClient(HardwareWalletClient):
                 # Find key to sign with
                 found = False
                 our_keys = 0
-                for key in psbt_in.hd_keypaths.keys():
-                    keypath = psbt_in.hd_keypaths[key]
-                    if keypath[0] == master_fp and key not in psbt_in.partial_sigs:
+                for key, keypath in our_inputs.get(input_num, []):
+                    if key not in psbt_in.partial_sigs:
                         if not found:
                             txinputtype.address_n = keypath[1:]
                             found = True
@@ -258,8 +291,8 @@ class TrezorClient(HardwareWalletClient):
                 # Add the derivation path for change, but only if there is exactly one derivation path
                 psbt_out = tx.outputs[i]
                 if len(psbt_out.hd_keypaths) == 1:
-                    _, keypath = next(iter(psbt_out.hd_keypaths.items()))
-                    if keypath[0] == master_fp:
+                    if i in our_outputs:
+                        _, keypath = our_outputs[i][0]
                         wit, ver, prog = out.is_witness()
                         if out.is_p2pkh():
                             txoutput.address_n = keypath[1:]
@@ -278,32 +311,6 @@ class TrezorClient(HardwareWalletClient):
                 # append to outputs
                 outputs.append(txoutput)
 
-            # Prepare prev txs
-            prevtxs = {}
-            for psbt_in in tx.inputs:
-                if psbt_in.non_witness_utxo:
-                    prev = psbt_in.non_witness_utxo
-
-                    t = proto.TransactionType()
-                    t.version = prev.nVersion
-                    t.lock_time = prev.nLockTime
-
-                    for vin in prev.vin:
-                        i = proto.TxInputType()
-                        i.prev_hash = ser_uint256(vin.prevout.hash)[::-1]
-                        i.prev_index = vin.prevout.n
-                        i.script_sig = vin.scriptSig
-                        i.sequence = vin.nSequence
-                        t.inputs.append(i)
-
-                    for vout in prev.vout:
-                        o = proto.TxOutputBinType()
-                        o.amount = vout.nValue
-                        o.script_pubkey = vout.scriptPubKey
-                        t.bin_outputs.append(o)
-                    logging.debug(psbt_in.non_witness_utxo.hash)
-                    prevtxs[ser_uint256(psbt_in.non_witness_utxo.sha256)[::-1]] = t
-
             # Sign the transaction
             tx_details = proto.SignTx()
             tx_details.version = tx.tx.nVersion
@@ -317,16 +324,13 @@ class TrezorClient(HardwareWalletClient):
             for input_num, (psbt_in, sig) in py_enumerate(list(zip(tx.inputs, signed_tx[0]))):
                 if input_num in to_ignore:
                     continue
-                for pubkey in psbt_in.hd_keypaths.keys():
-                    fp = psbt_in.hd_keypaths[pubkey][0]
-                    if fp == master_fp and pubkey not in psbt_in.partial_sigs:
+                for pubkey, _ in our_inputs.get(input_num, []):
+                    if pubkey not in psbt_in.partial_sigs:
                         psbt_in.partial_sigs[pubkey] = sig + b'\x01'
                         break
 
             p += 1
 
-        return {'psbt': tx.serialize()}
-
     # Must return a base64 encoded string with the signed message
     # The message can be any string
     @trezor_exception
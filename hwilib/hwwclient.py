@@ -1,3 +1,8 @@
+import logging
+
+from .bip32 import derive_xpub, split_hardened_path
+from .errors import BadArgumentError
+
 # This is an abstract class that defines all of the methods that each Hardware
 # wallet subclass must implement.
 class HardwareWalletClient(object):
@@ -15,18 +20,57 @@ class HardwareWalletClient(object):
     def get_master_xpub(self):
         return self.get_pubkey_at_path('m/44\'/0\'/0\'')
 
-    # Must return a dict with the xpub
-    # Retrieves the public key at the specified BIP 32 derivation path
+    # Returns a dict with the xpub at the specified BIP 32 derivation path.
+    # Only the part up to the last hardened step is asked from the device,
+    # once per network, and kept in xpub_cache. The non-hardened steps
+    # after it are derived locally.
     def get_pubkey_at_path(self, path):
+        try:
+            base, indexes = split_hardened_path(path)
+        except BadArgumentError:
+            # Let the device decide what to do with it
+            return self.get_device_pubkey_at_path(path)
+        # The device gives out testnet or mainnet xpubs depending on is_testnet
+        key = (base, self.is_testnet)
+        if key not in self.xpub_cache:
+            if base == 'm':
+                # Not every device gives out the master key
+                return self.get_device_pubkey_at_path(path)
+            self.xpub_cache[key] = self.get_device_pubkey_at_path(base)['xpub']
+        if not indexes:
+            return {'xpub': self.xpub_cache[key]}
+        return {'xpub': derive_xpub(self.xpub_cache[key], indexes)}
+
+    # Must return a dict with the xpub
+    # Retrieves the public key at the specified BIP 32 derivation path from the device
+    def get_device_pubkey_at_path(self, path):
         raise NotImplementedError('The HardwareWalletClient base class does not '
                                   'implement this method')
 
-    # Must return a hex string with the signed transaction
+    # Returns a dict with the signed PSBT, base64 encoded
     # The tx must be in the combined unsigned transaction format
     def sign_tx(self, tx):
+        self.sign_psbt(tx)
+        return {'psbt': tx.serialize()}
+
+    # Must sign the PSBT tx in place, adding the signatures it can make
+    def sign_psbt(self, tx):
         raise NotImplementedError('The HardwareWalletClient base class does not '
                                   'implement this method')
 
+    # Strip what the device with this master key fingerprint does not need
+    # to sign from the PSBT tx before sending it over. Returns the pruned
+    # PSBT and its serialization. Merge the signatures made on it back into
+    # tx with tx.merge_signatures().
+    def prune_psbt(self, tx, fingerprint):
+        pruned = tx.prune(fingerprint)
+        pruned_bytes = pruned.serialize_bytes()
+        # Measuring the saving takes a second full serialization
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            saved = len(tx.serialize_bytes()) - len(pruned_bytes)
+            logging.debug('Pruned PSBT from {} to {} bytes, {} bytes saved'.format(len(pruned_bytes) + saved, len(pruned_bytes), saved))
+        return pruned, pruned_bytes
+
     # Must return a base64 encoded string with the signed message
     # The message can be any string. keypath is the bip 32 derivation path for the key to sign with
     def sign_message(self, message, keypath):
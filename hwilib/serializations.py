@@ -15,14 +15,16 @@ CTransaction,CTxIn, CTxOut, etc....:
 ser_*, deser_*: functions that handle serialization/deserialization
 """
 
+from enum import IntEnum
 from io import BytesIO, BufferedReader
-from codecs import encode
 from .errors import PSBTSerializationError
 import struct
 import binascii
 import hashlib
 import copy
 import base64
+import mmap
+import os
 
 def sha256(s):
     return hashlib.new('sha256', s).digest()
@@ -64,9 +66,135 @@ def deser_string(f):
     nit = deser_compact_size(f)
     return f.read(nit)
 
+# For values that are parsed and then dropped: a ByteReader hands out a
+# view of its buffer instead of copying the value
+def deser_string_view(f):
+    nit = deser_compact_size(f)
+    if isinstance(f, ByteReader):
+        return f.read_view(nit)
+    return f.read(nit)
+
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+def stream_ser_string(f, s):
+    f.write(ser_compact_size(len(s)))
+    f.write(s)
+
+def _as_bytes(data):
+    return data if type(data) is bytes else data.tobytes()
+
+class ByteReader(object):
+    """A read cursor over an in-memory buffer
+
+    All reads are served by slicing one shared buffer, so nested values can
+    be handed out as sub-readers over a window of it without copying them.
+    """
+
+    def __init__(self, data, pos=0, end=None):
+        if not isinstance(data, (bytes, mmap.mmap)):
+            # Other buffers, like a bytearray, are viewed rather than copied
+            data = memoryview(data).cast('B')
+        self.data = data
+        self.pos = pos
+        self.end = len(data) if end is None else end
+
+    # Reads return bytes, copying only what was read
+    def read(self, n):
+        start = self.pos
+        self.pos = min(start + n, self.end)
+        return _as_bytes(self.data[start:self.pos])
+
+    # A view of the next n bytes, for callers that do not keep it
+    def read_view(self, n):
+        start = self.pos
+        self.pos = min(start + n, self.end)
+        return memoryview(self.data)[start:self.pos]
+
+    def tell(self):
+        return self.pos
+
+    def skip(self, n):
+        self.pos = min(self.pos + n, self.end)
+
+    # A view of the unread part of the buffer
+    def remaining(self):
+        return memoryview(self.data)[self.pos:self.end]
+
+    def sub_reader(self, n):
+        start = self.pos
+        self.pos = min(start + n, self.end)
+        return ByteReader(self.data, start, self.pos)
+
+    # A reader of the same kind over data[start:end]
+    def window(self, start, end):
+        return ByteReader(self.data, start, end)
+
+class PSBTLimits(object):
+    """Resource limits for strict PSBT parsing
+
+    max_size: largest serialized PSBT in bytes
+    max_maps: most input and output maps together
+    max_value_length: longest single length prefixed key or value
+    max_keypath_depth: most derivation steps in a keypath
+    """
+
+    def __init__(self, max_size=100000000, max_maps=100000, max_value_length=4000000, max_keypath_depth=255):
+        self.max_size = max_size
+        self.max_maps = max_maps
+        self.max_value_length = max_value_length
+        self.max_keypath_depth = max_keypath_depth
+
+class LimitedByteReader(ByteReader):
+    """A ByteReader for strict parsing
+
+    Reads past the end of the buffer, and of values longer than the limits
+    allow, raise PSBTSerializationError before anything is sliced instead
+    of coming back short.
+    """
+
+    def __init__(self, data, pos=0, end=None, limits=None):
+        super().__init__(data, pos, end)
+        self.limits = limits if limits is not None else PSBTLimits()
+
+    def _check(self, n):
+        if n > self.limits.max_value_length:
+            raise PSBTSerializationError("Value of {} bytes is longer than the limit of {} bytes".format(n, self.limits.max_value_length))
+        if self.pos + n > self.end:
+            raise PSBTSerializationError("Unexpected end of data, {} bytes needed but only {} left".format(n, self.end - self.pos))
+
+    def read(self, n):
+        self._check(n)
+        start = self.pos
+        self.pos += n
+        return _as_bytes(self.data[start:self.pos])
+
+    def read_view(self, n):
+        self._check(n)
+        start = self.pos
+        self.pos += n
+        return memoryview(self.data)[start:self.pos]
+
+    def skip(self, n):
+        self._check(n)
+        self.pos += n
+
+    def sub_reader(self, n):
+        self._check(n)
+        start = self.pos
+        self.pos += n
+        return LimitedByteReader(self.data, start, self.pos, self.limits)
+
+    def window(self, start, end):
+        return LimitedByteReader(self.data, start, end, self.limits)
+
+def deser_string_reader(f):
+    """Deserialize a length prefixed value and return a reader over it"""
+    nit = deser_compact_size(f)
+    if isinstance(f, ByteReader):
+        return f.sub_reader(nit)
+    return BufferedReader(BytesIO(f.read(nit)))
+
 def deser_uint256(f):
     r = 0
     for i in range(8):
@@ -76,19 +204,11 @@ def deser_uint256(f):
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & ((1 << 256) - 1)).to_bytes(32, "little")
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], "little")
 
 
 def deser_vector(f, c):
@@ -105,13 +225,18 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
+    f = BytesIO()
+    stream_ser_vector(f, l, ser_function_name)
+    return f.getvalue()
+
+
+def stream_ser_vector(f, vec, ser_function_name=None):
+    f.write(ser_compact_size(len(vec)))
+    for i in vec:
         if ser_function_name:
-            r += getattr(i, ser_function_name)()
+            f.write(getattr(i, ser_function_name)())
         else:
-            r += i.serialize()
-    return r
+            i.stream_serialize(f)
 
 
 def deser_string_vector(f):
@@ -124,10 +249,15 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
-    for sv in l:
-        r += ser_string(sv)
-    return r
+    f = BytesIO()
+    stream_ser_string_vector(f, l)
+    return f.getvalue()
+
+
+def stream_ser_string_vector(f, vec):
+    f.write(ser_compact_size(len(vec)))
+    for sv in vec:
+        stream_ser_string(f, sv)
 
 def Base64ToHex(s):
     return binascii.hexlify(base64.b64decode(s))
@@ -194,25 +324,53 @@ def ser_sig_compact(r, s, recid):
 MSG_WITNESS_FLAG = 1 << 30
 
 class COutPoint(object):
+    __slots__ = ("_hash", "_hash_bytes", "n")
+
     def __init__(self, hash=0, n=0xffffffff):
         self.hash = hash
         self.n = n
 
+    # The prevout hash as an integer, converted from hash_bytes on first use
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = uint256_from_str(self._hash_bytes)
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        self._hash = value
+        self._hash_bytes = None
+
+    # The prevout hash as the 32 bytes that appear in a serialized outpoint
+    @property
+    def hash_bytes(self):
+        if self._hash_bytes is None:
+            self._hash_bytes = ser_uint256(self._hash)
+        return self._hash_bytes
+
+    @hash_bytes.setter
+    def hash_bytes(self, value):
+        self._hash = None
+        self._hash_bytes = value
+
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
+        self.hash_bytes = f.read(32)
         self.n = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        return self.hash_bytes + struct.pack("<I", self.n)
+
+    def stream_serialize(self, f):
+        f.write(self.serialize())
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
 class CTxIn(object):
+    __slots__ = ("prevout", "scriptSig", "nSequence")
+
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
             self.prevout = COutPoint()
@@ -228,11 +386,14 @@ class CTxIn(object):
         self.nSequence = struct.unpack("<I", f.read(4))[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
+
+    def stream_serialize(self, f):
+        self.prevout.stream_serialize(f)
+        stream_ser_string(f, self.scriptSig)
+        f.write(struct.pack("<I", self.nSequence))
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -240,41 +401,94 @@ class CTxIn(object):
                self.nSequence)
 
 
+# Output script templates, as found by CTxOut.classify()
+class ScriptType(IntEnum):
+    NONSTANDARD = 0
+    P2PK = 1
+    P2PKH = 2
+    P2SH = 3
+    MULTISIG = 4
+    WITNESS_V0_KEYHASH = 5
+    WITNESS_V0_SCRIPTHASH = 6
+    WITNESS_UNKNOWN = 7
+
+# Return (script type, pubkey/hash/witness program, witness version) for
+# an output script. The witness version is None for non-witness scripts.
+def classify_script(script):
+    length = len(script)
+    if length == 25 and script[0] == 0x76 and script[1] == 0xa9 and script[2] == 0x14 and script[23] == 0x88 and script[24] == 0xac:
+        return (ScriptType.P2PKH, script[3:23], None)
+    if length == 23 and script[0] == 0xa9 and script[1] == 0x14 and script[22] == 0x87:
+        return (ScriptType.P2SH, script[2:22], None)
+    if 4 <= length <= 42 and (script[0] == 0 or 81 <= script[0] <= 96) and script[1] + 2 == length:
+        version = script[0] - 0x50 if script[0] else 0
+        program = script[2:]
+        if version == 0 and len(program) == 20:
+            return (ScriptType.WITNESS_V0_KEYHASH, program, version)
+        if version == 0 and len(program) == 32:
+            return (ScriptType.WITNESS_V0_SCRIPTHASH, program, version)
+        return (ScriptType.WITNESS_UNKNOWN, program, version)
+    if (length == 35 or length == 67) and (script[0] == 0x21 or script[0] == 0x41) and script[-1] == 0xac:
+        return (ScriptType.P2PK, script[1:-1], None)
+    if parse_multisig(script) is not None:
+        return (ScriptType.MULTISIG, b"", None)
+    return (ScriptType.NONSTANDARD, b"", None)
+
 class CTxOut(object):
+    __slots__ = ("nValue", "_scriptPubKey", "_classification")
+
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
+    # The script template is worked out once, on first use, and kept
+    # until scriptPubKey is assigned again
+    @property
+    def scriptPubKey(self):
+        return self._scriptPubKey
+
+    @scriptPubKey.setter
+    def scriptPubKey(self, value):
+        self._scriptPubKey = value
+        self._classification = None
+
+    # (script type, pubkey/hash/witness program, witness version)
+    def classify(self):
+        if self._classification is None:
+            self._classification = classify_script(self._scriptPubKey)
+        return self._classification
+
+    @property
+    def script_type(self):
+        return self.classify()[0]
+
     def deserialize(self, f):
         self.nValue = struct.unpack("<q", f.read(8))[0]
         self.scriptPubKey = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
+
+    def stream_serialize(self, f):
+        f.write(struct.pack("<q", self.nValue))
+        stream_ser_string(f, self._scriptPubKey)
 
     def is_p2sh(self):
-        return len(self.scriptPubKey) == 23 and self.scriptPubKey[0] == 0xa9 and self.scriptPubKey[1] == 0x14 and self.scriptPubKey[22] == 0x87
+        return self.classify()[0] == ScriptType.P2SH
 
     def is_p2pkh(self):
-        return len(self.scriptPubKey) == 25 and self.scriptPubKey[0] == 0x76 and self.scriptPubKey[1] == 0xa9 and self.scriptPubKey[2] == 0x14 and self.scriptPubKey[23] == 0x88 and self.scriptPubKey[24] == 0xac
+        return self.classify()[0] == ScriptType.P2PKH
 
     def is_p2pk(self):
-        return (len(self.scriptPubKey) == 35 or len(self.scriptPubKey) == 67) and (self.scriptPubKey[0] == 0x21 or self.scriptPubKey[0] == 0x41) and self.scriptPubKey[-1] == 0xac
+        return self.classify()[0] == ScriptType.P2PK
 
     def is_witness(self):
-        if len(self.scriptPubKey) < 4 or len(self.scriptPubKey) > 42:
-            return (False, None, None)
-
-        if self.scriptPubKey[0] != 0 and (self.scriptPubKey[0] < 81 or self.scriptPubKey[0] > 96):
+        _, program, version = self.classify()
+        if version is None:
             return (False, None, None)
-
-        if self.scriptPubKey[1] + 2 == len(self.scriptPubKey):
-            return (True, self.scriptPubKey[0] - 0x50 if self.scriptPubKey[0] else 0, self.scriptPubKey[2:])
-
-        return (False, None, None)
+        return (True, version, program)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -282,6 +496,8 @@ class CTxOut(object):
 
 
 class CScriptWitness(object):
+    __slots__ = ("stack",)
+
     def __init__(self):
         # stack is a vector of strings
         self.stack = []
@@ -297,6 +513,8 @@ class CScriptWitness(object):
 
 
 class CTxInWitness(object):
+    __slots__ = ("scriptWitness",)
+
     def __init__(self):
         self.scriptWitness = CScriptWitness()
 
@@ -306,6 +524,9 @@ class CTxInWitness(object):
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
 
+    def stream_serialize(self, f):
+        stream_ser_string_vector(f, self.scriptWitness.stack)
+
     def __repr__(self):
         return repr(self.scriptWitness)
 
@@ -314,6 +535,8 @@ class CTxInWitness(object):
 
 
 class CTxWitness(object):
+    __slots__ = ("vtxinwit",)
+
     def __init__(self):
         self.vtxinwit = []
 
@@ -322,13 +545,16 @@ class CTxWitness(object):
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
+
+    def stream_serialize(self, f):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+            x.stream_serialize(f)
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -341,26 +567,119 @@ class CTxWitness(object):
         return True
 
 
+# A CTransaction attribute that drops the cached txid and wtxid when it
+# is assigned a different value.
+#
+# The inputs, outputs and witnesses of a transaction whose txid has been
+# read must not be changed in place, except through mutable_vin(),
+# mutable_vout() and mutable_witness(). Adding or removing them is noticed,
+# but after any other change in place call rehash().
+def _tx_field(name):
+    attr = "_" + name
+
+    def getter(self):
+        return getattr(self, attr)
+
+    def setter(self, value):
+        old = getattr(self, attr, None)
+        if old is not value and old != value:
+            self._txid = None
+            self._wtxid = None
+        setattr(self, attr, value)
+
+    return property(getter, setter)
+
 class CTransaction(object):
+    nVersion = _tx_field("nVersion")
+    vin = _tx_field("vin")
+    vout = _tx_field("vout")
+    wit = _tx_field("wit")
+    nLockTime = _tx_field("nLockTime")
+
     def __init__(self, tx=None):
+        self._txid = None
+        self._wtxid = None
+        # The number of inputs, outputs and witnesses the cached hashes were computed with
+        self._hashed_counts = None
+        self._shared_vin = None
+        self._shared_vout = None
+        self._shared_wit = None
         if tx is None:
             self.nVersion = 1
             self.vin = []
             self.vout = []
             self.wit = CTxWitness()
             self.nLockTime = 0
-            self.sha256 = None
-            self.hash = None
         else:
             self.nVersion = tx.nVersion
             self.vin = copy.deepcopy(tx.vin)
             self.vout = copy.deepcopy(tx.vout)
             self.nLockTime = tx.nLockTime
-            self.sha256 = tx.sha256
-            self.hash = tx.hash
             self.wit = copy.deepcopy(tx.wit)
-
-    def deserialize(self, f):
+            self._txid = tx._txid
+            self._wtxid = tx._wtxid
+            self._hashed_counts = tx._hashed_counts
+
+    # Return a copy of this transaction that shares its inputs, outputs and
+    # witnesses with this one instead of deep copying them. Use mutable_vin(),
+    # mutable_vout() and mutable_witness() to get an input, output or
+    # witness of the copy that can be modified without affecting the
+    # original.
+    def copy_on_write(self):
+        tx = CTransaction()
+        tx.nVersion = self.nVersion
+        tx.vin = list(self.vin)
+        tx.vout = list(self.vout)
+        tx.wit.vtxinwit = list(self.wit.vtxinwit)
+        tx.nLockTime = self.nLockTime
+        tx._txid = self._txid
+        tx._wtxid = self._wtxid
+        tx._hashed_counts = self._hashed_counts
+        tx._shared_vin = set(range(len(tx.vin)))
+        tx._shared_vout = set(range(len(tx.vout)))
+        tx._shared_wit = set(range(len(tx.wit.vtxinwit)))
+        return tx
+
+    # Get input i for modification, copying it first if it is still shared
+    # with the transaction this one was copied from
+    def mutable_vin(self, i):
+        if self._shared_vin and i in self._shared_vin:
+            self.vin[i] = copy.deepcopy(self.vin[i])
+            self._shared_vin.discard(i)
+        self._txid = None
+        self._wtxid = None
+        return self.vin[i]
+
+    # Get output i for modification, like mutable_vin()
+    def mutable_vout(self, i):
+        if self._shared_vout and i in self._shared_vout:
+            self.vout[i] = copy.deepcopy(self.vout[i])
+            self._shared_vout.discard(i)
+        self._txid = None
+        self._wtxid = None
+        return self.vout[i]
+
+    # Get the witness of input i for modification, like mutable_vin()
+    def mutable_witness(self, i):
+        if self._shared_wit and i in self._shared_wit:
+            self.wit.vtxinwit[i] = copy.deepcopy(self.wit.vtxinwit[i])
+            self._shared_wit.discard(i)
+        self._wtxid = None
+        return self.wit.vtxinwit[i]
+
+    # Drop the cached hashes if inputs, outputs or witnesses were added or
+    # removed in place since they were computed
+    def _check_hashes(self):
+        counts = (len(self.vin), len(self.vout), len(self.wit.vtxinwit))
+        if counts != self._hashed_counts:
+            self._txid = None
+            self._wtxid = None
+            self._hashed_counts = counts
+
+    # wire_hash is hash256 of everything left in f, if the caller already
+    # has it, and is used for the txids when the transaction fills f
+    def deserialize(self, f, wire_hash=None):
+        start = f.tell()
         self.nVersion = struct.unpack("<i", f.read(4))[0]
         self.vin = deser_vector(f, CTxIn)
         flags = 0
@@ -369,76 +688,230 @@ class CTransaction(object):
             # Not sure why flags can't be zero, but this
             # matches the implementation in syscoind
             if (flags != 0):
+                body_start = f.tell()
                 self.vin = deser_vector(f, CTxIn)
                 self.vout = deser_vector(f, CTxOut)
         else:
             self.vout = deser_vector(f, CTxOut)
+        body_end = f.tell()
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
             self.wit.deserialize(f)
         self.nLockTime = struct.unpack("<I", f.read(4))[0]
-        self.sha256 = None
-        self.hash = None
+        self._txid = None
+        self._wtxid = None
+
+        # Hash the wire bytes we just read instead of serializing again later
+        if isinstance(f, ByteReader):
+            buf = memoryview(f.data)
+            end = f.tell()
+            if wire_hash is not None and end == f.end:
+                self._wtxid = wire_hash
+            else:
+                self._wtxid = hash256(buf[start:end])
+            if flags != 0:
+                h = hashlib.sha256()
+                h.update(buf[start:start + 4])
+                h.update(buf[body_start:body_end])
+                h.update(buf[end - 4:end])
+                self._txid = sha256(h.digest())
+            else:
+                self._txid = self._wtxid
+            self._hashed_counts = (len(self.vin), len(self.vout), len(self.wit.vtxinwit))
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        f = BytesIO()
+        self.stream_serialize(f, with_witness=False)
+        return f.getvalue()
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        f = BytesIO()
+        self.stream_serialize(f, with_witness=True)
+        return f.getvalue()
+
+    # Regular serialization is without witness -- must explicitly
+    # call serialize_with_witness to include witness data.
+    def serialize(self):
+        return self.serialize_without_witness()
+
+    def stream_serialize(self, f, with_witness=False):
         flags = 0
-        if not self.wit.is_null():
+        if with_witness and not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        f.write(struct.pack("<i", self.nVersion))
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            stream_ser_vector(f, dummy)
+            f.write(struct.pack("<B", flags))
+        stream_ser_vector(f, self.vin)
+        stream_ser_vector(f, self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
-
-    # Regular serialization is without witness -- must explicitly
-    # call serialize_with_witness to include witness data.
-    def serialize(self):
-        return self.serialize_without_witness()
-
-    # Recalculate the txid (transaction hash without witness)
+            self.wit.stream_serialize(f)
+        f.write(struct.pack("<I", self.nLockTime))
+
+    # The txid in internal byte order. It is computed at most once and kept
+    # until one of the transaction's fields is assigned a new value, see
+    # _tx_field.
+    @property
+    def txid(self):
+        self._check_hashes()
+        if self._txid is None:
+            self._txid = hash256(self.serialize_without_witness())
+        return self._txid
+
+    # The wtxid in internal byte order, cached like the txid
+    @property
+    def wtxid(self):
+        self._check_hashes()
+        if self._wtxid is None:
+            self._wtxid = hash256(self.serialize_with_witness())
+        return self._wtxid
+
+    @property
+    def sha256(self):
+        self._check_hashes()
+        if self._txid is None:
+            return None
+        return uint256_from_str(self._txid)
+
+    @sha256.setter
+    def sha256(self, value):
+        self._check_hashes()
+        self._txid = None if value is None else ser_uint256(value)
+
+    @property
+    def hash(self):
+        self._check_hashes()
+        if self._txid is None:
+            return None
+        return self._txid[::-1].hex()
+
+    # Recalculate the txid (transaction hash without witness). Only needed
+    # after modifying the inputs, outputs or witnesses in place.
     def rehash(self):
-        self.sha256 = None
+        self._txid = None
+        self._wtxid = None
         self.calc_sha256()
 
     # We will only cache the serialization without witness in
     # self.sha256 and self.hash -- those are expected to be the txid.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
-
-        if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+            return uint256_from_str(self.wtxid)
+        self.txid
 
     def is_null(self):
         return len(self.vin) == 0 and len(self.vout) == 0
 
+    # Classify all output scripts at once, see CTxOut.classify()
+    def classify_outputs(self):
+        return [txout.classify() for txout in self.vout]
+
     def __repr__(self):
         return "CTransaction(nVersion=%i vin=%s vout=%s wit=%s nLockTime=%i)" \
             % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
 
+SIGHASH_ALL = 1
+SIGHASH_NONE = 2
+SIGHASH_SINGLE = 3
+SIGHASH_ANYONECANPAY = 0x80
+
+class PrecomputedTransactionData(object):
+    """Signature hash computation for the inputs of one transaction
+
+    The parts of the BIP 143 preimage that are shared by every input
+    (hashPrevouts, hashSequence and hashOutputs) are computed once here,
+    so producing the digest of each input needs only a constant amount of
+    additional work.
+
+    For pre-segwit inputs, the transaction is serialized once with all
+    scriptSigs empty and each input's scriptCode is spliced into that
+    layout while hashing.
+    """
+
+    def __init__(self, tx):
+        self.tx = tx
+        self._legacy_layout = None
+        self.hashPrevouts = hash256(b"".join([txin.prevout.serialize() for txin in tx.vin]))
+        self.hashSequence = hash256(b"".join([struct.pack("<I", txin.nSequence) for txin in tx.vin]))
+        self.hashOutputs = hash256(b"".join([txout.serialize() for txout in tx.vout]))
+
+    # BIP 143 signature hash of input nIn spending amount with scriptCode
+    def segwit_v0_sighash(self, nIn, scriptCode, amount, hashtype=SIGHASH_ALL):
+        txin = self.tx.vin[nIn]
+        base_type = hashtype & 0x1f
+        anyonecanpay = hashtype & SIGHASH_ANYONECANPAY
+
+        hashPrevouts = b"\x00" * 32
+        hashSequence = b"\x00" * 32
+        hashOutputs = b"\x00" * 32
+        if not anyonecanpay:
+            hashPrevouts = self.hashPrevouts
+            if base_type != SIGHASH_SINGLE and base_type != SIGHASH_NONE:
+                hashSequence = self.hashSequence
+        if base_type != SIGHASH_SINGLE and base_type != SIGHASH_NONE:
+            hashOutputs = self.hashOutputs
+        elif base_type == SIGHASH_SINGLE and nIn < len(self.tx.vout):
+            hashOutputs = hash256(self.tx.vout[nIn].serialize())
+
+        preimage = b"".join([
+            struct.pack("<i", self.tx.nVersion),
+            hashPrevouts,
+            hashSequence,
+            txin.prevout.serialize(),
+            ser_string(scriptCode),
+            struct.pack("<q", amount),
+            struct.pack("<I", txin.nSequence),
+            hashOutputs,
+            struct.pack("<I", self.tx.nLockTime),
+            struct.pack("<I", hashtype),
+        ])
+        return hash256(preimage)
+
+    def _get_legacy_layout(self):
+        if self._legacy_layout is None:
+            header = struct.pack("<i", self.tx.nVersion) + ser_compact_size(len(self.tx.vin))
+            # Every input with an empty scriptSig, back to back
+            blank_inputs = BytesIO()
+            offsets = [0]
+            for txin in self.tx.vin:
+                txin.prevout.stream_serialize(blank_inputs)
+                blank_inputs.write(b"\x00")
+                blank_inputs.write(struct.pack("<I", txin.nSequence))
+                offsets.append(blank_inputs.tell())
+            tail = ser_vector(self.tx.vout) + struct.pack("<I", self.tx.nLockTime)
+            self._legacy_layout = (header, memoryview(blank_inputs.getvalue()), offsets, tail)
+        return self._legacy_layout
+
+    # Pre-segwit signature hash of input nIn signed with scriptCode.
+    # Only SIGHASH_ALL is supported.
+    def legacy_sighash(self, nIn, scriptCode, hashtype=SIGHASH_ALL):
+        if hashtype != SIGHASH_ALL:
+            raise ValueError("Only SIGHASH_ALL is supported for legacy inputs")
+        header, blank_inputs, offsets, tail = self._get_legacy_layout()
+        txin = self.tx.vin[nIn]
+
+        h = hashlib.sha256()
+        h.update(header)
+        h.update(blank_inputs[:offsets[nIn]])
+        h.update(txin.prevout.serialize())
+        h.update(ser_string(scriptCode))
+        h.update(struct.pack("<I", txin.nSequence))
+        h.update(blank_inputs[offsets[nIn + 1]:])
+        h.update(tail)
+        h.update(struct.pack("<I", hashtype))
+        return sha256(h.digest())
+
+# The BIP 143 scriptCode for a P2WPKH witness program
+def p2wpkh_script_code(witness_program):
+    return b"\x76\xa9\x14" + witness_program[2:] + b"\x88\xac"
+
 def DeserializeHDKeypath(f, key, hd_keypaths):
     if len(key) != 34 and len(key) != 66:
         raise PSBTSerializationError("Size of key was not the expected size for the type partial signature pubkey")
@@ -446,18 +919,72 @@ def DeserializeHDKeypath(f, key, hd_keypaths):
     if pubkey in hd_keypaths:
         raise PSBTSerializationError("Duplicate key, input partial signature for pubkey already provided")
 
-    value = deser_string(f)
+    limits = getattr(f, 'limits', None)
+    if limits is not None:
+        # Only a strict reader checks the value before it is read
+        length = deser_compact_size(f)
+        if length == 0 or length % 4 != 0:
+            raise PSBTSerializationError("Keypath value is not a fingerprint followed by 4 byte indexes")
+        if length // 4 - 1 > limits.max_keypath_depth:
+            raise PSBTSerializationError("Keypath of depth {} is deeper than the limit of {}".format(length // 4 - 1, limits.max_keypath_depth))
+        value = f.read_view(length)
+    else:
+        value = deser_string_view(f)
     hd_keypaths[pubkey] = struct.unpack("<" + "I" * (len(value) // 4), value)
 
 def SerializeHDKeypath(hd_keypaths, type):
-    r = b""
+    f = BytesIO()
+    StreamSerializeHDKeypath(f, hd_keypaths, type)
+    return f.getvalue()
+
+def StreamSerializeHDKeypath(f, hd_keypaths, type):
     for pubkey, path in sorted(hd_keypaths.items()):
-        r += ser_string(type + pubkey)
+        stream_ser_string(f, type + pubkey)
         packed = struct.pack("<" + "I" * len(path), *path)
-        r += ser_string(packed)
-    return r
+        stream_ser_string(f, packed)
+
+# Script push of data using the smallest push opcode
+def push_data(data):
+    if len(data) < 0x4c:
+        return struct.pack("B", len(data)) + data
+    elif len(data) <= 0xff:
+        return b"\x4c" + struct.pack("B", len(data)) + data
+    elif len(data) <= 0xffff:
+        return b"\x4d" + struct.pack("<H", len(data)) + data
+    return b"\x4e" + struct.pack("<I", len(data)) + data
+
+# Return (m, pubkeys) if script is an m-of-n OP_CHECKMULTISIG script,
+# with the pubkeys in script order, else None
+def parse_multisig(script):
+    if len(script) < 3 or script[-1] != 0xae:
+        return None
+    m = script[0] - 0x50
+    n = script[-2] - 0x50
+    if m < 1 or m > 16 or n < m or n > 16:
+        return None
+
+    pubkeys = []
+    offset = 1
+    while offset < len(script) - 2:
+        size = script[offset]
+        if size != 33 and size != 65:
+            return None
+        pubkeys.append(script[offset + 1:offset + 1 + size])
+        offset += 1 + size
+    if offset != len(script) - 2 or len(pubkeys) != n:
+        return None
+    return (m, pubkeys)
+
+# Insert the entries of src whose keys are not in dst yet
+def merge_map(dst, src):
+    for key, value in src.items():
+        if key not in dst:
+            dst[key] = value
 
 class PartiallySignedInput:
+    __slots__ = ("non_witness_utxo", "witness_utxo", "partial_sigs", "sighash", "redeem_script", "witness_script",
+                 "hd_keypaths", "final_script_sig", "final_script_witness", "unknown")
+
     def __init__(self):
         self.non_witness_utxo = None
         self.witness_utxo = None
@@ -482,12 +1009,17 @@ class PartiallySignedInput:
         self.final_script_witness = CTxInWitness()
         self.unknown.clear()
 
-    def deserialize(self, f):
+    # utxo_cache maps the hash of a serialized non_witness_utxo to its
+    # CTransaction. When given, identical previous transactions are parsed
+    # once and shared between the inputs that spend them, so they must be
+    # treated as read only.
+    def deserialize(self, f, utxo_cache=None):
         while True:
             # read the key
             try:
                 key = deser_string(f)
-            except Exception:
+            except struct.error:
+                # Out of data. Strict parsing raises before getting here.
                 break
 
             # Check for separator
@@ -502,10 +1034,17 @@ class PartiallySignedInput:
                     raise PSBTSerializationError("Duplicate Key, input non witness utxo already provided")
                 elif len(key) != 1:
                     raise PSBTSerializationError("non witness utxo key is more than one byte type")
-                self.non_witness_utxo = CTransaction()
-                value = BufferedReader(BytesIO(deser_string(f)))
-                self.non_witness_utxo.deserialize(value)
-                self.non_witness_utxo.rehash()
+                value = deser_string_reader(f)
+                if utxo_cache is not None and isinstance(value, ByteReader):
+                    utxo_hash = hash256(value.remaining())
+                    if utxo_hash not in utxo_cache:
+                        utxo = CTransaction()
+                        utxo.deserialize(value, utxo_hash)
+                        utxo_cache[utxo_hash] = utxo
+                    self.non_witness_utxo = utxo_cache[utxo_hash]
+                else:
+                    self.non_witness_utxo = CTransaction()
+                    self.non_witness_utxo.deserialize(value)
 
             elif key_type == 1:
                 if self.witness_utxo:
@@ -513,7 +1052,7 @@ class PartiallySignedInput:
                 elif len(key) != 1:
                     raise PSBTSerializationError("witness utxo key is more than one byte type")
                 self.witness_utxo = CTxOut()
-                value = BufferedReader(BytesIO(deser_string(f)))
+                value = deser_string_reader(f)
                 self.witness_utxo.deserialize(value)
 
             elif key_type == 2:
@@ -531,7 +1070,7 @@ class PartiallySignedInput:
                     raise PSBTSerializationError("Duplicate key, input sighash type already provided")
                 elif len(key) != 1:
                     raise PSBTSerializationError("sighash key is more than one byte type")
-                value = deser_string(f)
+                value = deser_string_view(f)
                 self.sighash = struct.unpack("<I", value)[0]
 
             elif key_type == 4:
@@ -563,7 +1102,7 @@ class PartiallySignedInput:
                     raise PSBTSerializationError("Duplicate key, input final scriptWitness already provided")
                 elif len(key) != 1:
                     raise PSBTSerializationError("final scriptWitness key is more than one byte type")
-                value = BufferedReader(BytesIO(deser_string(f)))
+                value = deser_string_reader(f)
                 self.final_script_witness.deserialize(value)
 
             else:
@@ -573,52 +1112,55 @@ class PartiallySignedInput:
                 self.unknown[key] = value
 
     def serialize(self):
-        r = b""
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
 
+    def stream_serialize(self, f):
         if self.non_witness_utxo:
-            r += ser_string(b"\x00")
+            stream_ser_string(f, b"\x00")
             tx = self.non_witness_utxo.serialize_with_witness()
-            r += ser_string(tx)
+            stream_ser_string(f, tx)
 
         elif self.witness_utxo:
-            r += ser_string(b"\x01")
+            stream_ser_string(f, b"\x01")
             tx = self.witness_utxo.serialize()
-            r += ser_string(tx)
+            stream_ser_string(f, tx)
 
         if len(self.final_script_sig) == 0 and self.final_script_witness.is_null():
-            for pubkey, sig in sorted(self.partial_sigs.items()):
-                r += ser_string(b"\x02" + pubkey)
-                r += ser_string(sig)
+            # Syscoin Core keys partial signatures by the hash160 of the
+            # pubkey, so they are written out in that order
+            for pubkey, sig in sorted(self.partial_sigs.items(), key=lambda item: hash160(item[0])):
+                stream_ser_string(f, b"\x02" + pubkey)
+                stream_ser_string(f, sig)
 
             if self.sighash > 0:
-                r += ser_string(b"\x03")
-                r += ser_string(struct.pack("<I", self.sighash))
+                stream_ser_string(f, b"\x03")
+                stream_ser_string(f, struct.pack("<I", self.sighash))
 
             if len(self.redeem_script) != 0:
-                r += ser_string(b"\x04")
-                r += ser_string(self.redeem_script)
+                stream_ser_string(f, b"\x04")
+                stream_ser_string(f, self.redeem_script)
 
             if len(self.witness_script) != 0:
-                r += ser_string(b"\x05")
-                r += ser_string(self.witness_script)
+                stream_ser_string(f, b"\x05")
+                stream_ser_string(f, self.witness_script)
 
-            r += SerializeHDKeypath(self.hd_keypaths, b"\x06")
+            StreamSerializeHDKeypath(f, self.hd_keypaths, b"\x06")
 
         if len(self.final_script_sig) != 0:
-            r += ser_string(b"\x07")
-            r += ser_string(self.final_script_sig)
+            stream_ser_string(f, b"\x07")
+            stream_ser_string(f, self.final_script_sig)
 
         if not self.final_script_witness.is_null():
-            r += ser_string(b"\x08")
-            r += self.final_script_witness.serialize()
+            stream_ser_string(f, b"\x08")
+            stream_ser_string(f, self.final_script_witness.serialize())
 
         for key, value in sorted(self.unknown.items()):
-            r += ser_string(key)
-            r += ser_string(value)
+            stream_ser_string(f, key)
+            stream_ser_string(f, value)
 
-        r += b"\x00"
-
-        return r
+        f.write(b"\x00")
 
     def is_sane(self):
         # Cannot have both witness and non-witness utxos
@@ -633,7 +1175,107 @@ class PartiallySignedInput:
 
         return True
 
+    # The stack that satisfies script with our partial signatures, or None
+    # if we do not have enough of them. Handles p2pkh, p2pk and multisig.
+    def _solve(self, script):
+        if len(script) == 25 and script[:3] == b"\x76\xa9\x14" and script[23:] == b"\x88\xac":
+            for pubkey, sig in self.partial_sigs.items():
+                if hash160(pubkey) == script[3:23]:
+                    return [sig, pubkey]
+            return None
+        if CTxOut(0, script).is_p2pk():
+            sig = self.partial_sigs.get(script[1:-1])
+            return None if sig is None else [sig]
+
+        multisig = parse_multisig(script)
+        if multisig is None:
+            return None
+        m, pubkeys = multisig
+        # Signatures go in the order of the pubkeys in the script, whether
+        # or not those were sorted
+        sigs = [self.partial_sigs[pubkey] for pubkey in pubkeys if pubkey in self.partial_sigs][:m]
+        if len(sigs) < m:
+            return None
+        # Extra stack item for the off by one OP_CHECKMULTISIG bug
+        return [b""] + sigs
+
+    # Build final_script_sig and final_script_witness from the partial
+    # signatures when they are enough to spend utxo, the CTxOut this input
+    # spends. Handles p2pkh, p2wpkh, p2sh-p2wpkh and multisig in p2sh,
+    # p2wsh and p2sh-p2wsh. Returns whether the input is finalized.
+    def finalize(self, utxo):
+        if len(self.final_script_sig) != 0 or not self.final_script_witness.is_null():
+            return True
+
+        script = utxo.scriptPubKey
+        redeem_push = b""
+        if utxo.is_p2sh():
+            if len(self.redeem_script) == 0 or hash160(self.redeem_script) != script[2:22]:
+                return False
+            script = self.redeem_script
+            redeem_push = push_data(self.redeem_script)
+
+        is_wit, version, program = CTxOut(0, script).is_witness()
+        if is_wit:
+            if version != 0:
+                return False
+            if len(program) == 20:
+                stack = self._solve(b"\x76\xa9\x14" + program + b"\x88\xac")
+            elif len(program) == 32 and len(self.witness_script) != 0 and sha256(self.witness_script) == program:
+                stack = self._solve(self.witness_script)
+                if stack is not None:
+                    stack.append(self.witness_script)
+            else:
+                return False
+            if stack is None:
+                return False
+            self.final_script_sig = redeem_push
+            self.final_script_witness = CTxInWitness()
+            self.final_script_witness.scriptWitness.stack = stack
+            # Only the witness utxo is needed from now on
+            if not self.witness_utxo:
+                self.witness_utxo = utxo
+                self.non_witness_utxo = None
+        else:
+            stack = self._solve(script)
+            if stack is None:
+                return False
+            self.final_script_sig = b"".join(push_data(item) for item in stack) + redeem_push
+
+        # Everything else was only needed to get here
+        self.partial_sigs.clear()
+        self.sighash = 0
+        self.redeem_script = b""
+        self.witness_script = b""
+        self.hd_keypaths.clear()
+        return True
+
+    # Add anything other knows about this input that we do not. Entries
+    # we already have win, like in Syscoin Core.
+    def merge(self, other):
+        if not self.non_witness_utxo and other.non_witness_utxo:
+            self.non_witness_utxo = other.non_witness_utxo
+        if not self.witness_utxo and other.witness_utxo:
+            self.witness_utxo = other.witness_utxo
+            # Clear out any non-witness utxo when we set a witness one
+            self.non_witness_utxo = None
+
+        merge_map(self.partial_sigs, other.partial_sigs)
+        merge_map(self.hd_keypaths, other.hd_keypaths)
+        merge_map(self.unknown, other.unknown)
+
+        if len(self.redeem_script) == 0:
+            self.redeem_script = other.redeem_script
+        if len(self.witness_script) == 0:
+            self.witness_script = other.witness_script
+        if len(self.final_script_sig) == 0:
+            self.final_script_sig = other.final_script_sig
+        if self.final_script_witness.is_null():
+            self.final_script_witness = other.final_script_witness
+
 class PartiallySignedOutput:
+    __slots__ = ("redeem_script", "witness_script", "hd_keypaths", "unknown")
+
     def __init__(self):
         self.redeem_script = b""
         self.witness_script = b""
@@ -651,7 +1293,8 @@ class PartiallySignedOutput:
             # read the key
             try:
                 key = deser_string(f)
-            except Exception:
+            except struct.error:
+                # Out of data. Strict parsing raises before getting here.
                 break
 
             # Check for separator
@@ -685,24 +1328,121 @@ class PartiallySignedOutput:
                 self.unknown[key] = value
 
     def serialize(self):
-        r = b""
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
+
+    def stream_serialize(self, f):
         if len(self.redeem_script) != 0:
-            r += ser_string(b"\x00")
-            r += ser_string(self.redeem_script)
+            stream_ser_string(f, b"\x00")
+            stream_ser_string(f, self.redeem_script)
 
         if len(self.witness_script) != 0:
-            r += ser_string(b"\x01")
-            r += ser_string(self.witness_script)
+            stream_ser_string(f, b"\x01")
+            stream_ser_string(f, self.witness_script)
 
-        r += SerializeHDKeypath(self.hd_keypaths, b"\x02")
+        StreamSerializeHDKeypath(f, self.hd_keypaths, b"\x02")
 
         for key, value in sorted(self.unknown.items()):
-            r += ser_string(key)
-            r += ser_string(value)
-
-        r += b"\x00"
-
-        return r
+            stream_ser_string(f, key)
+            stream_ser_string(f, value)
+
+        f.write(b"\x00")
+
+    # Same as PartiallySignedInput.merge
+    def merge(self, other):
+        merge_map(self.hd_keypaths, other.hd_keypaths)
+        merge_map(self.unknown, other.unknown)
+
+        if len(self.redeem_script) == 0:
+            self.redeem_script = other.redeem_script
+        if len(self.witness_script) == 0:
+            self.witness_script = other.witness_script
+
+# Advance f past a PSBT key-value map without decoding any of it
+def skip_map(f):
+    while True:
+        try:
+            keylen = deser_compact_size(f)
+        except struct.error:
+            break
+        if keylen == 0:
+            break
+        f.skip(keylen)
+        f.skip(deser_compact_size(f))
+
+# Read only the hd_keypaths, the keys of type key_type, from a PSBT
+# key-value map, skipping every other value
+def read_map_keypaths(f, key_type):
+    hd_keypaths = {}
+    while True:
+        try:
+            key = deser_string(f)
+        except struct.error:
+            break
+        if len(key) == 0:
+            break
+        if key[0] == key_type:
+            DeserializeHDKeypath(f, key, hd_keypaths)
+        else:
+            f.skip(deser_compact_size(f))
+    return hd_keypaths
+
+class LazyPSBTMaps(object):
+    """The input or output maps of a PSBT, decoded only when accessed
+
+    Only the byte offsets of each map are recorded up front. A map is
+    decoded the first time it is accessed, and maps that were never
+    accessed are copied verbatim when the PSBT is serialized again.
+    """
+
+    def __init__(self, reader, offsets, decode):
+        # offsets holds the start of every map followed by the end of the last one
+        self.reader = reader
+        self.data = reader.data
+        self.offsets = offsets
+        self.decode = decode
+        self.maps = [None] * (len(offsets) - 1)
+
+    def __len__(self):
+        return len(self.maps)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if self.maps[i] is None:
+            self.maps[i] = self.decode(i, self.reader.window(self.offsets[i], self.offsets[i + 1]))
+        return self.maps[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def is_decoded(self, i):
+        return self.maps[i] is not None
+
+    # Decode map i without keeping it, for a single pass over a PSBT that
+    # should not end up fully in memory
+    def peek(self, i):
+        if self.maps[i] is not None:
+            return self.maps[i]
+        return self.decode(i, self.reader.window(self.offsets[i], self.offsets[i + 1]))
+
+    # The hd_keypaths of map i, read from the buffer without decoding the
+    # rest of the map unless it already was
+    def keypaths(self, i, key_type):
+        if self.maps[i] is not None:
+            return self.maps[i].hd_keypaths
+        return read_map_keypaths(self.reader.window(self.offsets[i], self.offsets[i + 1]), key_type)
+
+    def stream_serialize(self, f):
+        for i, psbt_map in enumerate(self.maps):
+            if psbt_map is None:
+                f.write(self.data[self.offsets[i]:self.offsets[i + 1]])
+            else:
+                psbt_map.stream_serialize(f)
 
 class PSBT(object):
 
@@ -714,11 +1454,54 @@ class PSBT(object):
         self.inputs = []
         self.outputs = []
         self.unknown = {}
+        # Parsed non_witness_utxos, shared between inputs spending the same transaction
+        self.utxo_cache = {}
+        # hd_keypaths of the inputs and outputs by master key fingerprint
+        self._input_keypaths = None
+        self._output_keypaths = None
+
+    # With limits, a PSBTLimits, parsing is strict: any truncation or
+    # malformed length is an error and the limits are checked before
+    # anything they cover is decoded.
+    def deserialize(self, psbt, lazy=False, limits=None):
+        psbt = psbt.strip()
+        if limits is not None and len(psbt) // 4 * 3 > limits.max_size:
+            raise PSBTSerializationError("PSBT is larger than the limit of {} bytes".format(limits.max_size))
+        self.deserialize_bytes(base64.b64decode(psbt), lazy, limits)
+
+    # Deserialize a binary PSBT from any bytes-like object. The buffer is
+    # walked in place and is never copied as a whole.
+    # With lazy set, the input and output maps are only located here and
+    # are decoded and checked when they are first accessed.
+    def deserialize_bytes(self, data, lazy=False, limits=None):
+        if limits is None:
+            f = ByteReader(data)
+        else:
+            f = LimitedByteReader(data, limits=limits)
+        self.deserialize_stream(f, f.end, lazy)
+
+    # Deserialize a binary PSBT file (as written by Syscoin Core) through a
+    # read only memory map. A lazily parsed PSBT keeps the map open until
+    # it is garbage collected.
+    def deserialize_file(self, path, lazy=False, limits=None):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                raise PSBTSerializationError("invalid magic")
+            if limits is not None and size > limits.max_size:
+                raise PSBTSerializationError("PSBT is larger than the limit of {} bytes".format(limits.max_size))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if lazy:
+            self.deserialize_bytes(data, lazy, limits)
+        else:
+            with data:
+                self.deserialize_bytes(data, limits=limits)
 
-    def deserialize(self, psbt):
-        hexstring = Base64ToHex(psbt.strip())
-        f = BufferedReader(BytesIO(binascii.unhexlify(hexstring)))
-        end = len(binascii.unhexlify(hexstring))
+    # Strict parsing is enabled by passing a LimitedByteReader as f
+    def deserialize_stream(self, f, end, lazy=False):
+        limits = getattr(f, 'limits', None)
+        if limits is not None and end > limits.max_size:
+            raise PSBTSerializationError("PSBT is larger than the limit of {} bytes".format(limits.max_size))
 
         # Read the magic bytes
         magic = f.read(5)
@@ -730,7 +1513,8 @@ class PSBT(object):
             # read the key
             try:
                 key = deser_string(f)
-            except Exception:
+            except struct.error:
+                # Out of data. Strict parsing raises before getting here.
                 break
 
             # Check for separator
@@ -743,13 +1527,13 @@ class PSBT(object):
             # Do stuff based on type
             if key_type == 0x00:
                 # Checks for correctness
-                if not self.tx.is_null:
+                if not self.tx.is_null():
                     raise PSBTSerializationError("Duplicate key, unsigned tx already provided")
                 elif len(key) > 1:
                     raise PSBTSerializationError("Global unsigned tx key is more than one byte type")
 
                 # read in value
-                value = BufferedReader(BytesIO(deser_string(f)))
+                value = deser_string_reader(f)
                 self.tx.deserialize(value)
 
                 # Make sure that all scriptSigs and scriptWitnesses are empty
@@ -766,67 +1550,259 @@ class PSBT(object):
         # make sure that we got an unsigned tx
         if self.tx.is_null():
             raise PSBTSerializationError("No unsigned trasaction was provided")
+        if limits is not None and len(self.tx.vin) + len(self.tx.vout) > limits.max_maps:
+            raise PSBTSerializationError("PSBT has {} input and output maps, more than the limit of {}".format(len(self.tx.vin) + len(self.tx.vout), limits.max_maps))
 
-        # Read input data
-        for txin in self.tx.vin:
-            if f.tell() == end:
-                break
-            input = PartiallySignedInput()
-            input.deserialize(f)
-            self.inputs.append(input)
-
-            if input.non_witness_utxo and input.non_witness_utxo.rehash() and input.non_witness_utxo.sha256 != txin.prevout.sha256:
-                raise PSBTSerializationError("Non-witness UTXO does not match outpoint hash")
+        if lazy:
+            self.inputs = LazyPSBTMaps(f, self._scan_maps(f, end, len(self.tx.vin)), self._decode_input)
+        else:
+            # Read input data
+            self._input_keypaths = {}
+            for i, txin in enumerate(self.tx.vin):
+                if f.tell() == end:
+                    break
+                input = PartiallySignedInput()
+                input.deserialize(f, self.utxo_cache)
+                self.inputs.append(input)
+                self._check_input(input, txin)
+                self._index_keypaths(self._input_keypaths, i, input.hd_keypaths)
 
         if (len(self.inputs) != len(self.tx.vin)):
             raise PSBTSerializationError("Inputs provided does not match the number of inputs in transaction")
 
-        # Read output data
-        for txout in self.tx.vout:
-            if f.tell() == end:
-                break
-            output = PartiallySignedOutput()
-            output.deserialize(f)
-            self.outputs.append(output)
+        if lazy:
+            self.outputs = LazyPSBTMaps(f, self._scan_maps(f, end, len(self.tx.vout)), self._decode_output)
+        else:
+            # Read output data
+            self._output_keypaths = {}
+            for i, txout in enumerate(self.tx.vout):
+                if f.tell() == end:
+                    break
+                output = PartiallySignedOutput()
+                output.deserialize(f)
+                self.outputs.append(output)
+                self._index_keypaths(self._output_keypaths, i, output.hd_keypaths)
 
         if len(self.outputs) != len(self.tx.vout):
             raise PSBTSerializationError("Outputs provided does not match the number of outputs in transaction")
 
-        if not self.is_sane():
+        if not lazy and not self.is_sane():
             raise PSBTSerializationError("PSBT is not sane")
 
+    # Record where each of up to count maps starts, plus where the last one ends
+    def _scan_maps(self, f, end, count):
+        if not isinstance(f, ByteReader):
+            raise PSBTSerializationError("Lazy deserialization requires an in-memory buffer")
+        offsets = [f.tell()]
+        for _ in range(count):
+            if f.tell() == end:
+                break
+            skip_map(f)
+            offsets.append(f.tell())
+        return offsets
+
+    def _check_input(self, input, txin):
+        if input.non_witness_utxo and input.non_witness_utxo.txid != txin.prevout.hash_bytes:
+            raise PSBTSerializationError("Non-witness UTXO does not match outpoint hash")
+
+    def _decode_input(self, i, f):
+        input = PartiallySignedInput()
+        input.deserialize(f, self.utxo_cache)
+        self._check_input(input, self.tx.vin[i])
+        if not input.is_sane():
+            raise PSBTSerializationError("PSBT is not sane")
+        return input
+
+    def _decode_output(self, i, f):
+        output = PartiallySignedOutput()
+        output.deserialize(f)
+        return output
+
+    # Add the hd_keypaths of map i to an index of
+    # fingerprint -> {map index: [(pubkey, path), ...]}
+    @staticmethod
+    def _index_keypaths(index, i, hd_keypaths):
+        for pubkey, path in hd_keypaths.items():
+            index.setdefault(path[0], {}).setdefault(i, []).append((pubkey, path))
+
+    # (Re)build the keypath indexes. They are built while deserializing,
+    # or on first use otherwise, so call this after adding or removing
+    # hd_keypaths once they have been queried. Lazily parsed maps that
+    # were not accessed yet are scanned for keypaths and stay undecoded.
+    def index_keypaths(self):
+        self._input_keypaths = self._build_keypath_index(self.inputs, 6)
+        self._output_keypaths = self._build_keypath_index(self.outputs, 2)
+
+    @classmethod
+    def _build_keypath_index(cls, maps, key_type):
+        index = {}
+        for i in range(len(maps)):
+            if isinstance(maps, LazyPSBTMaps):
+                hd_keypaths = maps.keypaths(i, key_type)
+            else:
+                hd_keypaths = maps[i].hd_keypaths
+            cls._index_keypaths(index, i, hd_keypaths)
+        return index
+
+    # Map the index of every input with keys derived from the master key
+    # with this fingerprint to its (pubkey, path) pairs
+    def get_input_keypaths(self, fingerprint):
+        if self._input_keypaths is None:
+            self.index_keypaths()
+        return self._input_keypaths.get(fingerprint, {})
+
+    # Same as get_input_keypaths, for change outputs
+    def get_output_keypaths(self, fingerprint):
+        if self._output_keypaths is None:
+            self.index_keypaths()
+        return self._output_keypaths.get(fingerprint, {})
+
+    # Merge other PSBTs for the same unsigned transaction into this one, in
+    # a single pass over each of them
+    def combine(self, *psbts):
+        for psbt in psbts:
+            if psbt.tx.txid != self.tx.txid:
+                raise PSBTSerializationError("PSBTs not compatible (different transactions)")
+
+        for psbt in psbts:
+            for input, other in zip(self.inputs, psbt.inputs):
+                input.merge(other)
+            for output, other in zip(self.outputs, psbt.outputs):
+                output.merge(other)
+            merge_map(self.unknown, psbt.unknown)
+
+        # New hd_keypaths may have come in
+        self._input_keypaths = None
+        self._output_keypaths = None
+
+    # A copy of this PSBT with only what the signer with the given master
+    # key fingerprint needs, to save upload time on slow device links.
+    # Inputs and outputs without any of its keys lose their keypaths,
+    # scripts, signatures and unknowns, but keep their utxos so fees can
+    # still be checked. Signatures by other keys are dropped everywhere, and
+    # a non_witness_utxo is replaced by the witness_utxo it spends when that
+    # is a witness output. Use merge_signatures() to bring the signatures
+    # made on the copy back.
+    def prune(self, fingerprint):
+        our_inputs = self.get_input_keypaths(fingerprint)
+        our_outputs = self.get_output_keypaths(fingerprint)
+        pruned = PSBT(self.tx)
+        pruned.unknown = self.unknown
+
+        for i, input in enumerate(self.inputs):
+            pruned_in = PartiallySignedInput()
+            pruned_in.non_witness_utxo = input.non_witness_utxo
+            pruned_in.witness_utxo = input.witness_utxo
+            pruned_in.final_script_sig = input.final_script_sig
+            pruned_in.final_script_witness = input.final_script_witness
+            if i in our_inputs:
+                pruned_in.partial_sigs = {pubkey: input.partial_sigs[pubkey] for pubkey, _ in our_inputs[i] if pubkey in input.partial_sigs}
+                pruned_in.sighash = input.sighash
+                pruned_in.redeem_script = input.redeem_script
+                pruned_in.witness_script = input.witness_script
+                pruned_in.hd_keypaths = input.hd_keypaths
+                pruned_in.unknown = input.unknown
+
+            if input.non_witness_utxo:
+                utxo = self.get_utxo(i)
+                script = input.redeem_script if utxo.is_p2sh() else utxo.scriptPubKey
+                if CTxOut(0, script).is_witness()[0]:
+                    pruned_in.witness_utxo = utxo
+                    pruned_in.non_witness_utxo = None
+            pruned.inputs.append(pruned_in)
+
+        for i, output in enumerate(self.outputs):
+            if i in our_outputs:
+                pruned.outputs.append(output)
+            else:
+                pruned.outputs.append(PartiallySignedOutput())
+        return pruned
+
+    # Add the partial signatures of a signed copy of this PSBT, such as one
+    # made by prune(), to this one
+    def merge_signatures(self, signed):
+        if signed.tx.txid != self.tx.txid:
+            raise PSBTSerializationError("PSBTs not compatible (different transactions)")
+        # Inputs without new signatures are left alone, so those of a lazily
+        # parsed PSBT stay undecoded
+        for i, signed_in in enumerate(signed.inputs):
+            if signed_in.partial_sigs:
+                merge_map(self.inputs[i].partial_sigs, signed_in.partial_sigs)
+
+    # The CTxOut spent by input i
+    def get_utxo(self, i):
+        input = self.inputs[i]
+        if input.witness_utxo:
+            return input.witness_utxo
+        elif input.non_witness_utxo:
+            return input.non_witness_utxo.vout[self.tx.vin[i].prevout.n]
+        return None
+
+    # Finalize every input we have enough signatures for. Returns whether
+    # all inputs are finalized.
+    def finalize(self):
+        complete = True
+        for i, input in enumerate(self.inputs):
+            utxo = self.get_utxo(i)
+            if utxo is None or not input.finalize(utxo):
+                complete = False
+        self._input_keypaths = None
+        return complete
+
+    # The network serialized transaction of a finalized PSBT
+    def extract(self):
+        tx = self.tx.copy_on_write()
+        tx.wit = CTxWitness()
+        for i, input in enumerate(self.inputs):
+            if len(input.final_script_sig) == 0 and input.final_script_witness.is_null():
+                raise PSBTSerializationError("PSBT is not finalized, input {} has no final scriptSig or scriptWitness".format(i))
+            tx.mutable_vin(i).scriptSig = input.final_script_sig
+            tx.wit.vtxinwit.append(input.final_script_witness)
+        return tx
+
+    # Serialize to a base64 string
     def serialize(self):
-        r = b""
+        return base64.b64encode(self.serialize_bytes()).decode()
 
+    # Serialize to the binary PSBT format
+    def serialize_bytes(self):
+        f = BytesIO()
+        self.stream_serialize(f)
+        return f.getvalue()
+
+    # Write the binary PSBT to f, which only needs a write() method
+    def stream_serialize(self, f):
         # magic bytes
-        r += b"psbt\xff"
+        f.write(b"psbt\xff")
 
         # unsigned tx flag
-        r += b"\x01\x00"
+        f.write(b"\x01\x00")
 
         # write serialized tx
         tx = self.tx.serialize_with_witness()
-        r += ser_compact_size(len(tx))
-        r += tx
+        stream_ser_string(f, tx)
 
         # unknowns
         for key, value in sorted(self.unknown.items()):
-            r += ser_string(key)
-            r += ser_string(value)
+            stream_ser_string(f, key)
+            stream_ser_string(f, value)
 
         # separator
-        r += b"\x00"
+        f.write(b"\x00")
 
         # inputs
-        for input in self.inputs:
-            r += input.serialize()
+        if isinstance(self.inputs, LazyPSBTMaps):
+            self.inputs.stream_serialize(f)
+        else:
+            for input in self.inputs:
+                input.stream_serialize(f)
 
         # outputs
-        for output in self.outputs:
-            r += output.serialize()
-
-        # return hex string
-        return HexToBase64(binascii.hexlify(r)).decode()
+        if isinstance(self.outputs, LazyPSBTMaps):
+            self.outputs.stream_serialize(f)
+        else:
+            for output in self.outputs:
+                output.stream_serialize(f)
 
     def is_sane(self):
         for input in self.inputs:
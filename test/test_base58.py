@@ -45,5 +45,32 @@ class TestBase58(unittest.TestCase):
             encoded: str = base58.encode(unhexlify(pair[0]))
             self.assertEqual(encoded, pair[1])
 
+    def test_invalid(self):
+        """Test decoding invalid characters"""
+
+        for s in ['0', 'O', 'I', 'l', '2g ', 'a3g\u00e9']:
+            with self.subTest(s=s):
+                self.assertRaises(ValueError, base58.decode, s)
+
+    def test_many(self):
+        """Test batch encoding and decoding"""
+
+        data: List[bytes] = [unhexlify(pair[0]) for pair in TEST_VECTORS]
+        strings: List[str] = [pair[1] for pair in TEST_VECTORS]
+        self.assertEqual(base58.encode_many(data), strings)
+        self.assertEqual(base58.decode_many(strings), data)
+
+    def test_check(self):
+        """Test Base58Check encoding and decoding"""
+
+        # A P2PKH address from Syscoin Core's key_io_valid.json
+        payload: bytes = unhexlify("0065a16059864a2fdbc7c99a4723a8395bc6f188eb")
+        address: str = "1AGNa15ZQXAZUgFiqJ2i7Z2DPU2J6hW62i"
+        self.assertEqual(base58.encode_check(payload), address)
+        self.assertEqual(base58.decode_check(address), payload)
+        self.assertEqual(base58.to_address(payload[1:], payload[:1]), address)
+        self.assertRaises(ValueError, base58.decode_check, address[:-1] + "j")
+        self.assertRaises(ValueError, base58.decode_check, "1")
+
 if __name__ == "__main__":
     unittest.main()
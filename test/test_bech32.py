@@ -131,5 +131,30 @@ class TestSegwitAddress(unittest.TestCase):
             code = segwit_addr.encode(hrp, version, [0] * length)
             self.assertIsNone(code)
 
+    def test_many(self):
+        """Test batch encoding and decoding, from bytes or lists."""
+        programs = []
+        for (address, _) in VALID_ADDRESS:
+            witver, witprog = segwit_addr.decode("bc", address)
+            if witver is not None:
+                programs.append((witver, bytes(witprog)))
+        addrs = segwit_addr.encode_many("bc", programs)
+        self.assertEqual(addrs, [segwit_addr.encode("bc", witver, list(witprog)) for witver, witprog in programs])
+        self.assertEqual(segwit_addr.decode_many("bc", addrs), [(witver, list(witprog)) for witver, witprog in programs])
+        self.assertEqual(segwit_addr.encode_many("bc", [(0, b'\x00' * 19), (17, b'\x00' * 20)]), [None, None])
+
+    def test_convertbits(self):
+        """Test conversion of bytes to 5 bit values and back."""
+        data = bytes(range(255))
+        values = segwit_addr.convertbits(data, 8, 5)
+        self.assertEqual(len(values), 408)
+        self.assertEqual(values, segwit_addr.convertbits(list(data), 8, 5))
+        self.assertEqual(bytes(segwit_addr.convertbits(values, 5, 8, False)), data)
+        self.assertEqual(segwit_addr.convertbits(b'\xff', 8, 5), [31, 28])
+        self.assertIsNone(segwit_addr.convertbits(b'\xff', 8, 5, False))
+        self.assertIsNone(segwit_addr.convertbits([0, 1, 256], 8, 5))
+        self.assertIsNone(segwit_addr.convertbits([32], 5, 8, False))
+        self.assertIsNone(segwit_addr.convertbits(values + [0], 5, 8, False))
+
 if __name__ == "__main__":
     unittest.main()
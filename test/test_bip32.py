@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+
+"""Tests for BIP 32 public key derivation"""
+
+from hwilib.base58 import get_xpub_fingerprint, get_xpub_fingerprint_hex, xpub_main_2_test, xpub_to_pub_hex
+from hwilib.bip32 import ExtendedPubKey, HARDENED_FLAG, derive_xpub, parse_path, parse_xpub, split_hardened_path
+from hwilib.errors import BadArgumentError
+from hwilib.hwwclient import HardwareWalletClient
+import pickle
+import unittest
+
+# BIP 32 test vector 1, from the xpub of m/0H
+# https://github.com/bitcoin/bips/blob/master/bip-0032.mediawiki#test-vector-1
+XPUB_0H = 'xpub68Gmy5EdvgibQVfPdqkBBCHxA5htiqg55crXYuXoQRKfDBFA1WEjWgP6LHhwBZeNK1VTsfTFUHCdrfp1bgwQ9xv5ski8PX9rL2dZXvgGDnw'
+XPUB_0H_1 = 'xpub6ASuArnXKPbfEwhqN6e3mwBcDTgzisQN1wXN9BJcM47sSikHjJf3UFHKkNAWbWMiGj7Wf5uMash7SyYq527Hqck2AxYysAA7xmALppuCkwQ'
+XPUB_0H_1_2H = 'xpub6D4BDPcP2GT577Vvch3R8wDkScZWzQzMMUm3PWbmWvVJrZwQY4VUNgqFJPMM3No2dFDFGTsxxpG5uJh7n7epu4trkrX7x7DogT5Uv6fcLW5'
+XPUB_0H_1_2H_2 = 'xpub6FHa3pjLCk84BayeJxFW2SP4XRrFd1JYnxeLeU8EqN3vDfZmbqBqaGJAyiLjTAwm6ZLRQUMv1ZACTj37sR62cfN7fe5JnJ7dh8zL4fiyLHV'
+XPUB_0H_1_2H_2_1000000000 = 'xpub6H1LXWLaKsWFhvm6RVpEL9P4KfRZSW7abD2ttkWP3SSQvnyA8FSVqNTEcYFgJS2UaFcxupHiYkro49S8yGasTvXEYBVPamhGW6cFJodrTHy'
+
+class FakeClient(HardwareWalletClient):
+    def __init__(self):
+        super(FakeClient, self).__init__('', '')
+        self.requests = []
+
+    def get_device_pubkey_at_path(self, path):
+        self.requests.append(path)
+        xpub = {'m/0h': XPUB_0H, 'm/0h/1/2h': XPUB_0H_1_2H}[path]
+        return {'xpub': xpub_main_2_test(xpub) if self.is_testnet else xpub}
+
+class TestBIP32(unittest.TestCase):
+    def test_derive(self):
+        key = ExtendedPubKey.deserialize(XPUB_0H)
+        self.assertEqual(key.serialize(), XPUB_0H)
+        self.assertEqual(key.derive_child(1).serialize(), XPUB_0H_1)
+        self.assertEqual(derive_xpub(XPUB_0H_1_2H, [2]), XPUB_0H_1_2H_2)
+        self.assertEqual(derive_xpub(XPUB_0H_1_2H, [2, 1000000000]), XPUB_0H_1_2H_2_1000000000)
+        self.assertIs(key.derive_child(1), key.derive_child(1))
+        self.assertRaises(BadArgumentError, key.derive_child, HARDENED_FLAG)
+        self.assertRaises(BadArgumentError, ExtendedPubKey.deserialize, XPUB_0H[:-1] + 'x')
+
+    def test_parse_xpub(self):
+        key = parse_xpub(XPUB_0H_1)
+        self.assertIs(parse_xpub(XPUB_0H_1), key)
+        self.assertEqual(key.depth, 2)
+        self.assertEqual(key.child_num, 1)
+        self.assertEqual(key.parent_fingerprint, bytes.fromhex('5c1bd648'))
+        self.assertEqual(key.fingerprint, bytes.fromhex('bef5a2f9'))
+        self.assertEqual(key.pubkey.hex(), '03501e454bf00751f24b1b489aa925215d66af2234e3891c3b21a52bedb3cd711c')
+        self.assertRaises(AttributeError, setattr, key, 'depth', 3)
+        self.assertEqual(pickle.loads(pickle.dumps(key)), key)
+
+        self.assertEqual(get_xpub_fingerprint(XPUB_0H_1), 0x48d61b5c)
+        self.assertEqual(get_xpub_fingerprint_hex(XPUB_0H_1), '5c1bd648')
+        self.assertEqual(xpub_to_pub_hex(XPUB_0H_1), key.pubkey.hex())
+        tpub = xpub_main_2_test(XPUB_0H_1)
+        self.assertTrue(tpub.startswith('tpub'))
+        self.assertEqual(parse_xpub(tpub).serialize_bytes()[4:], key.serialize_bytes()[4:])
+        self.assertRaises(BadArgumentError, parse_xpub, XPUB_0H_1[:-1] + 'x')
+
+        # The point is only decompressed to derive a child
+        key = ExtendedPubKey.deserialize(XPUB_0H)
+        get_xpub_fingerprint(XPUB_0H)
+        self.assertIsNone(key._point)
+        key.derive_child(0)
+        self.assertIsNotNone(key._point)
+        off_curve = ExtendedPubKey(key.version, 0, b'\x00' * 4, 0, key.chaincode, b'\x02' + b'\x00' * 31 + b'\x05')
+        self.assertRaises(BadArgumentError, parse_xpub(off_curve.serialize()).derive_child, 0)
+
+    def test_paths(self):
+        self.assertEqual(parse_path("m/0'/1/2H/3h"), [HARDENED_FLAG, 1, HARDENED_FLAG + 2, HARDENED_FLAG + 3])
+        self.assertEqual(split_hardened_path("m/0'/1/2H/2/1000000000"), ('m/0h/1/2h', [2, 1000000000]))
+        self.assertEqual(split_hardened_path('m/0/1'), ('m', [0, 1]))
+        self.assertEqual(split_hardened_path('m'), ('m', []))
+        for path in ['', '0/1', 'm/', 'm/a', 'm/1/', 'm/2147483648']:
+            with self.subTest(path=path):
+                self.assertRaises(BadArgumentError, parse_path, path)
+
+    def test_client_derivation(self):
+        client = FakeClient()
+        self.assertEqual(client.get_pubkey_at_path('m/0h/1')['xpub'], XPUB_0H_1)
+        self.assertEqual(client.get_pubkey_at_path("m/0'")['xpub'], XPUB_0H)
+        self.assertEqual(client.requests, ['m/0h'])
+
+        self.assertEqual(client.get_pubkey_at_path('m/0h/1/2h/2/1000000000')['xpub'], XPUB_0H_1_2H_2_1000000000)
+        self.assertEqual(client.get_pubkey_at_path('m/0H/1/2H/2')['xpub'], XPUB_0H_1_2H_2)
+        self.assertEqual(client.requests, ['m/0h', 'm/0h/1/2h'])
+
+        # Switching to testnet asks the device again
+        client.is_testnet = True
+        self.assertEqual(client.get_pubkey_at_path('m/0h/1')['xpub'], xpub_main_2_test(XPUB_0H_1))
+        self.assertEqual(client.get_pubkey_at_path("m/0h")['xpub'], xpub_main_2_test(XPUB_0H))
+        self.assertEqual(client.requests, ['m/0h', 'm/0h/1/2h', 'm/0h'])
+        client.is_testnet = False
+        self.assertEqual(client.get_pubkey_at_path('m/0h')['xpub'], XPUB_0H)
+        self.assertEqual(len(client.requests), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,13 @@
 #! /usr/bin/env python3
 
-from hwilib.descriptor import Descriptor
+from hwilib.batch import derive_addresses
+from hwilib.cli import process_commands
+from hwilib.commands import deriveaddresses
+from hwilib.descriptor import AddChecksum, Descriptor, DescriptorChecksum, descriptor_checksums, parse_descriptor
+from hwilib.errors import BadArgumentError
+from contextlib import redirect_stdout
+from io import StringIO
+import multiprocessing
 import unittest
 
 class TestDescriptor(unittest.TestCase):
@@ -98,5 +105,134 @@ class TestDescriptor(unittest.TestCase):
             self.assertIsNone(Descriptor.parse("sh(multi(2,[00000000/111'/222]xprvA1RpRA33e1JQ7ifknakTFpgNXPmW2YvmhqLQYMmrj4xJXXWYpDPS3xz7iAxn8L39njGVyuoseXzU6rcxFLJ8HFsTjSyQbLYnMpCqE2VbFWc,xprv9uPDJpEQgRQfDcW7BkF7eTya6RPxXeJCqCJGHuCJ4GiRVLzkTXBAJMu2qaMWPrS7AANYqdq6vcBcBUdJCVVFceUvJFjaPdGZ2y9WACViL4L/0))#ggssrxfy"))
             self.assertIsNone(Descriptor.parse("sh(multi(2,[00000000/111'/222]xpub6ERApfZwUNrhLCkDtcHTcxd75RbzS1ed54G1LkBUHQVHQKqhMkhgbmJbZRkrgZw4koxb5JaHWkY4ALHY2grBGRjaDMzQLcgJvLJuZZvRcEL,xpub68NZiKmJWnxxS6aaHmn81bvJeTESw724CRDs6HbuccFQN9Ku14VQrADWgqbhhTHBaohPX4CjNLf9fq9MYo6oDaPPLPxSb7gwQN3ih19Zm4Y/0))#tjq09x4t"))
 
+    def test_descriptor_checksums(self):
+        descs = [
+            "wpkh([00000001/84'/1'/0']tpubD6NzVbkrYhZ4WaWSyoBvQwbpLkojyoTZPRsgXELWz3Popb3qkjcJyJUGLnL4qHHoQvao8ESaAstxYSnhyswJ76uZPStJRJCTKvosUCJZL5B/0/0)",
+            "wpkh(tpubD6NzVbkrYhZ4WaWSyoBvQwbpLkojyoTZPRsgXELWz3Popb3qkjcJyJUGLnL4qHHoQvao8ESaAstxYSnhyswJ76uZPStJRJCTKvosUCJZL5B/0/0)",
+            "wpkh([00000001/84'/1'/0'/0/0]0297dc3f4420402e01a113984311bf4a1b8de376cac0bdcfaf1b3ac81f13433c7)",
+            "",
+            "a",
+            "ab",
+            "raw(\u00e9)",
+        ]
+        self.assertEqual(descriptor_checksums(descs), [DescriptorChecksum(desc) for desc in descs])
+        self.assertEqual(descriptor_checksums(descs[:3]), ["mz20k55p", "ac0p4yhq", "rh7p6vk2"])
+        self.assertEqual(DescriptorChecksum(descs[-1]), "")
+        self.assertEqual(AddChecksum(descs[1]), descs[1] + "#ac0p4yhq")
+
+    def test_parse_descriptor_tree(self):
+        xpub1 = "xpub6ERApfZwUNrhLCkDtcHTcxd75RbzS1ed54G1LkBUHQVHQKqhMkhgbmJbZRkrgZw4koxb5JaHWkY4ALHY2grBGRjaDMzQLcgJvLJuZZvRcEL"
+        xpub2 = "xpub68NZiKmJWnxxS6aaHmn81bvJeTESw724CRDs6HbuccFQN9Ku14VQrADWgqbhhTHBaohPX4CjNLf9fq9MYo6oDaPPLPxSb7gwQN3ih19Zm4Y"
+        desc = "sh(wsh(sortedmulti(1,[00000000/48'/0'/0'/1']" + xpub1 + "/0/*," + xpub2 + "/1/2)))"
+        node = parse_descriptor(desc.replace("'", "h"))
+        self.assertEqual(node.nesting(), ['sh', 'wsh', 'sortedmulti'])
+        inner = node.inner()
+        self.assertEqual(inner.threshold, 1)
+        self.assertEqual(len(inner.keys), 2)
+        self.assertEqual(inner.keys[0].origin_fingerprint, "00000000")
+        self.assertEqual(inner.keys[0].origin_path, "/48'/0'/0'/1'")
+        self.assertEqual(inner.keys[0].key, xpub1)
+        self.assertEqual(inner.keys[0].path_suffix, "/0/*")
+        self.assertTrue(inner.keys[0].is_range())
+        self.assertEqual(inner.keys[1].origin_fingerprint, None)
+        self.assertFalse(inner.keys[1].is_range())
+        self.assertTrue(node.is_range())
+        self.assertEqual(str(node), desc)
+        self.assertEqual(node.serialize(), AddChecksum(desc))
+
+        # Parsing again, also with a checksum, gives the cached tree
+        self.assertIs(parse_descriptor(desc.replace("'", "h")), node)
+        self.assertIs(parse_descriptor(" " + AddChecksum(desc.replace("'", "h"))), node)
+
+        desc = Descriptor.parse("wsh(multi(2," + xpub1 + "/0," + xpub2 + "/0))")
+        self.assertEqual(desc.base_key, xpub1)
+        self.assertEqual(desc.path_suffix, "/0")
+        self.assertEqual(desc.wpkh, None)
+        self.assertEqual(desc.sh_wpkh, None)
+        self.assertEqual(desc.node.nesting(), ['wsh', 'multi'])
+
+        # Descriptors the single key fields can not hold serialize from the tree
+        for desc in ["wsh(multi(2," + xpub1 + "/0," + xpub2 + "/0))",
+                     "sh(wsh(sortedmulti(1,[00000000/48'/0'/0'/1']" + xpub1 + "/0/*," + xpub2 + "/1/2)))",
+                     "multi(1," + xpub1 + "/0," + xpub2 + "/0)",
+                     "pk(" + xpub1 + "/0)",
+                     "wsh(pkh(" + xpub1 + "/0))",
+                     "pkh([00000000/44'/0'/0']" + xpub1 + "/0/*)",
+                     "sh(wpkh(" + xpub1 + "/0))"]:
+            with self.subTest(desc=desc):
+                self.assertEqual(Descriptor.parse(desc).serialize(), AddChecksum(desc))
+
+    def test_parse_invalid_descriptors(self):
+        pubkey = "0297dc3f4420402e01a113984311bf4a1b8de376cac0bdcfaf1b3ac81f13433c7"
+        for desc in [
+            "",
+            "wpkh(" + pubkey,
+            "wpkh(" + pubkey + "))",
+            "foo(" + pubkey + ")",
+            "wsh(wpkh(" + pubkey + "))",
+            "sh(sh(pkh(" + pubkey + ")))",
+            "wsh(sh(pkh(" + pubkey + ")))",
+            "sh(combo(" + pubkey + "))",
+            "multi(3," + pubkey + "," + pubkey + ")",
+            "multi(0," + pubkey + ")",
+            "multi(x," + pubkey + ")",
+            "multi(\u00b2," + pubkey + "," + pubkey + ")",
+            "multi(\u0663," + pubkey + "," + pubkey + "," + pubkey + ")",
+            "multi(," + pubkey + ")",
+            "pkh(" + pubkey + "/0)",
+            "pkh([0000000/0]" + pubkey + ")",
+            "pkh([00000000/0x]" + pubkey + ")",
+            "pkh(xpub/0/*/1)",
+            "pkh(xpub//1)",
+            "pkh(xpub/2147483648)",
+            "raw(abc)",
+            "wpkh(" + pubkey + ")#00000000",
+        ]:
+            with self.subTest(desc=desc):
+                self.assertRaises(BadArgumentError, parse_descriptor, desc)
+                self.assertIsNone(Descriptor.parse(desc))
+
+    def test_get_address(self):
+        # BIP 84 test vector account key, m/84'/0'/0' of "abandon abandon ... about", as an xpub
+        xpub = "xpub6CatWdiZiodmUeTDp8LT5or8nmbKNcuyvz7WyksVFkKB4RHwCD3XyuvPEbvqAQY3rAPshWcMLoP2fMFMKHPJ4ZeZXYVUhLv1VMrjPC7PW6V"
+        desc = Descriptor.parse("wpkh([73c5da0a/84h/0h/0h]" + xpub + "/0/*)")
+        self.assertEqual(desc.get_pubkey(0).hex(), "0330d54fd0dd420a6e5f8d3624f5f3482cae350f79d5f0753bf5beef9c2d91af3c")
+        # bc1qcr8te4kr609gcawutmrza0j4xv80jy8z306fyu with the Syscoin HRP
+        self.assertEqual(desc.get_address(0), "sys1qcr8te4kr609gcawutmrza0j4xv80jy8zeltnmw")
+        self.assertEqual(desc.get_addresses(0, 1), ["sys1qcr8te4kr609gcawutmrza0j4xv80jy8zeltnmw", "sys1qnjg0jd8228aq7egyzacy8cys3knf9xvr3n8n66"])
+        self.assertEqual(Descriptor.parse("pkh(" + xpub + "/0/0)").get_address(), "SesUS4GX9ztruBHF9hjcCXix68JhPkY4Ux")
+        self.assertEqual(Descriptor.parse("sh(wpkh(" + xpub + "/0/0))").get_address(), "3GtVZYzsKF6Feikdjd4bDyPdAiyeHANY9b")
+        self.assertEqual(Descriptor.parse("sh(wpkh(" + xpub + "/0/0))", True).get_address(), "2N8ShdHvtvhbbrWPBQkgTqvNtP5Bp33veEi")
+
+        self.assertRaises(BadArgumentError, desc.get_address)
+        self.assertRaises(BadArgumentError, Descriptor.parse("wpkh(" + xpub + "/0h/*)").get_address, 0)
+        self.assertRaises(BadArgumentError, Descriptor.parse("wsh(multi(1," + xpub + "/0))").get_address)
+
+    def test_deriveaddresses(self):
+        xpub = "xpub6CatWdiZiodmUeTDp8LT5or8nmbKNcuyvz7WyksVFkKB4RHwCD3XyuvPEbvqAQY3rAPshWcMLoP2fMFMKHPJ4ZeZXYVUhLv1VMrjPC7PW6V"
+        desc = "pkh(" + xpub + "/1/*)"
+        expected = Descriptor.parse(desc).get_addresses(3, 9)
+        self.assertEqual(list(deriveaddresses(desc, 3, 9)), expected)
+        # Split over worker processes in chunks
+        self.assertEqual(list(derive_addresses(desc, 3, 9, max_workers=2, chunk_size=2)), expected)
+        self.assertEqual(list(derive_addresses(desc, 3, 9, max_workers=1, chunk_size=4, mp_context=multiprocessing.get_context('spawn'))), expected)
+        # Bad arguments fail before the first address
+        addresses = derive_addresses("pkh(" + xpub + "/1/*')", 0, 5000)
+        self.assertRaises(BadArgumentError, next, addresses)
+        self.assertEqual(list(deriveaddresses("pkh(" + xpub + "/1/3)")), expected[:1])
+
+        for args in [("pkh(" + xpub + "/1/3)", 0, 1), (desc,), (desc, 2, 1), (desc, 0, 0x80000000), ("pkh(" + xpub + "/1/*')", 0, 1), ("wsh(pkh(" + xpub + "/1/*))", 0, 1), ("pkh(", 0, 1)]:
+            with self.subTest(args=args):
+                self.assertRaises(BadArgumentError, list, deriveaddresses(*args))
+
+        # The command hands its lines to main() to print, a failure included
+        with redirect_stdout(StringIO()) as out:
+            lines = list(process_commands(['deriveaddresses', desc, '3', '4', '--jobs', '1']))
+            failed = list(process_commands(['deriveaddresses', desc]))
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(lines, [{'address': expected[0], 'index': 3}, {'address': expected[1], 'index': 4}, {'addresses': 2}])
+        self.assertEqual(len(failed), 1)
+        self.assertIn('error', failed[0])
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,20 @@
 #! /usr/bin/env python3
 
-from hwilib.serializations import PSBT
-from hwilib.errors import PSBTSerializationError
+from hwilib.serializations import ByteReader, COutPoint, CTransaction, CTxIn, CTxOut, PartiallySignedInput, PartiallySignedOutput, PrecomputedTransactionData, PSBT, PSBTLimits, ScriptType, hash160, hash256, p2wpkh_script_code, sha256
+from hwilib.batch import process_batch, signtx_batch
+from hwilib.cli import process_commands, signtx_batch_handler
+from hwilib.commands import decodepsbt, finalizepsbt, finalizepsbts, signtx
+from hwilib.errors import BadArgumentError, PSBTSerializationError
+from hwilib.hwwclient import HardwareWalletClient
+from argparse import Namespace
+from binascii import unhexlify
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+import base64
 import json
+import multiprocessing
 import os
+import tempfile
 import unittest
 
 class TestPSBT(unittest.TestCase):
@@ -28,5 +39,496 @@ class TestPSBT(unittest.TestCase):
                 serd = psbt.serialize()
                 self.assertEqual(valid, serd)
 
+    def test_strict_psbt(self):
+        for invalid in self.data['invalid']:
+            with self.subTest(invalid=invalid):
+                with self.assertRaises(PSBTSerializationError):
+                    PSBT().deserialize(invalid, limits=PSBTLimits())
+        for valid in self.data['valid']:
+            with self.subTest(valid=valid):
+                for lazy in [False, True]:
+                    psbt = PSBT()
+                    psbt.deserialize(valid, lazy, PSBTLimits())
+                    list(psbt.inputs)
+                    list(psbt.outputs)
+                    self.assertEqual(psbt.serialize(), valid)
+
+        # Truncation is an error instead of the end of the last map
+        raw = base64.b64decode(self.data['valid'][1])
+        with self.assertRaises(PSBTSerializationError):
+            PSBT().deserialize_bytes(raw[:-1], limits=PSBTLimits())
+
+        psbt_b64 = self.data['combiner'][0]['combine'][0]
+        for limits in [PSBTLimits(max_size=100), PSBTLimits(max_maps=3), PSBTLimits(max_value_length=100), PSBTLimits(max_keypath_depth=2)]:
+            with self.assertRaises(PSBTSerializationError):
+                PSBT().deserialize(psbt_b64, limits=limits)
+        PSBT().deserialize(psbt_b64, limits=PSBTLimits(max_maps=4, max_keypath_depth=3))
+
+    def test_non_witness_utxo_outpoint(self):
+        psbt = PSBT()
+        psbt.deserialize(self.data['combiner'][0]['combine'][0])
+        psbt.tx.vin[0].prevout = COutPoint(1, 0)
+        with self.assertRaises(PSBTSerializationError):
+            PSBT().deserialize(psbt.serialize())
+
+    def test_valid_psbt_bytes(self):
+        for valid in self.data['valid']:
+            with self.subTest(valid=valid):
+                psbt = PSBT()
+                psbt.deserialize_bytes(memoryview(base64.b64decode(valid)))
+                self.assertEqual(valid, psbt.serialize())
+                self.assertEqual(base64.b64decode(valid), psbt.serialize_bytes())
+                psbt = PSBT()
+                psbt.deserialize_bytes(bytearray(base64.b64decode(valid)), lazy=True)
+                self.assertEqual(valid, psbt.serialize())
+
+        # Buffers other than bytes are viewed in place, but reads give bytes
+        buf = bytearray(b"\x01\x02\x03")
+        reader = ByteReader(buf)
+        buf[0] = 4
+        self.assertEqual(reader.read(2), b"\x04\x02")
+        self.assertEqual(reader.sub_reader(1).read(1), b"\x03")
+
+    def test_final_script_witness(self):
+        # The BIP 174 finalizer vector has a finalized P2SH-P2WSH input
+        result = self.data['finalizer'][0]['result']
+        psbt = PSBT()
+        psbt.deserialize(result)
+        self.assertFalse(psbt.inputs[1].final_script_witness.is_null())
+        self.assertEqual(psbt.serialize(), result)
+
+        # The value of the 0x08 key is the serialized witness stack, with the
+        # length prefix of any other value
+        witness = psbt.inputs[1].final_script_witness.serialize()
+        self.assertIn(b"\x01\x08" + bytes([len(witness)]) + witness, psbt.serialize_bytes())
+        psbt.inputs[1].final_script_witness.scriptWitness.stack.append(b"\x01" * 300)
+        psbt_copy = PSBT()
+        psbt_copy.deserialize(psbt.serialize())
+        self.assertEqual(psbt_copy.inputs[1].final_script_witness.scriptWitness.stack, psbt.inputs[1].final_script_witness.scriptWitness.stack)
+
+    def test_psbt_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.psbt')
+            for valid in self.data['valid']:
+                with open(path, 'wb') as f:
+                    f.write(base64.b64decode(valid))
+                for lazy in [False, True]:
+                    psbt = PSBT()
+                    psbt.deserialize_file(path, lazy)
+                    self.assertEqual(psbt.serialize(), valid)
+                    del psbt
+
+            open(path, 'wb').close()
+            with self.assertRaises(PSBTSerializationError):
+                PSBT().deserialize_file(path)
+
+    def test_signtx_files(self):
+        class SigningClient(HardwareWalletClient):
+            # Signs by copying the signatures of the other combiner PSBT
+            def __init__(self, signatures):
+                super(SigningClient, self).__init__('', '')
+                self.signatures = signatures
+
+            def sign_psbt(self, tx):
+                for psbt_in, signed_in in zip(tx.inputs, self.signatures.inputs):
+                    psbt_in.partial_sigs.update(signed_in.partial_sigs)
+
+        vector = self.data['combiner'][0]
+        signatures = PSBT()
+        signatures.deserialize(vector['combine'][1])
+        client = SigningClient(signatures)
+        self.assertEqual(signtx(client, vector['combine'][0]), {'psbt': vector['result']})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.psbt')
+            out_path = os.path.join(tmpdir, 'signed.psbt')
+            with open(path, 'wb') as f:
+                f.write(base64.b64decode(vector['combine'][0]))
+            result = signtx(client, psbt_file=path, out_file=out_path)
+            with open(out_path, 'rb') as f:
+                self.assertEqual(f.read(), base64.b64decode(vector['result']))
+            self.assertEqual(result['psbt_file'], out_path)
+
+            with open(path, 'wb') as f:
+                f.write(base64.b64decode(self.data['finalizer'][0]['finalize']))
+            extracted = {'hex': self.data['extractor'][0]['result'], 'complete': True}
+            self.assertEqual(finalizepsbts([self.data['finalizer'][0]['finalize']], psbt_files=[path]), [extracted, extracted])
+        self.assertRaises(BadArgumentError, finalizepsbts, [])
+
+    def test_combiner(self):
+        for vector in self.data['combiner']:
+            psbts = []
+            for psbt_b64 in vector['combine']:
+                psbt = PSBT()
+                psbt.deserialize(psbt_b64)
+                psbts.append(psbt)
+            psbts[0].combine(*psbts[1:])
+            self.assertEqual(psbts[0].serialize(), vector['result'])
+
+        psbt = PSBT()
+        psbt.deserialize(self.data['valid'][0])
+        other = PSBT()
+        other.deserialize(self.data['valid'][1])
+        with self.assertRaises(PSBTSerializationError):
+            psbt.combine(other)
+
+    def test_finalizer(self):
+        for vector in self.data['finalizer']:
+            psbt = PSBT()
+            psbt.deserialize(vector['finalize'])
+            self.assertTrue(psbt.finalize())
+            self.assertEqual(psbt.serialize(), vector['result'])
+
+        # Not enough signatures for the 2-of-2 multisigs
+        psbt = PSBT()
+        psbt.deserialize(self.data['combiner'][0]['combine'][0])
+        self.assertFalse(psbt.finalize())
+        self.assertEqual(psbt.serialize(), self.data['combiner'][0]['combine'][0])
+        with self.assertRaises(PSBTSerializationError):
+            psbt.extract()
+
+    def test_finalize_scripts(self):
+        pubkeys = [bytes([2]) + bytes([i]) * 32 for i in range(1, 4)]
+        sigs = [b"\x30" + bytes([i]) * 70 + b"\x01" for i in range(1, 4)]
+        keyhash = hash160(pubkeys[0])
+        p2wpkh = b"\x00\x14" + keyhash
+        multisig = b"\x52" + b"".join(b"\x21" + pubkey for pubkey in pubkeys) + b"\x53\xae"
+
+        psbt_in = PartiallySignedInput()
+        psbt_in.partial_sigs[pubkeys[0]] = sigs[0]
+        self.assertTrue(psbt_in.finalize(CTxOut(0, b"\x76\xa9\x14" + keyhash + b"\x88\xac")))
+        self.assertEqual(psbt_in.final_script_sig, b"\x48" + sigs[0] + b"\x21" + pubkeys[0])
+        self.assertTrue(psbt_in.final_script_witness.is_null())
+        self.assertEqual(psbt_in.partial_sigs, {})
+
+        psbt_in = PartiallySignedInput()
+        psbt_in.partial_sigs[pubkeys[0]] = sigs[0]
+        self.assertTrue(psbt_in.finalize(CTxOut(0, p2wpkh)))
+        self.assertEqual(psbt_in.final_script_sig, b"")
+        self.assertEqual(psbt_in.final_script_witness.scriptWitness.stack, [sigs[0], pubkeys[0]])
+
+        psbt_in = PartiallySignedInput()
+        psbt_in.partial_sigs[pubkeys[0]] = sigs[0]
+        psbt_in.redeem_script = p2wpkh
+        self.assertTrue(psbt_in.finalize(CTxOut(0, b"\xa9\x14" + hash160(p2wpkh) + b"\x87")))
+        self.assertEqual(psbt_in.final_script_sig, b"\x16" + p2wpkh)
+        self.assertEqual(psbt_in.final_script_witness.scriptWitness.stack, [sigs[0], pubkeys[0]])
+        self.assertEqual(psbt_in.redeem_script, b"")
+
+        # 2-of-3 with all three signatures takes the first two in script order
+        psbt_in = PartiallySignedInput()
+        psbt_in.witness_script = multisig
+        p2wsh = CTxOut(0, b"\x00\x20" + sha256(multisig))
+        psbt_in.partial_sigs[pubkeys[2]] = sigs[2]
+        self.assertFalse(psbt_in.finalize(p2wsh))
+        psbt_in.partial_sigs[pubkeys[1]] = sigs[1]
+        psbt_in.partial_sigs[pubkeys[0]] = sigs[0]
+        self.assertTrue(psbt_in.finalize(p2wsh))
+        self.assertEqual(psbt_in.final_script_witness.scriptWitness.stack, [b"", sigs[0], sigs[1], multisig])
+
+    def test_extractor(self):
+        for vector in self.data['extractor']:
+            psbt = PSBT()
+            psbt.deserialize(vector['extract'])
+            self.assertEqual(psbt.extract().serialize_with_witness().hex(), vector['result'])
+
+    def test_prune(self):
+        full = PSBT()
+        full.deserialize(self.data['combiner'][0]['combine'][0])
+        fingerprint = next(iter(full.inputs[0].hd_keypaths.values()))[0]
+
+        # A signer none of whose keys are used gets no keypaths or signatures
+        pruned = full.prune(fingerprint + 1)
+        for psbt_in in pruned.inputs:
+            self.assertEqual(psbt_in.hd_keypaths, {})
+            self.assertEqual(psbt_in.partial_sigs, {})
+            self.assertTrue(psbt_in.witness_utxo or psbt_in.non_witness_utxo)
+        self.assertLess(len(pruned.serialize_bytes()), len(full.serialize_bytes()))
+
+        # Our inputs keep everything but other keys' signatures
+        pruned = full.prune(fingerprint)
+        self.assertEqual(pruned.inputs[0].hd_keypaths, full.inputs[0].hd_keypaths)
+        self.assertEqual(pruned.inputs[0].redeem_script, full.inputs[0].redeem_script)
+        signed = PSBT()
+        signed.deserialize_bytes(pruned.serialize_bytes())
+        self.assertTrue(signed.is_sane())
+
+        # Signatures made on the pruned copy are merged back
+        other = PSBT()
+        other.deserialize(self.data['combiner'][0]['combine'][1])
+        expected = dict(full.inputs[0].partial_sigs)
+        expected.update(other.inputs[0].partial_sigs)
+        signed.inputs[0].partial_sigs.update(other.inputs[0].partial_sigs)
+        full.merge_signatures(signed)
+        self.assertEqual(full.inputs[0].partial_sigs, expected)
+
+    def test_classify_outputs(self):
+        keyhash = b"\x11" * 20
+        multisig = b"\x51\x21" + b"\x02" * 33 + b"\x51\xae"
+        tx = CTransaction()
+        for script in [b"\x76\xa9\x14" + keyhash + b"\x88\xac", b"\xa9\x14" + keyhash + b"\x87", b"\x00\x14" + keyhash,
+                       b"\x00\x20" + keyhash + b"\x22" * 12, b"\x51\x20" + keyhash + b"\x22" * 12, b"\x21" + b"\x02" * 33 + b"\xac",
+                       multisig, b"\x6a\x01\x00"]:
+            tx.vout.append(CTxOut(0, script))
+        self.assertEqual([c[0] for c in tx.classify_outputs()], [
+            ScriptType.P2PKH, ScriptType.P2SH, ScriptType.WITNESS_V0_KEYHASH, ScriptType.WITNESS_V0_SCRIPTHASH,
+            ScriptType.WITNESS_UNKNOWN, ScriptType.P2PK, ScriptType.MULTISIG, ScriptType.NONSTANDARD])
+        self.assertEqual(tx.vout[0].classify()[1], keyhash)
+        self.assertEqual(tx.vout[4].is_witness(), (True, 1, keyhash + b"\x22" * 12))
+        self.assertEqual(tx.vout[1].is_witness(), (False, None, None))
+
+        # Assigning a new script drops the cached classification
+        tx.vout[0].scriptPubKey = b"\x00\x14" + keyhash
+        self.assertFalse(tx.vout[0].is_p2pkh())
+        self.assertEqual(tx.vout[0].is_witness(), (True, 0, keyhash))
+
+    def test_decodepsbt(self):
+        psbt_b64 = self.data['combiner'][0]['combine'][0]
+        lines = list(decodepsbt(psbt_b64, fingerprint='d90c6a4f'))
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0]['inputs'], 2)
+        self.assertEqual(lines[1]['redeem_script_type'], 'multisig')
+        self.assertEqual(lines[1]['our_keypaths'], ['m/0h/0h/0h', 'm/0h/0h/1h'])
+        self.assertFalse(lines[1]['signed'])
+        self.assertEqual(lines[3]['amount'], 149990000)
+        self.assertEqual(lines[5], {'fee': 10000, 'complete': False})
+
+        lines = list(decodepsbt(self.data['finalizer'][0]['result']))
+        self.assertTrue(lines[-1]['complete'])
+        self.assertNotIn('our_keypaths', lines[1])
+
+        # The command hands its lines to main() to print, a failure included
+        with redirect_stdout(StringIO()) as out:
+            self.assertEqual(list(process_commands(['decodepsbt', psbt_b64])), list(decodepsbt(psbt_b64)))
+            lines = list(process_commands(['decodepsbt', 'bm90IGEgcHNidA==']))
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(len(lines), 1)
+        self.assertIn('error', lines[0])
+
+    def test_batch(self):
+        class SigningClient(object):
+            # Signs by copying the signatures of the other combiner PSBT
+            def __init__(self, signatures):
+                self.signatures = signatures
+
+            def sign_tx(self, tx):
+                for psbt_in, signed_in in zip(tx.inputs, self.signatures.inputs):
+                    psbt_in.partial_sigs.update(signed_in.partial_sigs)
+                return {'psbt': tx.serialize()}
+
+        vector = self.data['combiner'][0]
+        signatures = PSBT()
+        signatures.deserialize(vector['combine'][1])
+        psbts = [vector['combine'][0], 'bm90IGEgcHNidA==', vector['combine'][0]]
+        fingerprint = next(iter(signatures.inputs[0].hd_keypaths.values()))[0]
+
+        results = list(signtx_batch(SigningClient(signatures), psbts, fingerprint=fingerprint, max_workers=2))
+        self.assertEqual([i for i, _ in results], [0, 1, 2])
+        self.assertEqual(results[0][1], {'psbt': vector['result']})
+        self.assertIn('error', results[1][1])
+        self.assertEqual(results[2][1], results[0][1])
+
+        results = list(signtx_batch(SigningClient(signatures), psbts, finalize=True, max_workers=2, ordered=False))
+        self.assertEqual(sorted(i for i, _ in results), [0, 1, 2])
+        self.assertEqual(dict(results)[0], {'hex': self.data['extractor'][0]['result'], 'complete': True})
+
+        # Without a fingerprint nothing is pruned or merged
+        results = list(signtx_batch(SigningClient(signatures), psbts, max_workers=2))
+        self.assertEqual(results[0], (0, {'psbt': vector['result']}))
+        self.assertIn('error', results[1][1])
+
+        # Work that never reaches a worker is an error result too
+        class LocalLimits(PSBTLimits):
+            pass
+        results = list(signtx_batch(SigningClient(signatures), psbts[:2], fingerprint=fingerprint, limits=LocalLimits(), max_workers=1))
+        self.assertEqual([i for i, _ in results], [0, 1])
+        self.assertTrue(all('error' in result for _, result in results))
+
+        # The command line fingerprint is checked before anything is signed
+        for bad in ['1234', '123456789a', 'zz345678']:
+            args = Namespace(batch_file=os.devnull, fingerprint=bad, finalize=False, jobs=1, unordered=False)
+            self.assertRaises(BadArgumentError, signtx_batch_handler, args, SigningClient(signatures))
+
+        results = list(process_batch(finalizepsbt, [self.data['finalizer'][0]['finalize']] * 3, max_workers=2))
+        self.assertEqual(results, [(i, {'hex': self.data['extractor'][0]['result'], 'complete': True}) for i in range(3)])
+
+        # Workers started with spawn import everything again
+        spawn = multiprocessing.get_context('spawn')
+        results = list(process_batch(finalizepsbt, [self.data['finalizer'][0]['finalize']] * 2, max_workers=2, ordered=False, mp_context=spawn))
+        self.assertEqual(sorted(results), [(i, {'hex': self.data['extractor'][0]['result'], 'complete': True}) for i in range(2)])
+        results = list(signtx_batch(SigningClient(signatures), psbts[:2], fingerprint=fingerprint, max_workers=1, mp_context=spawn))
+        self.assertEqual(results[0], (0, {'psbt': vector['result']}))
+
+        # Items are submitted a window at a time, and abandoning a batch
+        # does not wait for the rest
+        consumed = []
+
+        def items():
+            for i in range(1000):
+                consumed.append(i)
+                yield self.data['finalizer'][0]['finalize']
+        batch = process_batch(finalizepsbt, items(), max_workers=1)
+        self.assertEqual(next(batch)[0], 0)
+        batch.close()
+        self.assertLessEqual(len(consumed), 3)
+
+    def test_lazy_psbt(self):
+        for valid in self.data['valid']:
+            with self.subTest(valid=valid):
+                psbt = PSBT()
+                psbt.deserialize(valid)
+                lazy = PSBT()
+                lazy.deserialize(valid, lazy=True)
+                self.assertEqual(len(psbt.inputs), len(lazy.inputs))
+                self.assertEqual(len(psbt.outputs), len(lazy.outputs))
+                # Untouched maps are copied verbatim
+                self.assertEqual(valid, lazy.serialize())
+                self.assertFalse(lazy.inputs.is_decoded(0))
+                # Accessed maps are decoded to the same objects
+                self.assertEqual(psbt.inputs[0].serialize(), lazy.inputs[0].serialize())
+                self.assertTrue(lazy.inputs.is_decoded(0))
+                self.assertEqual([o.serialize() for o in psbt.outputs], [o.serialize() for o in lazy.outputs])
+                self.assertEqual(valid, lazy.serialize())
+
+    def test_cached_txid(self):
+        for valid in self.data['valid']:
+            psbt = PSBT()
+            psbt.deserialize(valid)
+            for psbt_in in psbt.inputs:
+                utxo = psbt_in.non_witness_utxo
+                if utxo is None:
+                    continue
+                with self.subTest(valid=valid):
+                    # Hashes taken from the wire bytes match a fresh serialization
+                    self.assertEqual(utxo.txid, hash256(utxo.serialize_without_witness()))
+                    self.assertEqual(utxo.wtxid, hash256(utxo.serialize_with_witness()))
+                    # Assigning a new value invalidates the cache
+                    utxo.nLockTime += 1
+                    self.assertEqual(utxo.txid, hash256(utxo.serialize_without_witness()))
+                    self.assertEqual(CTransaction(utxo).txid, utxo.txid)
+
+        # Changes in place are picked up when made through mutable_vin(),
+        # mutable_vout() and mutable_witness(), or when inputs, outputs or
+        # witnesses are added or removed
+        tx = PSBT()
+        tx.deserialize(self.data['finalizer'][0]['result'])
+        tx = tx.extract()
+
+        def check_hashes():
+            self.assertEqual(tx.txid, hash256(tx.serialize_without_witness()))
+            self.assertEqual(tx.wtxid, hash256(tx.serialize_with_witness()))
+        check_hashes()
+        tx.mutable_vin(0).nSequence -= 1
+        check_hashes()
+        tx.mutable_vout(1).nValue += 1
+        check_hashes()
+        tx.mutable_witness(1).scriptWitness.stack.append(b"\x01")
+        check_hashes()
+        tx.vout.append(CTxOut(1000, b"\x51"))
+        check_hashes()
+        tx.vin.pop()
+        tx.wit.vtxinwit.pop()
+        check_hashes()
+        # Any other change in place needs a rehash()
+        tx.vin[0].scriptSig = b"\x51"
+        tx.rehash()
+        check_hashes()
+
+    def test_copy_on_write(self):
+        psbt = PSBT()
+        psbt.deserialize(self.data['valid'][1])
+        tx = psbt.tx
+        txid = tx.txid
+        clone = tx.copy_on_write()
+        self.assertEqual(clone.serialize_with_witness(), tx.serialize_with_witness())
+        self.assertIs(clone.vin[0], tx.vin[0])
+        self.assertEqual(clone.txid, txid)
+
+        clone.mutable_vin(0).scriptSig = b"\x51"
+        clone.mutable_vout(0).nValue += 1
+        self.assertIsNot(clone.vin[0], tx.vin[0])
+        self.assertIs(clone.vout[1], tx.vout[1])
+        self.assertEqual(tx.vin[0].scriptSig, b"")
+        self.assertEqual(tx.txid, txid)
+        self.assertEqual(clone.txid, hash256(clone.serialize_without_witness()))
+        self.assertNotEqual(clone.txid, txid)
+
+    def test_shared_non_witness_utxo(self):
+        prev = CTransaction()
+        prev.deserialize(BytesIO(unhexlify(BIP143_TX)))
+        prev.rehash()
+        psbt = PSBT()
+        for n in range(len(prev.vout)):
+            psbt.tx.vin.append(CTxIn(COutPoint(prev.sha256, n)))
+            psbt_in = PartiallySignedInput()
+            psbt_in.non_witness_utxo = CTransaction(prev)
+            psbt.inputs.append(psbt_in)
+        psbt.tx.vout.append(CTxOut(1000, b"\x51"))
+        psbt.outputs.append(PartiallySignedOutput())
+        serd = psbt.serialize()
+
+        for lazy in [False, True]:
+            parsed = PSBT()
+            parsed.deserialize(serd, lazy)
+            self.assertIs(parsed.inputs[0].non_witness_utxo, parsed.inputs[1].non_witness_utxo)
+            self.assertEqual(len(parsed.utxo_cache), 1)
+            self.assertEqual(parsed.serialize(), serd)
+
+            # The intern key is reused as the txids instead of hashing again
+            utxo = parsed.inputs[0].non_witness_utxo
+            self.assertIs(next(iter(parsed.utxo_cache)), utxo._wtxid)
+            self.assertEqual(utxo.txid, prev.txid)
+            self.assertEqual(utxo.wtxid, hash256(utxo.serialize_with_witness()))
+
+    def test_keypath_index(self):
+        for psbt_b64 in self.data['valid']:
+            psbt = PSBT()
+            psbt.deserialize(psbt_b64)
+            indexed = (psbt._input_keypaths, psbt._output_keypaths)
+            psbt.index_keypaths()
+            self.assertEqual((psbt._input_keypaths, psbt._output_keypaths), indexed)
+
+            lazy = PSBT()
+            lazy.deserialize(psbt_b64, lazy=True)
+            for i, psbt_in in enumerate(psbt.inputs):
+                for pubkey, path in psbt_in.hd_keypaths.items():
+                    self.assertIn((pubkey, path), lazy.get_input_keypaths(path[0])[i])
+            for i, psbt_out in enumerate(psbt.outputs):
+                for pubkey, path in psbt_out.hd_keypaths.items():
+                    self.assertIn((pubkey, path), lazy.get_output_keypaths(path[0])[i])
+            # Building the index does not decode the lazy maps
+            lazy.get_input_keypaths(0)
+            self.assertEqual((lazy._input_keypaths, lazy._output_keypaths), indexed)
+            self.assertFalse(any(lazy.inputs.is_decoded(i) for i in range(len(lazy.inputs))))
+            self.assertFalse(any(lazy.outputs.is_decoded(i) for i in range(len(lazy.outputs))))
+        self.assertEqual(psbt.get_input_keypaths(0), {})
+
+# Native P2WPKH example from BIP 143
+BIP143_TX = "0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffffef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac11000000"
+
+class TestSighash(unittest.TestCase):
+    def test_segwit_v0_sighash(self):
+        tx = CTransaction()
+        tx.deserialize(ByteReader(unhexlify(BIP143_TX)))
+        txdata = PrecomputedTransactionData(tx)
+        self.assertEqual(txdata.hashPrevouts.hex(), "96b827c8483d4e9b96712b6713a7b68d6e8003a781feba36c31143470b4efd37")
+        self.assertEqual(txdata.hashSequence.hex(), "52b0a642eea2fb7ae638c36f6252b6750293dbe574a806984b8e4d8548339a3b")
+        script_code = p2wpkh_script_code(unhexlify("00141d0f172a0ecb48aee1be1f2687d2963ae33f71a1"))
+        sighash = txdata.segwit_v0_sighash(1, script_code, 600000000)
+        self.assertEqual(sighash.hex(), "c37af31116d1b27caf68aae9e3ac82f1477929014d5b917657d0eb49478cb670")
+
+    def test_legacy_sighash(self):
+        tx = CTransaction()
+        tx.deserialize(ByteReader(unhexlify(BIP143_TX)))
+        txdata = PrecomputedTransactionData(tx)
+        script_code = unhexlify("76a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac")
+        for i, txin in enumerate(tx.vin):
+            with self.subTest(input=i):
+                # Reference: set the scriptCode as this input's scriptSig and hash the whole transaction
+                blank_tx = CTransaction(tx)
+                blank_tx.vin[i].scriptSig = script_code
+                expected = hash256(blank_tx.serialize_without_witness() + b"\x01\x00\x00\x00")
+                self.assertEqual(txdata.legacy_sighash(i, script_code), expected)
+
 if __name__ == "__main__":
     unittest.main()